@@ -9,7 +9,7 @@ Original Area by Municipality Table was taken from http://www.inide.gob.ni/compe
 
 import os, sys
 import pandas as pd
-import difflib
+import namematch
 
 DATADIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/") 
 INIDE_FPATH = DATADIR + "Area/INIDE_Area_by_Municipality.csv"
@@ -19,55 +19,24 @@ inide_df = pd.read_csv(INIDE_FPATH, delimiter = ',', header=0, encoding='utf-8',
                       dtype = {'Muni_ID' : str, 'Department' : str, 'Municipality' : str, 'Area_km2' : float})
      
 gadm_df = pd.read_csv(GADM_FPATH, delimiter = ',', header=0, encoding='utf-8')
+
+# Match each GADM municipality with an INIDE municipality once (same normalized name, else the most similar name of the same department)
+matcher = namematch.NameMatcher(inide_df['Municipality'].tolist(), inide_df['Department'].tolist())
+inide_rows = matcher.match_all(gadm_df['NAME_2'].astype(str).tolist(), gadm_df['NAME_1'].astype(str).tolist())
+inide_ids = [inide_df['Muni_ID'].iat[row] if row is not None else None for row in inide_rows]
+inide_areas = [float(inide_df['Area_km2'].iat[row]) if row is not None else None for row in inide_rows]
+print('%d of %d GADM municipalities matched' % (sum(row is not None for row in inide_rows), len(inide_rows)))
                       
 inide_gadm_df = pd.DataFrame(data = {'Municipality' : gadm_df['NAME_2'].astype(str),
                                      'GADM_OBJECTID' : gadm_df['OBJECTID'].astype(str), 
-                                     'INIDE_muniID' : None})
+                                     'INIDE_muniID' : [str(inide_id) for inide_id in inide_ids]})
                                      
 gadm_area_df = pd.DataFrame(data = {'Municipality' : gadm_df['NAME_2'].astype(str),
                                      'GADM_OBJECTID' : gadm_df['OBJECTID'].astype(str), 
-                                     'INIDE_Area' : None})
+                                     'INIDE_Area' : inide_areas})
 
 del gadm_df
 
-inide_names = inide_df['Municipality'].tolist()
-
-def get_inide_muni(gadm_muni_name):
-    """
-    Return the name of a municipality from the INIDE table given its GADM municipality name
-    """
-    name = None
-    if gadm_muni_name:
-        name = difflib.get_close_matches(gadm_muni_name, inide_names, n=1, cutoff=0.6)
-        name = name[0] if name else None
-    return name
-
-def get_inide_muniID(gadm_muni_name):
-    """
-    Return the INIDE muniID given its GADM municipality name
-    """
-    inideID = None
-    if gadm_muni_name:
-        inide_name = get_inide_muni(gadm_muni_name)
-        if inide_name:
-            inideID = inide_df.loc[inide_df['Municipality'] == inide_name, 'Muni_ID'].values[0] 
-    return str(inideID)
-    
-def get_inide_area(inide_id):
-    """
-    Return the area of a municipality given its id from the INIDE table
-    """
-    area = inide_df.loc[inide_df['Muni_ID'] == inide_id, 'Area_km2'].values
-    area = float(area[0]) if area else None
-    return area
-    
-inide_gadm_df['INIDE_muniID'] = inide_gadm_df['Municipality'].map(lambda x: get_inide_muniID(x))
-
-gadm_area_df['INIDE_ID'] = gadm_area_df['Municipality'].map(lambda x: get_inide_muniID(x))
-gadm_area_df['INIDE_Area'] = gadm_area_df['INIDE_ID'].map(lambda x: get_inide_area(x))
- 
-del gadm_area_df['INIDE_ID']
-
 # KEYS_GADM_INIDE table
 output_fname = "Area/" + "TEMP_KEYS_GADM_INIDE.csv"
 inide_gadm_df.to_csv(DATADIR + output_fname, delimiter = ',', header=True, quotechar='"', encoding='utf-8', index=False)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Match names of administrative areas between tables (e.g. the GADM and INIDE municipalities) which spell them differently.
+
+Names are normalized (accents removed, lower case, punctuation and stop words such as "San" or "de" dropped), then looked up
+by their normalized key in a hash table, first in the same department. Only the names without an exact match are compared
+(difflib ratio and shared words) with the names of the same department, so matching a table is near-linear and does not depend on
+the order of the names. Results are memoized, so matching the same name twice is free.
+Example:
+  matcher = NameMatcher(inide_df['Municipality'].tolist(), inide_df['Department'].tolist())
+  rows = matcher.match_all(gadm_df['NAME_2'].tolist(), gadm_df['NAME_1'].tolist())   # row numbers in the INIDE table, or None
+"""
+
+import re
+import difflib
+import unicodedata
+
+STOP_WORDS = {'de', 'del', 'la', 'las', 'el', 'los', 'y', 'san', 'santa', 'santo', 'municipio', 'departamento'}
+CUTOFF = 0.6
+
+def fold(name):
+    """ Lower case name, remove accents and split it into words (e.g. 'San José de Cusmapa' -> ['san', 'jose', 'de', 'cusmapa']) """
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    return re.findall(r'[^\W_]+', name)
+
+def normalize_name(name):
+    """ Return the key of a name: its folded words without the stop words (all the words if they are all stop words) """
+    words = fold(name)
+    return ' '.join([word for word in words if word not in STOP_WORDS] or words)
+
+class NameMatcher(object):
+    """
+    Index of the names of a table, optionally with the group (e.g. department) of each name.
+    names: list of names; groups (optional): list of the groups of the names; cutoff: minimum difflib similarity of fuzzy matches
+    """
+    def __init__(self, names, groups=None, cutoff=CUTOFF):
+        self.names = list(names)
+        self.cutoff = cutoff
+        self.keys = [normalize_name(name) for name in self.names]
+        self.rows = {}          # (group key, name key) and (None, name key) -> row numbers, in order
+        self.group_rows = {}    # group key -> row numbers, in order
+        self.group_matcher = None
+        self.memo = {}
+        group_keys = [normalize_name(group) for group in groups] if groups is not None else [None] * len(self.names)
+        for row, (group_key, key) in enumerate(zip(group_keys, self.keys)):
+            self.rows.setdefault((group_key, key), []).append(row)
+            if group_key is not None:
+                self.rows.setdefault((None, key), []).append(row)
+                self.group_rows.setdefault(group_key, []).append(row)
+        if groups is not None:
+            # Groups are matched the same way, e.g. 'Atlántico Norte' with 'Atlantico Norte'
+            self.group_names = sorted(self.group_rows)
+            self.group_matcher = NameMatcher(self.group_names, cutoff=cutoff)
+
+    def match_group(self, group):
+        """ Return the key of the group of the index matching group, or None """
+        if self.group_matcher is None or not group:
+            return None
+        row = self.group_matcher.match(group)
+        return None if row is None else self.group_names[row]
+
+    def fuzzy(self, key, rows):
+        """
+        Return the row of rows whose key is the most similar to key, if similar enough, or None. The similarity is the best of
+        the difflib ratio and of the share of the words of the shorter key found in the other (e.g. 'dario' and 'ciudad dario'),
+        ties being broken by the difflib ratio, then by row order
+        """
+        best, best_score = None, (self.cutoff, 0.)
+        words = set(key.split())
+        matcher = difflib.SequenceMatcher(None, '', key)
+        for row in rows:
+            matcher.set_seq1(self.keys[row])
+            row_words = set(self.keys[row].split())
+            overlap = len(words & row_words) / float(min(len(words), len(row_words)) or 1)
+            if overlap < best_score[0] and matcher.real_quick_ratio() < best_score[0]:
+                continue
+            ratio = matcher.ratio()
+            score = (max(overlap, ratio), ratio)
+            if score > best_score or (best is None and score[0] >= self.cutoff):
+                best, best_score = row, score
+        return best
+
+    def match(self, name, group=None):
+        """
+        Return the row number of the name matching name (in group if given), or None: the first name with the same key in the
+        group, else in any group, else the most similar name of the group (of all the names if the group is unknown)
+        """
+        if (name, group) in self.memo:
+            return self.memo[name, group]
+        key = normalize_name(name)
+        row = None
+        if key:
+            group_key = self.match_group(group)
+            rows = self.rows.get((group_key, key)) or self.rows.get((None, key))
+            if rows:
+                row = rows[0]
+            else:
+                row = self.fuzzy(key, self.group_rows[group_key] if group_key is not None else range(len(self.names)))
+        self.memo[name, group] = row
+        return row
+
+    def match_all(self, names, groups=None):
+        """ Return the list of the row numbers matching names (optionally in groups), None for names without match """
+        if groups is None:
+            groups = [None] * len(names)
+        return [self.match(name, group) for name, group in zip(names, groups)]
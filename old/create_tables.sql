@@ -68,3 +68,69 @@ CREATE TABLE IF NOT EXISTS OSMMetadata
         ON DELETE CASCADE
         ON UPDATE CASCADE
 );
+
+CREATE TABLE IF NOT EXISTS AltNames
+(   placeid     INTEGER     NOT NULL,
+    name        TEXT     NOT NULL,
+    PRIMARY KEY(placeid, name),
+    FOREIGN KEY(placeid) REFERENCES Places(placeid)
+      ON DELETE CASCADE
+      ON UPDATE CASCADE
+);
+
+-- R*Tree index of the coordinates of Places (one point box per place), queried by osm_db/osmsqlite.py. Triggers keep the index in
+-- sync with Places whichever loader inserts the places (osmsqlite.py, insert_data.py); osmsqlite.build_spatial_index fills it
+-- for a database loaded before the index existed
+CREATE VIRTUAL TABLE IF NOT EXISTS PlacesRTree USING rtree(placeid, min_lat, max_lat, min_lng, max_lng);
+
+CREATE TRIGGER IF NOT EXISTS PlacesRTreeInsert AFTER INSERT ON Places
+BEGIN
+    INSERT INTO PlacesRTree(placeid, min_lat, max_lat, min_lng, max_lng) VALUES (NEW.placeid, NEW.lat, NEW.lat, NEW.lng, NEW.lng);
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlacesRTreeUpdate AFTER UPDATE OF placeid, lat, lng ON Places
+BEGIN
+    DELETE FROM PlacesRTree WHERE placeid = OLD.placeid;
+    INSERT INTO PlacesRTree(placeid, min_lat, max_lat, min_lng, max_lng) VALUES (NEW.placeid, NEW.lat, NEW.lat, NEW.lng, NEW.lng);
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlacesRTreeDelete AFTER DELETE ON Places
+BEGIN
+    DELETE FROM PlacesRTree WHERE placeid = OLD.placeid;
+END;
+
+-- Full-text index of the names of Places and of their AltNames (accents removed, prefix indexes of 2 to 4 characters), queried by
+-- osm_db/namesearch.py. The names of Places have rowid -placeid, the AltNames the rowid of their row; triggers keep the index in sync
+CREATE VIRTUAL TABLE IF NOT EXISTS PlaceNames USING fts5(name, placeid UNINDEXED, tokenize='unicode61 remove_diacritics 2', prefix='2 3 4');
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesPlacesInsert AFTER INSERT ON Places WHEN NEW.name IS NOT NULL AND NEW.name != ''
+BEGIN
+    INSERT INTO PlaceNames(rowid, name, placeid) VALUES (-NEW.placeid, NEW.name, NEW.placeid);
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesPlacesUpdate AFTER UPDATE OF placeid, name ON Places
+BEGIN
+    DELETE FROM PlaceNames WHERE rowid = -OLD.placeid;
+    INSERT INTO PlaceNames(rowid, name, placeid) SELECT -NEW.placeid, NEW.name, NEW.placeid WHERE NEW.name IS NOT NULL AND NEW.name != '';
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesPlacesDelete AFTER DELETE ON Places
+BEGIN
+    DELETE FROM PlaceNames WHERE rowid = -OLD.placeid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesAltNamesInsert AFTER INSERT ON AltNames
+BEGIN
+    INSERT INTO PlaceNames(rowid, name, placeid) VALUES (NEW.rowid, NEW.name, NEW.placeid);
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesAltNamesUpdate AFTER UPDATE OF placeid, name ON AltNames
+BEGIN
+    DELETE FROM PlaceNames WHERE rowid = OLD.rowid;
+    INSERT INTO PlaceNames(rowid, name, placeid) VALUES (NEW.rowid, NEW.name, NEW.placeid);
+END;
+
+CREATE TRIGGER IF NOT EXISTS PlaceNamesAltNamesDelete AFTER DELETE ON AltNames
+BEGIN
+    DELETE FROM PlaceNames WHERE rowid = OLD.rowid;
+END;
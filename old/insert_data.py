@@ -1,132 +1,214 @@
 # -*- coding: utf-8 -*-
 
 """
-Insert data from the csv files obtained from search_for_health_units.py into SQLite Database: Places, Reviews, GoogleMetadata, and AmenityTypes tables. 
+Insert data from the csv files obtained from search_for_health_units.py into SQLite Database: Places, Reviews, GoogleMetadata, and AmenityTypes tables.
+
+By default the csv files of each search are loaded in bulk: the places, reviews and types are grouped by place_id in dicts,
+the new rows are inserted with executemany in one transaction per search, and rows already in the database are skipped
+with UPSERT (ON CONFLICT DO NOTHING) clauses. The database is opened in WAL mode with the pragmas of PRAGMAS.
+Run `python insert_data.py --bb 0 1 2` to load bounding boxes 0 to 2 (default: all), `--row-by-row` to use the original,
+one row at a time insertion. Both modes give the same tables.
 """
 
 import os
+import argparse
 import fnmatch
 import sqlite3
 import csv
 import re
+import time
+
+FDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "google_data")
+DB_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'NICA.db')
+# Number of bounding boxes of search_for_health_units.NIC_BOUNDBOXES
+NUM_BOUNDBOXES = 12
+# Pragmas of the bulk mode: write-ahead log, fewer fsyncs (the database stays consistent, a crash may lose the last transaction),
+# 64 MB page cache and temporary tables in memory
+PRAGMAS = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL', 'PRAGMA cache_size=-65536', 'PRAGMA temp_store=MEMORY']
+
+PLACES_COLUMNS = ['placeid', 'name', 'lat', 'lng', 'source', 'date_retrieved', 'address', 'streetnumber', 'streetname',
+                  'citytown', 'province', 'postalcode', 'phonenum', 'website', 'permanently_closed', 'vicinity', 'owner', 'google_rating']
+
+def search_files(fdir, bb_num):
+    """ Return the list of the (prefix, search) of the searches of bounding box bb_num, e.g. ('BB0', 'LON-86.3675_LAT+11.6550_RAD4000m') """
+    bbname = 'BB%s' % bb_num
+    files = sorted(fnmatch.filter(os.listdir(fdir), bbname + 'METADATA_*.csv'))
+    return [(bbname, re.sub(bbname + 'METADATA_(.*).csv', '\\1', filename)) for filename in files]
+
+def read_rows(fdir, prefix, table, strmatch):
+    """ Return the rows (dicts) of the csv file of table (e.g. 'PLACES') of a search, or [] if there is no such file """
+    fpath = os.path.join(fdir, prefix + table + '_' + strmatch + '.csv')
+    if not os.path.exists(fpath):
+        return []
+    with open(fpath, encoding='utf-8') as f:
+        return list(csv.DictReader(f, delimiter=';'))
+
+def group_by_place_id(rows):
+    """ Return {place_id: [rows with this place_id, in order]} """
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['place_id'], []).append(row)
+    return groups
 
-fdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "/data/google_data/")
-
-bb = 0
-bbname = 'BB%s' %bb
-files = fnmatch.filter(os.listdir(fdir), bbname + 'METADATA_*.csv')
-
-conn = sqlite3.connect(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'NICA.db'))
-cur = conn.cursor()
-
-# Data insertion is done as follows: for each search grid (specified by LAT, LON), we first insert a place, specified with google_id into the GoogleMetadata Table. If the insertion fails, skip the current google_id. If the insertion is successful, insert the corresponding place details into Places Table, generating a placeid key. Copy this newly generated key back into the GoogleMetadata Table. If reviews and types are found for this google_id, insert the corresponding entries into Reviews and AmenityTypes tables. 
-for filename in files:
-    strmatch = re.sub(bbname + 'METADATA_(.*).csv', '\\1', filename)      
-    
-    with open(os.path.join(fdir, 'METADATA_' + strmatch + '.csv'), encoding='utf-8') as csv_metadata, \
-         open(os.path.join(fdir, 'PLACES_' + strmatch + '.csv'), encoding='utf-8') as csv_places:
-        
-        places_reader = csv.DictReader(csv_places, delimiter=';')
-        places = [row for row in places_reader]
-        
-        if fnmatch.filter(os.listdir(fdir), 'REVIEWS_' + strmatch + '.csv'):
-            with open(os.path.join(fdir, 'REVIEWS_' + strmatch + '.csv'), encoding='utf-8') as csv_reviews:
-                reviews_reader = csv.DictReader(csv_reviews, delimiter=';')
-                reviews = [row for row in reviews_reader]    
-        else: reviews = []
-        
-        if fnmatch.filter(os.listdir(fdir), 'TYPES_' + strmatch + '.csv'):
-            with open(os.path.join(fdir, 'TYPES_' + strmatch + '.csv'), encoding='utf-8') as csv_types:
-                types_reader = csv.DictReader(csv_types, delimiter=';')
-                types = [row for row in types_reader]    
-        else: types = []
-        
-        metadata_reader = csv.DictReader(csv_metadata, delimiter=';')
-        for metadata in metadata_reader:
-            placeid = None
+def place_values(place):
+    """ Return the values of the columns of the Places table after placeid, for a row of a PLACES csv file """
+    return (place['name'],
+            place['lat'] if place['lat'] != '' else None,
+            place['lng'] if place['lng'] != '' else None,
+            'Google', place['date_retrieved'], place['formatted_address'], place['street_number'], place['street_name'],
+            place['city'], place['province'], place['postal_code'], place['phone_number'], place['website'],
+            place['permanently_closed'], place['vicinity'], None, place['rating'])
+
+def connect(db_fpath=DB_FPATH):
+    """ Open the database with the pragmas of the bulk mode """
+    conn = sqlite3.connect(db_fpath)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def insert_search_bulk(conn, fdir, prefix, strmatch):
+    """
+    Insert the places of a search (its METADATA, PLACES, REVIEWS and TYPES csv files) in one transaction.
+    As in insert_search_row_by_row, a metadata row is skipped if its google_id is already in GoogleMetadata, has no place,
+    or its place has no coordinates; only the first reviews of an author and the first of each type are kept.
+    Return the number of places inserted
+    """
+    metadata_rows = read_rows(fdir, prefix, 'METADATA', strmatch)
+    places = {}
+    for place in read_rows(fdir, prefix, 'PLACES', strmatch):
+        places.setdefault(place['place_id'], place)
+    reviews = group_by_place_id(read_rows(fdir, prefix, 'REVIEWS', strmatch))
+    types = group_by_place_id(read_rows(fdir, prefix, 'TYPES', strmatch))
+
+    with conn:
+        cur = conn.cursor()
+        google_ids = list(set(metadata['place_id'] for metadata in metadata_rows))
+        existing = set()
+        for start in range(0, len(google_ids), 500):
+            batch = google_ids[start:start + 500]
+            cur.execute('SELECT google_id FROM GoogleMetadata WHERE google_id IN (%s);' % ','.join('?' * len(batch)), batch)
+            existing.update(row[0] for row in cur)
+        # Place ids are assigned here, as SQLite would (largest placeid + 1), so that the rows of all the tables are inserted at once
+        placeid = cur.execute('SELECT COALESCE(MAX(placeid), 0) FROM Places;').fetchone()[0]
+        place_rows, metadata_values, review_rows, type_rows = [], [], [], []
+        for metadata in metadata_rows:
             google_id = metadata['place_id']
-            url = metadata['url']
-            scope = metadata['scope']            
-            try:
-                cur.execute(''' INSERT INTO GoogleMetadata(id, google_id, url, idscope) \
-                                VALUES (?, ?, ?, ?);''', (placeid, google_id, url, scope))   
-                                
-                # Find the row in places (list of all places) with matching place_id
-                place = next(filter(lambda x: x['place_id'] == google_id, places))
-                if place:
-                    name = place['name']
-                    lat = place['lat'] if place['lat'] != '' else None
-                    lng = place['lng'] if place['lng'] != '' else None
-                    source = 'Google'
-                    date_retrieved = place['date_retrieved']
-                    address = place['formatted_address']
-                    streetnumber = place['street_number']
-                    streetname = place['street_name']
-                    citytown = place['city']
-                    province = place['province']
-                    postalcode = place['postal_code']
-                    phonenum = place['phone_number']
-                    website = place['website']
-                    permanently_closed = place['permanently_closed']
-                    vicinity = place['vicinity']
-                    owner = None
-                    google_rating = place['rating']
-                    
-                    try:
-                        cur.execute('''INSERT INTO Places(name, lat, lng, source, date_retrieved, address, streetnumber, \
-                                                     streetname, citytown, province, postalcode, phonenum, website, \
-                                                     permanently_closed, vicinity, owner, google_rating) \
-                                            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', \
-                                     (name, lat, lng, source, date_retrieved, address, streetnumber, streetname, \
-                                     citytown, province, postalcode, phonenum, website, permanently_closed, \
-                                     vicinity, owner, google_rating) )
-                        
-                        placeid = cur.lastrowid   # get the latest generated placeid key
-                        
-                        print(placeid)
-                        
-                        # UPDATE GoogleMetadata Table with placeid
-                        cur.execute('''UPDATE GoogleMetadata SET id = '%s' WHERE google_id = '%s'; ''' %(placeid, google_id))
-                        
-                        # Insert reviews and amenity types, if corresponding entries exist
-                        for review in filter(lambda x: x['place_id'] == google_id, reviews):
-                            author_name = review['author_name']
-                            user_rating = review['rating']
-                            text = review['text']
-                            review_time = review['time']
-                            lang = review['language']                            
-                            try:
-                                cur.execute('''INSERT INTO Reviews(placeid, author_name, user_rating, text, review_time, lang) \
-                                            VALUES(?, ?, ?, ?, ?, ?);''', \
-                                           (placeid, author_name, user_rating, text, review_time, lang))
-                            except sqlite3.Error as e:
-                                print("An error occurred when inserting into Reviews table:", e.args[0])
-                                print("None is inserted.")
-                                
-                        for type in filter(lambda x: x['place_id'] == google_id, types):
-                            amtype = type['type']
-                            source = 'Google'                            
-                            try:
-                                cur.execute('''INSERT INTO AmenityTypes(placeid, amtype, source) \
-                                               VALUES(?, ?, ?);''', (placeid, amtype, source))
-                            except sqlite3.Error as e:
-                                print("An error occurred when inserting into AmenityTypes table:", e.args[0])
-                                print("None is inserted.")
-                                
-                    except sqlite3.IntegrityError:
-                        # If fail to insert, delete the corresponding entry in the metadata table.
-                        print('Insertion into Places table failed. Possibly null values in lat, lng. Deleting the corresponding entry in the Metadata table...')
-                        # Integrity error... Delete the item in Metadata table
-                        cur.execute('''DELETE FROM GoogleMetadata WHERE google_id = '%s'; ''' %google_id)
-                else:
-                    # Metadata exists but no corresponding place in Place Table, delete the item in metadata table
-                    print('Metadata exists but no corresponding entry in the Place table. Deleting the entry from the Metadata table...')
-                    cur.execute('''DELETE FROM GoogleMetadata WHERE google_id = '%s';''' %google_id)
-                    
-            except sqlite3.IntegrityError:
-                print('Item already exists. Cannot add twice.')
-                
-            conn.commit()
-    
-conn.close()
-    
\ No newline at end of file
+            place = places.get(google_id)
+            if google_id in existing or place is None or place['lat'] == '' or place['lng'] == '':
+                continue
+            existing.add(google_id)
+            placeid += 1
+            place_rows.append((placeid, ) + place_values(place))
+            metadata_values.append((placeid, google_id, metadata['url'], metadata['scope']))
+            review_rows.extend((placeid, review['author_name'], review['rating'], review['text'], review['time'], review['language'])
+                               for review in reviews.get(google_id, ()))
+            type_rows.extend((placeid, type['type'], 'Google') for type in types.get(google_id, ()))
+
+        cur.executemany('INSERT INTO Places(%s) VALUES(%s);' % (', '.join(PLACES_COLUMNS), ', '.join('?' * len(PLACES_COLUMNS))), place_rows)
+        cur.executemany('''INSERT INTO GoogleMetadata(id, google_id, url, idscope) VALUES (?, ?, ?, ?)
+                           ON CONFLICT(google_id) DO NOTHING;''', metadata_values)
+        cur.executemany('''INSERT INTO Reviews(placeid, author_name, user_rating, text, review_time, lang) VALUES(?, ?, ?, ?, ?, ?)
+                           ON CONFLICT(placeid, author_name) DO NOTHING;''', review_rows)
+        cur.executemany('''INSERT INTO AmenityTypes(placeid, amtype, source) VALUES(?, ?, ?)
+                           ON CONFLICT(placeid, amtype) DO NOTHING;''', type_rows)
+    return len(place_rows)
+
+def insert_search_row_by_row(conn, fdir, prefix, strmatch):
+    """ Insert the places of a search one row at a time, committing after each metadata row (original insertion). Return the number of places inserted """
+    cur = conn.cursor()
+    count = 0
+    places = read_rows(fdir, prefix, 'PLACES', strmatch)
+    reviews = read_rows(fdir, prefix, 'REVIEWS', strmatch)
+    types = read_rows(fdir, prefix, 'TYPES', strmatch)
+
+    # Data insertion is done as follows: for each search grid (specified by LAT, LON), we first insert a place, specified with google_id into the GoogleMetadata Table. If the insertion fails, skip the current google_id. If the insertion is successful, insert the corresponding place details into Places Table, generating a placeid key. Copy this newly generated key back into the GoogleMetadata Table. If reviews and types are found for this google_id, insert the corresponding entries into Reviews and AmenityTypes tables.
+    for metadata in read_rows(fdir, prefix, 'METADATA', strmatch):
+        placeid = None
+        google_id = metadata['place_id']
+        url = metadata['url']
+        scope = metadata['scope']
+        try:
+            cur.execute(''' INSERT INTO GoogleMetadata(id, google_id, url, idscope) \
+                            VALUES (?, ?, ?, ?);''', (placeid, google_id, url, scope))
+
+            # Find the row in places (list of all places) with matching place_id
+            place = next(filter(lambda x: x['place_id'] == google_id, places), None)
+            if place:
+                try:
+                    cur.execute('''INSERT INTO Places(%s) VALUES(%s);''' % (', '.join(PLACES_COLUMNS[1:]), ', '.join('?' * (len(PLACES_COLUMNS) - 1))),
+                                place_values(place))
+
+                    placeid = cur.lastrowid   # get the latest generated placeid key
+
+                    print(placeid)
+
+                    # UPDATE GoogleMetadata Table with placeid
+                    cur.execute('''UPDATE GoogleMetadata SET id = ? WHERE google_id = ?; ''', (placeid, google_id))
+                    count += 1
+
+                    # Insert reviews and amenity types, if corresponding entries exist
+                    for review in filter(lambda x: x['place_id'] == google_id, reviews):
+                        author_name = review['author_name']
+                        user_rating = review['rating']
+                        text = review['text']
+                        review_time = review['time']
+                        lang = review['language']
+                        try:
+                            cur.execute('''INSERT INTO Reviews(placeid, author_name, user_rating, text, review_time, lang) \
+                                        VALUES(?, ?, ?, ?, ?, ?);''', \
+                                       (placeid, author_name, user_rating, text, review_time, lang))
+                        except sqlite3.Error as e:
+                            print("An error occurred when inserting into Reviews table:", e.args[0])
+                            print("None is inserted.")
+
+                    for type in filter(lambda x: x['place_id'] == google_id, types):
+                        amtype = type['type']
+                        source = 'Google'
+                        try:
+                            cur.execute('''INSERT INTO AmenityTypes(placeid, amtype, source) \
+                                           VALUES(?, ?, ?);''', (placeid, amtype, source))
+                        except sqlite3.Error as e:
+                            print("An error occurred when inserting into AmenityTypes table:", e.args[0])
+                            print("None is inserted.")
+
+                except sqlite3.IntegrityError:
+                    # If fail to insert, delete the corresponding entry in the metadata table.
+                    print('Insertion into Places table failed. Possibly null values in lat, lng. Deleting the corresponding entry in the Metadata table...')
+                    # Integrity error... Delete the item in Metadata table
+                    cur.execute('''DELETE FROM GoogleMetadata WHERE google_id = ?; ''', (google_id, ))
+            else:
+                # Metadata exists but no corresponding place in Place Table, delete the item in metadata table
+                print('Metadata exists but no corresponding entry in the Place table. Deleting the entry from the Metadata table...')
+                cur.execute('''DELETE FROM GoogleMetadata WHERE google_id = ?;''', (google_id, ))
+
+        except sqlite3.IntegrityError:
+            print('Item already exists. Cannot add twice.')
+
+        conn.commit()
+    return count
+
+def main(bb_nums=None, fdir=FDIR, db_fpath=DB_FPATH, row_by_row=False):
+    """
+    Insert the searches of the bounding boxes bb_nums (default: all) found in fdir into the database db_fpath (see create_tables.sql).
+    row_by_row: if True, use the original insertion instead of the bulk one
+    """
+    if bb_nums is None:
+        bb_nums = range(NUM_BOUNDBOXES)
+    conn = sqlite3.connect(db_fpath) if row_by_row else connect(db_fpath)
+    insert_search = insert_search_row_by_row if row_by_row else insert_search_bulk
+    start = time.time()
+    for bb_num in bb_nums:
+        searches = search_files(fdir, bb_num)
+        count = sum(insert_search(conn, fdir, prefix, strmatch) for prefix, strmatch in searches)
+        print('BB%s: %d places inserted from %d searches' % (bb_num, count, len(searches)))
+    print('Done in %.1f s' % (time.time() - start))
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Insert the results of search_for_health_units.py into the SQLite database')
+    parser.add_argument('--bb', type=int, nargs='+', help='numbers of the bounding boxes to load (default: all)')
+    parser.add_argument('--data-dir', default=FDIR, help='folder of the csv files (default: google_data next to this script)')
+    parser.add_argument('--db', default=DB_FPATH, help='SQLite database (default: NICA.db next to this script)')
+    parser.add_argument('--row-by-row', action='store_true', help='insert one row at a time, committing after each place')
+    args = parser.parse_args()
+    main(args.bb, args.data_dir, args.db, args.row_by_row)
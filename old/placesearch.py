@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent search of places with the Google Places API web service (a search request per cell, then a details request per place),
+used by search_for_health_units.py.
+
+Requests are sent from a thread pool driven by asyncio: at most `concurrency` requests are in flight, and a token bucket limits
+them to `rate` requests per second. Failed requests are retried with exponential backoff; an OVER_QUERY_LIMIT or REQUEST_DENIED
+answer stops the search (QuotaExceeded), and any other unexpected answer raises PlacesAPIError, so that the cell is not
+checkpointed as done. The next page of the results of a search is requested PAGE_TOKEN_DELAY seconds after its token is
+received, and again with backoff while the API answers INVALID_REQUEST (a token is valid only after a short delay). Successful responses are kept in an on-disk cache keyed by the request parameters
+(location, radius and types of a search, placeid of a details request), and each cell written to csv files is appended to a
+checkpoint file, so that an interrupted search skips the cells already done and does not pay again for the cached requests.
+base_url is the address of the API, so that the searcher can be run against a local stub server.
+Example:
+  searcher = PlacesSearcher(API_KEY, 'google_data/', concurrency=8, rate=10.)
+  searcher.run([('BB0', 13.5, -84.0, '4000', 'hospital|health'), ...])
+"""
+
+import os
+import csv
+import json
+import time
+import random
+import hashlib
+import asyncio
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BASE_URL = 'https://maps.googleapis.com/maps/api/place/'
+SEARCH_ENDPOINT = 'nearbysearch/json'
+DETAILS_ENDPOINT = 'details/json'
+MAX_RETRIES = 4
+# Delay before the first retry, doubled at each retry (plus up to 100% random jitter)
+RETRY_DELAY = 1.
+TIMEOUT = 30
+# Answers of the API meaning that no more requests will succeed today
+QUOTA_STATUSES = ('OVER_QUERY_LIMIT', 'REQUEST_DENIED')
+# Answers worth retrying
+RETRY_STATUSES = ('UNKNOWN_ERROR', )
+# Answers of a details request for a place_id that no longer exists: the place is skipped
+SKIP_STATUSES = ('NOT_FOUND', )
+# Delay before requesting the next page of results, in s: its token becomes valid about 2 s after it is received
+PAGE_TOKEN_DELAY = 2.
+CHECKPOINT_FILENAME = 'checkpoint.jsonl'
+
+FIELDNAMES = { 'places' : ['place_id', 'name', 'lat', 'lng', 'date_retrieved', 'formatted_address', 'street_number', 'street_name',
+                           'city', 'province', 'postal_code', 'phone_number', 'website', 'permanently_closed', 'vicinity', 'rating'],
+               'reviews' : ['place_id', 'author_name', 'rating', 'text', 'time', 'language'],
+               'metadata' : ['place_id', 'url', 'scope'],
+               'types' : ['place_id', 'type'] }
+# address_components types of the fields of the places table
+ADDRESS_FIELDS = [('street_number', 'street_number'), ('route', 'street_name'), ('locality', 'city'),
+                  ('administrative_area_level_1', 'province'), ('postal_code', 'postal_code')]
+
+class QuotaExceeded(Exception):
+    pass
+
+class PlacesAPIError(IOError):
+    pass
+
+class TokenBucket(object):
+    """ Allow rate acquisitions per second on average, and bursts of up to capacity acquisitions """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        """ Wait until a token is available and take it (the lock is created by the first acquire of each event loop, see reset) """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def reset(self):
+        """ Drop the lock, bound to the event loop that used it, so that the bucket can be used by another event loop """
+        self.lock = None
+
+class ResponseCache(object):
+    """ JSON responses stored in cache_dir, one file per request, keyed by the request parameters without the API key """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, endpoint, params):
+        key = json.dumps([endpoint, sorted((k, v) for k, v in params.items() if k != 'key')])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.json')
+
+    def get(self, endpoint, params):
+        fpath = self.path(endpoint, params)
+        if not os.path.exists(fpath):
+            return None
+        with open(fpath, encoding='utf-8') as f:
+            return json.load(f)
+
+    def put(self, endpoint, params, response):
+        fpath = self.path(endpoint, params)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(response, f, ensure_ascii=False)
+        os.replace(fpath + '.tmp', fpath)
+
+def fetch_json(url, timeout=TIMEOUT):
+    """ Return the decoded JSON response of a GET request """
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def cell_name(lat, lon, radius):
+    """ Return the name of the csv files of a search cell, e.g. 'LON-86.3675_LAT+11.6550_RAD4000m' (see search_for_health_units.py) """
+    return 'LON%+03.4f_' % lon + 'LAT%+03.4f_' % lat + 'RAD%sm' % radius
+
+def place_rows(place_id, result, date_retrieved):
+    """ Return the rows of the places, reviews, metadata and types tables of the result of a details request """
+    location = result.get('geometry', {}).get('location', {})
+    place = { 'place_id' : place_id,
+              'name' : result.get('name', ''),
+              'lat' : location.get('lat', ''),
+              'lng' : location.get('lng', ''),
+              'date_retrieved' : date_retrieved,
+              'formatted_address' : result.get('formatted_address', ''),
+              'phone_number' : result.get('formatted_phone_number', ''),
+              'website' : result.get('website', ''),
+              'permanently_closed' : result.get('permanently_closed', ''),
+              'vicinity' : result.get('vicinity', ''),
+              'rating' : result.get('rating', '') }
+    for component_type, field in ADDRESS_FIELDS:
+        place[field] = next((c.get('long_name', '') for c in result.get('address_components', []) if component_type in c.get('types', [])), '')
+    reviews = [{ 'place_id' : place_id,
+                 'author_name' : review.get('author_name', ''),
+                 'rating' : review.get('rating', ''),
+                 'text' : review.get('text', ''),
+                 'time' : review.get('time', ''),
+                 'language' : review.get('language', '') } for review in result.get('reviews', [])]
+    metadata = { 'place_id' : place_id, 'url' : result.get('url', ''), 'scope' : result.get('scope', '') }
+    types = [{ 'place_id' : place_id, 'type' : type } for type in result.get('types', [])]
+    return place, reviews, metadata, types
+
+def write_table(fpath, rows, fieldnames):
+    with open(fpath, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames, delimiter=';', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+class PlacesSearcher(object):
+    """
+    api_key: Google API key; out_dir: folder of the csv files, of the checkpoint file and (default) of the response cache
+    concurrency: maximum number of requests in flight; rate: maximum number of requests per second
+    base_url: address of the Places API (e.g. http://localhost:8000/ for a stub server)
+    """
+    def __init__(self, api_key, out_dir, concurrency=8, rate=10., base_url=BASE_URL, cache_dir=None, checkpoint_fpath=None,
+                 max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY, page_delay=PAGE_TOKEN_DELAY):
+        self.api_key = api_key
+        self.out_dir = out_dir
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.base_url = base_url
+        self.cache = ResponseCache(cache_dir or os.path.join(out_dir, '.cache'))
+        self.checkpoint_fpath = checkpoint_fpath or os.path.join(out_dir, CHECKPOINT_FILENAME)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.page_delay = page_delay
+        self.counts = {'requests' : 0, 'cached' : 0, 'retries' : 0}
+
+    def checkpoint(self):
+        """ Return {(prefix, cell name): {'places': places written, 'results': places found by the search}} of the cells of the checkpoint file """
+        done = {}
+        if os.path.exists(self.checkpoint_fpath):
+            with open(self.checkpoint_fpath, encoding='utf-8') as f:
+                for line in f:
+                    item = json.loads(line)
+                    # Cells checkpointed before the number of results was recorded
+                    item.setdefault('results', item['places'])
+                    done[item['prefix'], item['cell']] = item
+        return done
+
+    def done_cells(self):
+        """ Return the set of the (prefix, cell name) of the cells of the checkpoint file """
+        return set(self.checkpoint())
+
+    async def request(self, endpoint, params, delay=0.):
+        """
+        Return the JSON response of a request, from the cache if possible, else sent after delay seconds.
+        Raise QuotaExceeded, or PlacesAPIError for an unexpected answer or after max_retries failures
+        """
+        response = self.cache.get(endpoint, params)
+        if response is not None:
+            self.counts['cached'] += 1
+            return response
+        url = self.base_url + endpoint + '?' + urllib.parse.urlencode(dict(params, key=self.api_key))
+        loop = asyncio.get_running_loop()
+        if delay:
+            await asyncio.sleep(delay)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.counts['retries'] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1) * (1 + random.random()))
+            async with self.semaphore:
+                await self.bucket.acquire()
+                self.counts['requests'] += 1
+                try:
+                    response = await loop.run_in_executor(None, fetch_json, url)
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    error = e
+                    continue
+            status = response.get('status')
+            if status in QUOTA_STATUSES:
+                raise QuotaExceeded('%s: %s' % (status, response.get('error_message', '')))
+            # A page token is answered INVALID_REQUEST until it becomes valid
+            if status in RETRY_STATUSES or (status == 'INVALID_REQUEST' and 'pagetoken' in params):
+                error = status
+                continue
+            if status in ('OK', 'ZERO_RESULTS'):
+                self.cache.put(endpoint, params, response)
+                return response
+            if endpoint == DETAILS_ENDPOINT and status in SKIP_STATUSES:
+                return response
+            raise PlacesAPIError('%s: %s %s' % (endpoint, status, response.get('error_message', '')))
+        raise PlacesAPIError('%s failed after %d attempts: %s' % (endpoint, self.max_retries + 1, error))
+
+    async def search_cell(self, lat, lon, radius, types):
+        """ Return the list of the place_ids found by the search of a cell (all the pages of results) """
+        params = {'location' : '%s,%s' % (lat, lon), 'radius' : radius, 'types' : types}
+        place_ids = []
+        delay = 0.
+        while True:
+            response = await self.request(SEARCH_ENDPOINT, params, delay)
+            place_ids.extend(result['place_id'] for result in response.get('results', []))
+            if not response.get('next_page_token'):
+                return list(dict.fromkeys(place_ids))
+            params = {'pagetoken' : response['next_page_token']}
+            delay = self.page_delay
+
+    async def details(self, place_id):
+        """ Return the details of a place. A place found by several cells searched at the same time is requested once """
+        if place_id not in self.details_tasks:
+            self.details_tasks[place_id] = asyncio.ensure_future(self.request(DETAILS_ENDPOINT, {'placeid' : place_id}))
+        response = await asyncio.shield(self.details_tasks[place_id])
+        return response.get('result')
+
+    async def process_cell(self, prefix, lat, lon, radius, types):
+        """ Search a cell, get the details of its places, write its csv files and add it to the checkpoint file. Return the number of places """
+        name = cell_name(lat, lon, radius)
+        place_ids = await self.search_cell(lat, lon, radius, types)
+        results = await asyncio.gather(*[self.details(place_id) for place_id in place_ids])
+        date_retrieved = time.strftime('%Y-%m-%d %H:%M:%S')
+        tables = {'places' : [], 'reviews' : [], 'metadata' : [], 'types' : []}
+        for place_id, result in zip(place_ids, results):
+            if result:
+                place, reviews, metadata, types_rows = place_rows(place_id, result, date_retrieved)
+                tables['places'].append(place)
+                tables['reviews'].extend(reviews)
+                tables['metadata'].append(metadata)
+                tables['types'].extend(types_rows)
+        for table, rows in tables.items():
+            if rows:
+                write_table(os.path.join(self.out_dir, prefix + table.upper() + '_' + name + '.csv'), rows, FIELDNAMES[table])
+        with open(self.checkpoint_fpath, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'prefix' : prefix, 'cell' : name, 'places' : len(tables['places']), 'results' : len(place_ids)}) + '\n')
+        print('%s %s: %d places found' % (prefix, name, len(tables['places'])))
+        return len(tables['places'])
+
+    async def run_async(self, cells):
+        """ See run """
+        os.makedirs(self.out_dir, exist_ok=True)
+        # The semaphore and the lock of the token bucket belong to the event loop of this run
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.bucket.reset()
+        self.details_tasks = {}
+        done = self.done_cells()
+        queue = asyncio.Queue()
+        skipped = 0
+        for prefix, lat, lon, radius, types in cells:
+            if (prefix, cell_name(lat, lon, radius)) in done:
+                skipped += 1
+            else:
+                queue.put_nowait((prefix, lat, lon, radius, types))
+        total = {'cells' : 0, 'places' : 0, 'skipped' : skipped}
+
+        async def worker():
+            while not queue.empty():
+                cell = queue.get_nowait()
+                places = await self.process_cell(*cell)
+                total['places'] += places
+                total['cells'] += 1
+
+        # A cell searches then gets its details: enough workers to keep `concurrency` requests in flight
+        workers = [asyncio.ensure_future(worker()) for i in range(min(self.concurrency, queue.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return total
+
+    def run(self, cells):
+        """
+        Search cells, a list of (prefix, lat, lon, radius, types), skipping the cells of the checkpoint file.
+        The csv files of a cell are written in out_dir as prefix + 'PLACES_' + cell_name + '.csv', etc.
+        Return {'cells': cells searched, 'places': places found, 'skipped': cells already done}. Raise QuotaExceeded if the quota is reached
+        """
+        return asyncio.run(self.run_async(cells))
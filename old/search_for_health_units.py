@@ -1,6 +1,8 @@
-import utilFunctions as uf
 import numpy as np
 import os, sys
+import argparse
+import placesearch
+import searchplan
 
 FDIR = os.path.dirname(os.path.realpath(__file__))  
 
@@ -23,12 +25,10 @@ NIC_BOUNDBOXES = [[ (15.03, -83.13), (13.87, -84.93) ],   # 0 [Northheast corner
                   [ (14.10, -85.70), (12.67, -86.60) ],   # 10
                   [ (13.87, -86.60), (12.67, -87.70) ] ]  # 11
                 
-# For each bounding box, we divide the area into smaller squares, their sides are 5-km long. For each square, we do a radar search centered at the square's center and with search radius of 5/2 *sqrt(2) = 4 km. For each bounding box, create a log file: log_BB{0:9}.txt that reports how many places found in each square. Each square's search results in 4 lists: place, reviews, metadata, and types tables; each of them is written as a csv table with a filename like this: PLACES_LON-86.3675_LAT+11.6550_RAD4000m. Lon, Lat in the filename denotes the centre of the search. Note: Just keep in mind that Google accommodates up to 1000 queries per day, after that the query may fail (returning no place). 
-bb_num = 11         
-boundbox = NIC_BOUNDBOXES[bb_num]
-log_txt = os.path.join(FDIR, "google_data/" + 'log_BB%s' % bb_num + '.txt')
-with open(log_txt, 'w', newline='') as txt_log:
-    txt_log.write('Logging place search for Bound Box %s: \n' %bb_num)
+# For each bounding box, we divide the area into smaller squares, their sides are 5-km long. For each square, we do a radar search centered at the square's center and with search radius of 5/2 *sqrt(2) = 4 km. Each square's search results in 4 lists: place, reviews, metadata, and types tables; each of them is written as a csv table with a filename like this: BB0PLACES_LON-86.3675_LAT+11.6550_RAD4000m. Lon, Lat in the filename denotes the centre of the search. Note: Just keep in mind that Google accommodates up to 1000 queries per day, after that the query may fail (returning no place). The searched squares are listed in google_data/checkpoint.jsonl, so that a search stopped by the quota resumes where it stopped the next day (see placesearch.py).
+def grid_cells(bb_num):
+    """ Return the list of the (lat, lon) of the centres of the squares of bounding box bb_num """
+    boundbox = NIC_BOUNDBOXES[bb_num]
     # Construct search grids
     left_lon, right_lon = boundbox[1][1], boundbox[0][1]
     top_lat, bottom_lat = boundbox[0][0], boundbox[1][0]  
@@ -37,72 +37,68 @@ with open(log_txt, 'w', newline='') as txt_log:
     lon_grids = np.linspace(left_lon, right_lon, ngrid_lon)
     lat_grids = np.linspace(top_lat, bottom_lat, ngrid_lat)
 
-    prev_lon, prev_lat = lon_grids[0], lat_grids[0]
+    cells = []
+    prev_lon = lon_grids[0]
     for lon in lon_grids[1:]:
         ctr_lon = prev_lon + (lon - prev_lon) / 2.0
+        prev_lat = lat_grids[0]
         for lat in lat_grids[1:]:
             ctr_lat = prev_lat + (lat - prev_lat) / 2.0
-            
-            print('\nSearching for places at lon: %s' %ctr_lon + ', lat:%s ...' % ctr_lat)
-            txt_log.write('\nSearching for places at lon: %s' %ctr_lon + ', lat:%s ...' % ctr_lat) 
-            
-            search_params = {'location' : '%s' %ctr_lat + ',' + '%s' % ctr_lon, 
-              'radius' : SEARCH_RADIUS, \
-              'types' : SEARCH_TYPES}
-            
-            places, reviews, metadata, types = uf.search_details_reviews(search_params, API_KEY)
-            
-            if places:   
-                print('%s' %len(places) + ' places found. Writing to files...\n')
-                txt_log.write('%s' %len(places) + ' places found. Writing to files...\n')
-                outfile_places = os.path.join(FDIR, "google_data/" + \
-                                        'BB%s' % bb_num + 'PLACES_' + \
-                                        'LON%+03.4f_' %ctr_lon + \
-                                        'LAT%+03.4f_' %ctr_lat + 
-                                        'RAD%sm' %SEARCH_RADIUS + '.csv')
-                                        
-                with open(outfile_places, 'w', newline='', encoding='utf-8') as csv_places:
-                    fieldnames = uf.get_fieldnames('places')
-                    uf.dictlist2csv(places, csv_places, fieldnames)
-            else:
-                txt_log.write('0 places found. \n')
-                    
-            if reviews:            
-                outfile_reviews = os.path.join(FDIR, "google_data/" + \
-                                        'BB%s' % bb_num + 'REVIEWS_' + \
-                                        'LON%+03.4f_' %ctr_lon + \
-                                        'LAT%+03.4f_' %ctr_lat + 'RAD%sm' %SEARCH_RADIUS + '.csv')
-                                        
-                with open(outfile_reviews, 'w', newline='', encoding='utf-8') as csv_reviews:
-                    fieldnames = uf.get_fieldnames('reviews')
-                    uf.dictlist2csv(reviews, csv_reviews, fieldnames)
-                    
-            if metadata:            
-                outfile_metadata = os.path.join(FDIR, "google_data/" + \
-                                        'BB%s' % bb_num + 'METADATA_' + \
-                                        'LON%+03.4f_' %ctr_lon + \
-                                        'LAT%+03.4f_' %ctr_lat + 'RAD%sm' %SEARCH_RADIUS + '.csv')
-                                        
-                with open(outfile_metadata, 'w', newline='', encoding='utf-8') as csv_metadata:
-                    fieldnames = uf.get_fieldnames('metadata')
-                    uf.dictlist2csv(metadata, csv_metadata, fieldnames)
-                    
-            if types:            
-                outfile_types = os.path.join(FDIR, "google_data/" + \
-                                        'BB%s' % bb_num + 'TYPES_' + \
-                                        'LON%+03.4f_' %ctr_lon + \
-                                        'LAT%+03.4f_' %ctr_lat + 'RAD%sm' %SEARCH_RADIUS + '.csv')
-                                        
-                with open(outfile_types, 'w', newline='', encoding='utf-8') as csv_types:
-                    fieldnames = uf.get_fieldnames('types')
-                    uf.dictlist2csv(types, csv_types, fieldnames)
-            
+            cells.append((ctr_lat, ctr_lon))
             prev_lat = lat
         prev_lon = lon
-                    
-                
-            
-            
-            
-            
-           
+    return cells
+
+def main(bb_nums=None, concurrency=8, rate=10., base_url=placesearch.BASE_URL, out_dir=None, adaptive=False, dry_run=False, scale=1.):
+    """
+    Search the squares of the bounding boxes bb_nums (default: all) with the Places API at base_url, with at most concurrency
+    requests in flight and rate requests per second. The csv files are written in out_dir (default: google_data next to this script).
+    adaptive: search the cells of the quadtree of searchplan.py instead of the squares
+    dry_run: only print the number of searches, and for the quadtree an estimate of the requests from the known places
+    (searchplan.known_places), each counting as scale places
+    """
+    if bb_nums is None:
+        bb_nums = range(len(NIC_BOUNDBOXES))
+    out_dir = out_dir or os.path.join(FDIR, "google_data")
+    cells = [('BB%s' % bb_num, lat, lon, SEARCH_RADIUS, SEARCH_TYPES) for bb_num in bb_nums for lat, lon in grid_cells(bb_num)]
+    if adaptive:
+        country = searchplan.Country.from_gadm()
+        if country is None:
+            print('NIC_adm1 not found in %s: cells outside the country are searched too' % searchplan.GADM_DIR)
+        planner = searchplan.SearchPlanner(NIC_BOUNDBOXES, country, bb_nums)
+    if dry_run:
+        print('Fixed grid: %d squares, at least %d requests' % (len(cells), len(cells)))
+        if adaptive:
+            lat, lon = searchplan.known_places(google_dir=out_dir)
+            counts = planner.dry_run(lat, lon, scale)
+            print('Quadtree (%d known places x %g): %%(cells)d cells in %%(levels)d levels, %%(skipped)d cells outside the country, '
+                  '%%(saturated)d cells at the cap\n%%(search_requests)d search requests + %%(details_requests)d details requests = '
+                  '%%(requests)d requests' % (len(lat), scale) % counts)
+        return
+    searcher = placesearch.PlacesSearcher(API_KEY, out_dir, concurrency, rate, base_url)
+    try:
+        if adaptive:
+            total = planner.run(searcher, SEARCH_TYPES)
+            print('%(cells)d cells searched, %(places)d places found, %(skipped)d cells already done, %(outside)d cells outside '
+                  'the country, %(saturated)d cells at the cap' % total)
+        else:
+            total = searcher.run(cells)
+            print('%(cells)d squares searched, %(places)d places found, %(skipped)d squares already done' % total)
+    except placesearch.QuotaExceeded as e:
+        print('Quota exceeded (%s). Run again to resume the search.' % e)
+    except placesearch.PlacesAPIError as e:
+        print('Search stopped (%s). Run again to resume the search.' % e)
+    print('%(requests)d requests, %(cached)d cached responses, %(retries)d retries' % searcher.counts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search for health units with the Google Places API')
+    parser.add_argument('--bb', type=int, nargs='+', help='numbers of the bounding boxes to search (default: all)')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of requests in flight')
+    parser.add_argument('--rate', type=float, default=10., help='maximum number of requests per second')
+    parser.add_argument('--base-url', default=placesearch.BASE_URL, help='address of the Places API, e.g. http://localhost:8000/ for a stub server')
+    parser.add_argument('--out-dir', help='folder of the csv files (default: google_data next to this script)')
+    parser.add_argument('--adaptive', action='store_true', help='search coarse cells, divided where the results reach the cap (see searchplan.py)')
+    parser.add_argument('--dry-run', action='store_true', help='only count the searches (and estimate the requests of --adaptive)')
+    parser.add_argument('--scale', type=float, default=1., help='places expected per known place in the estimate of --dry-run --adaptive')
+    args = parser.parse_args()
+    main(args.bb, args.concurrency, args.rate, args.base_url, args.out_dir, args.adaptive, args.dry_run, args.scale)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive quadtree plan of the searches of search_for_health_units.py, to cover the country with fewer Places API requests
+than the fixed grid of 5-km squares.
+
+A nearby search returns at most RESULT_CAP places (3 pages of 20), so a fixed grid has to be fine enough for the densest
+areas (Managua) and spends most of the daily quota on empty cells elsewhere. Here each bounding box is first divided into
+coarse cells of about COARSE_SIZE degrees, each searched with the radius of the circle around it. A cell whose search
+reaches the cap is divided into four cells, searched in turn, down to cells of MIN_SIZE degrees. Cells that do not
+intersect the country (the departments of the GADM shapefile NIC_adm1, e.g. cells of the Caribbean sea) are not searched.
+The searches are run level by level with placesearch.PlacesSearcher. The number of results of each cell is kept in its
+checkpoint file, so that a resumed search divides the same cells without searching them again.
+A dry run sends no request: the results of each search are estimated by the known places inside its circle (the health
+facilities of osm_db/osm_places.csv and the places already downloaded in google_data), and the requests are counted.
+Example:
+  planner = SearchPlanner(NIC_BOUNDBOXES, Country.from_gadm())
+  counts = planner.dry_run(*known_places())     # {'cells': ..., 'search_requests': ..., 'details_requests': ..., ...}
+  planner.run(searcher, SEARCH_TYPES)           # searcher: placesearch.PlacesSearcher
+"""
+
+import os
+import csv
+import math
+import fnmatch
+import asyncio
+import numpy as np
+import shapefile
+
+import placesearch
+
+FDIR = os.path.dirname(os.path.realpath(__file__))
+GADM_DIR = os.path.join(os.path.dirname(FDIR), "plots", "data", "NIC_adm")
+OSM_PLACES_FPATH = os.path.join(os.path.dirname(FDIR), "osm_db", "osm_places.csv")
+GOOGLE_DIR = os.path.join(FDIR, "google_data")
+# Maximum number of places returned by a search, and per page of results
+RESULT_CAP = 60
+PAGE_SIZE = 20
+# Side of the coarse cells and of the smallest cells, in degrees (5 levels of division)
+COARSE_SIZE = 0.4
+MIN_SIZE = 0.0125
+# Maximum radius of a search, in m
+MAX_RADIUS = 50000
+KM_PER_DEGREE = 111.32
+
+def cell_center(cell):
+    """ Return the (lat, lon) of the centre of a cell (prefix, min lat, min lon, max lat, max lon) """
+    prefix, min_lat, min_lon, max_lat, max_lon = cell
+    return (min_lat + max_lat) / 2., (min_lon + max_lon) / 2.
+
+def cell_radius(cell):
+    """ Return the radius in m of the circle around a cell (taking the width of the cell at its southern edge, the widest) """
+    prefix, min_lat, min_lon, max_lat, max_lon = cell
+    height = (max_lat - min_lat) * KM_PER_DEGREE
+    width = (max_lon - min_lon) * KM_PER_DEGREE * math.cos(math.radians(min_lat))
+    return min(int(math.ceil(500 * math.hypot(height, width))), MAX_RADIUS)
+
+def split_cell(cell):
+    """ Return the four quarters of a cell """
+    prefix, min_lat, min_lon, max_lat, max_lon = cell
+    lat, lon = cell_center(cell)
+    return [(prefix, min_lat, min_lon, lat, lon), (prefix, min_lat, lon, lat, max_lon),
+            (prefix, lat, min_lon, max_lat, lon), (prefix, lat, lon, max_lat, max_lon)]
+
+def coarse_cells(prefix, boundbox, size=COARSE_SIZE):
+    """ Return the cells of at most size degrees dividing a bounding box [(NE lat, NE lon), (SW lat, SW lon)] """
+    (top_lat, right_lon), (bottom_lat, left_lon) = boundbox
+    nlat = max(1, int(math.ceil((top_lat - bottom_lat) / size - 1e-9)))
+    nlon = max(1, int(math.ceil((right_lon - left_lon) / size - 1e-9)))
+    lats = np.linspace(bottom_lat, top_lat, nlat + 1)
+    lons = np.linspace(left_lon, right_lon, nlon + 1)
+    return [(prefix, lats[i], lons[j], lats[i + 1], lons[j + 1]) for i in range(nlat) for j in range(nlon)]
+
+def in_circle(cell, lat, lon):
+    """ Return the boolean array telling which points (lat, lon arrays) are inside the search circle of a cell """
+    center_lat, center_lon = cell_center(cell)
+    dy = (lat - center_lat) * KM_PER_DEGREE
+    dx = (lon - center_lon) * KM_PER_DEGREE * math.cos(math.radians(center_lat))
+    return dx * dx + dy * dy <= (cell_radius(cell) / 1000.) ** 2
+
+def known_places(osm_fpath=OSM_PLACES_FPATH, google_dir=GOOGLE_DIR):
+    """ Return the lat and lon arrays of the health facilities of osm_fpath and of the places of the PLACES csv files of google_dir (if they exist) """
+    lat, lon = [], []
+    if os.path.exists(osm_fpath):
+        with open(osm_fpath, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if row['type'] == 'health' and row['lat'] and row['lon']:
+                    lat.append(float(row['lat']))
+                    lon.append(float(row['lon']))
+    if os.path.isdir(google_dir):
+        for filename in fnmatch.filter(os.listdir(google_dir), 'BB*PLACES_*.csv'):
+            with open(os.path.join(google_dir, filename), newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f, delimiter=';'):
+                    if row['lat'] and row['lng']:
+                        lat.append(float(row['lat']))
+                        lon.append(float(row['lng']))
+    return np.array(lat, dtype=np.float64), np.array(lon, dtype=np.float64)
+
+class Country(object):
+    """
+    The polygons of a shapefile (by default the departments of NIC_adm1), to test which cells intersect the country.
+    fpath: shapefile path without extension
+    """
+    def __init__(self, fpath):
+        r = shapefile.Reader(fpath)
+        self.edges = []
+        bboxes = []
+        for shape in r.shapes():
+            if not shape.points:
+                continue
+            points = np.array(shape.points, dtype=np.float64)
+            # Edges of each part (ring), as in osm_db/adminareas.py
+            starts = list(shape.parts) + [len(points)]
+            rings = [points[start:end] for start, end in zip(starts[:-1], starts[1:]) if end - start >= 3]
+            if not rings:
+                continue
+            x1, y1 = np.concatenate([ring[:, 0] for ring in rings]), np.concatenate([ring[:, 1] for ring in rings])
+            x2 = np.concatenate([np.roll(ring[:, 0], -1) for ring in rings])
+            y2 = np.concatenate([np.roll(ring[:, 1], -1) for ring in rings])
+            self.edges.append((x1, y1, x2, y2))
+            bboxes.append((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+        r.close()
+        self.bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_gadm(cls, gadm_dir=GADM_DIR):
+        """ Load NIC_adm1 from gadm_dir (default: plots/data/NIC_adm). Return None if it is missing """
+        fpath = os.path.join(gadm_dir, "NIC_adm1")
+        if not os.path.exists(fpath + '.shp'):
+            return None
+        return cls(fpath)
+
+    def intersects(self, min_lat, min_lon, max_lat, max_lon):
+        """ Return True if the box intersects a polygon: an edge of the polygon crosses the box, or the box is inside the polygon """
+        corners = np.array([(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)])
+        for (x1, y1, x2, y2), (xmin, ymin, xmax, ymax) in zip(self.edges, self.bboxes):
+            if xmax < min_lon or xmin > max_lon or ymax < min_lat or ymin > max_lat:
+                continue
+            # Edges whose bounding box overlaps the box cross it unless the 4 corners are strictly on the same side of their line
+            near = ((np.maximum(x1, x2) >= min_lon) & (np.minimum(x1, x2) <= max_lon) &
+                    (np.maximum(y1, y2) >= min_lat) & (np.minimum(y1, y2) <= max_lat))
+            if near.any():
+                ax, ay, bx, by = x1[near], y1[near], x2[near], y2[near]
+                sides = (bx - ax) * (corners[:, 1, None] - ay) - (by - ay) * (corners[:, 0, None] - ax)
+                if ((sides.min(axis=0) <= 0) & (sides.max(axis=0) >= 0)).any():
+                    return True
+            # No edge crosses the box: it is inside the polygon if one of its points is (crossing number test, even-odd rule)
+            px, py = corners[0]
+            crosses = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            if np.logical_xor.reduce(crosses & (px < x_cross)):
+                return True
+        return False
+
+class SearchPlanner(object):
+    """
+    boundboxes: list of [(NE lat, NE lon), (SW lat, SW lon)] (see search_for_health_units.NIC_BOUNDBOXES); the cells of
+    boundbox i get the prefix 'BB<i>' of its csv files. country: Country whose cells are searched, or None to search all the cells
+    """
+    def __init__(self, boundboxes, country=None, bb_nums=None, coarse_size=COARSE_SIZE, min_size=MIN_SIZE):
+        self.boundboxes = boundboxes
+        self.country = country
+        self.bb_nums = range(len(boundboxes)) if bb_nums is None else bb_nums
+        self.coarse_size = coarse_size
+        self.min_size = min_size
+
+    def inside_cells(self, cells, counts):
+        """ Return the cells intersecting the country, counting the others in counts['skipped'] """
+        if self.country is None:
+            return cells
+        inside = [cell for cell in cells if self.country.intersects(*cell[1:])]
+        counts['skipped'] += len(cells) - len(inside)
+        return inside
+
+    def first_cells(self, counts):
+        """ Return the coarse cells of the bounding boxes intersecting the country """
+        cells = [cell for bb_num in self.bb_nums for cell in coarse_cells('BB%s' % bb_num, self.boundboxes[bb_num], self.coarse_size)]
+        return self.inside_cells(cells, counts)
+
+    def next_cells(self, cell, results, counts):
+        """ Return the quarters of a cell (intersecting the country) if its search reached the cap, counting the cells too small to divide """
+        if results < RESULT_CAP:
+            return []
+        if cell[3] - cell[1] <= self.min_size * 1.001:     # (cells of min_size degrees, up to rounding)
+            counts['saturated'] += 1
+            return []
+        return self.inside_cells(split_cell(cell), counts)
+
+    def dry_run(self, lat, lon, scale=1.):
+        """
+        Plan the searches without sending requests, estimating the results of a search by scale x the number of known places
+        (lat, lon arrays, see known_places) inside its circle. Return {'cells': searches, 'levels', 'skipped': cells outside
+        the country, 'saturated': cells at the cap but too small to divide, 'search_requests': pages of results,
+        'details_requests': places found, 'requests': all the requests}
+        """
+        counts = {'cells' : 0, 'levels' : 0, 'skipped' : 0, 'saturated' : 0, 'search_requests' : 0}
+        found = np.zeros(len(lat), dtype=bool)
+        cells = self.first_cells(counts)
+        while cells:
+            counts['levels'] += 1
+            next_level = []
+            for cell in cells:
+                inside = in_circle(cell, lat, lon)
+                found |= inside
+                results = int(round(scale * np.count_nonzero(inside)))
+                counts['cells'] += 1
+                counts['search_requests'] += max(1, int(math.ceil(min(results, RESULT_CAP) / float(PAGE_SIZE))))
+                next_level.extend(self.next_cells(cell, results, counts))
+            cells = next_level
+        counts['details_requests'] = int(round(scale * np.count_nonzero(found)))
+        counts['requests'] = counts['search_requests'] + counts['details_requests']
+        return counts
+
+    async def run_async(self, searcher, types):
+        """ See run """
+        counts = {'skipped' : 0, 'saturated' : 0}
+        total = {'cells' : 0, 'places' : 0, 'skipped' : 0}
+        cells = self.first_cells(counts)
+        level = 0
+        while cells:
+            level += 1
+            searches = [(cell[0], ) + cell_center(cell) + (str(cell_radius(cell)), types) for cell in cells]
+            print('Level %d: %d cells' % (level, len(cells)))
+            for key, value in (await searcher.run_async(searches)).items():
+                total[key] += value
+            checkpoint = searcher.checkpoint()
+            next_level = []
+            for cell, (prefix, lat, lon, radius, types) in zip(cells, searches):
+                results = checkpoint[prefix, placesearch.cell_name(lat, lon, radius)]['results']
+                next_level.extend(self.next_cells(cell, results, counts))
+            cells = next_level
+        total['outside'], total['saturated'] = counts['skipped'], counts['saturated']
+        return total
+
+    def run(self, searcher, types):
+        """
+        Search the cells level by level with searcher (placesearch.PlacesSearcher), for places of types, skipping the cells
+        already in its checkpoint file. All the levels are searched in one event loop. Return {'cells': cells searched,
+        'places': places found, 'skipped': cells already done, 'outside': cells outside the country, 'saturated': cells at
+        the cap but too small to divide}. Raise placesearch.QuotaExceeded if the quota is reached
+        """
+        return asyncio.run(self.run_async(searcher, types))
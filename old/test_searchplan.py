@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the adaptive search of searchplan.py against a local stub of the Places API, with a throttling rate limit.
+Run `python -m unittest test_searchplan` in this folder.
+"""
+
+import json
+import math
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import placesearch
+import searchplan
+
+# Bounding box of a single coarse cell, and a grid of places over it: more than the cap in the cell, less in each of its quarters
+BOUNDBOXES = [[ (12.4, -86.0), (12.0, -86.4) ]]
+PLACES = [(12.02 + 0.04 * (i % 10), -86.37 + 0.057 * (i // 10)) for i in range(70)]
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Nearby search (by distance, pages of 20 results, at most 60) and details of the places of PLACES """
+    pages = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.endswith(placesearch.SEARCH_ENDPOINT):
+            if 'pagetoken' in params:
+                ids, start = self.pages[params['pagetoken']]
+            else:
+                lat, lon = map(float, params['location'].split(','))
+                radius = float(params['radius']) / 1000.
+                distances = [(math.hypot((plat - lat) * searchplan.KM_PER_DEGREE,
+                                         (plon - lon) * searchplan.KM_PER_DEGREE * math.cos(math.radians(lat))), i)
+                             for i, (plat, plon) in enumerate(PLACES)]
+                ids, start = [i for distance, i in sorted(distances) if distance <= radius][:searchplan.RESULT_CAP], 0
+            body = {'status' : 'OK' if ids else 'ZERO_RESULTS', 'results' : [{'place_id' : 'p%d' % i} for i in ids[start:start + 20]]}
+            if start + 20 < len(ids):
+                with self.lock:
+                    token = 't%d' % len(self.pages)
+                    self.pages[token] = (ids, start + 20)
+                body['next_page_token'] = token
+        else:
+            i = int(params['placeid'][1:])
+            body = {'status' : 'OK', 'result' : {'name' : 'Place %d' % i, 'geometry' : {'location' : {'lat' : PLACES[i][0], 'lng' : PLACES[i][1]}}}}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class AdaptiveSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.out_dir)
+
+    def searcher(self):
+        # A rate of 20 requests per second makes the token bucket wait at each level
+        return placesearch.PlacesSearcher('KEY', self.out_dir, concurrency=4, rate=20., base_url='http://127.0.0.1:%d/' % self.server.server_address[1],
+                                          retry_delay=0.01, page_delay=0.01)
+
+    def test_two_levels(self):
+        planner = searchplan.SearchPlanner(BOUNDBOXES)
+        searcher = self.searcher()
+        total = planner.run(searcher, 'health')
+        self.assertEqual(total['cells'], 5)
+        self.assertEqual(total['skipped'], 0)
+        counts = planner.dry_run(*np.array(PLACES).T)
+        self.assertEqual(counts['levels'], 2)
+        self.assertEqual(searcher.counts['requests'], counts['requests'])
+
+        # A resumed search divides the same cells without sending requests
+        searcher = self.searcher()
+        total = planner.run(searcher, 'health')
+        self.assertEqual((total['cells'], total['skipped']), (0, 5))
+        self.assertEqual(searcher.counts['requests'], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Assign the municipality and department of places from their coordinates, with the GADM administrative boundaries
+(NIC_adm1: departments, NIC_adm2: municipalities; the shapefiles drawn by plots/NICmap.py).
+
+The polygons are registered in a grid of their bounding boxes. Points are first matched to the polygons whose
+bounding box contains them, then tested against each candidate polygon with a vectorized crossing number test
+(even-odd rule, so that holes such as lakes are handled).
+Example:
+  areas = AdminAreas.from_gadm()
+  areas.assign(places)      # fills places[i]['municipality'], places[i]['department'] and places[i]['gadm_code']
+"""
+
+import os
+import numpy as np
+import shapefile
+
+GADM_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "plots", "data", "NIC_adm")
+# Number of grid cells along each axis
+GRID_SIZE = 64
+# Maximum number of (point, edge) pairs tested at once
+MAX_PAIRS = 1 << 22
+
+def record_field(reader, name, default_index):
+    """ Return the index of field name in the records of a shapefile.Reader, or default_index if there is no such field """
+    names = [field[0] for field in reader.fields[1:]]   # the first field is the deletion flag
+    return names.index(name) if name in names else default_index
+
+class PolygonLayer(object):
+    """
+    The polygons of a shapefile and a grid index of their bounding boxes.
+    fpath: shapefile path without extension
+    name_fields: [(field name, default index), ...] of the record fields kept for each polygon (see values)
+    """
+    def __init__(self, fpath, name_fields):
+        r = shapefile.Reader(fpath)
+        indexes = [record_field(r, name, default_index) for name, default_index in name_fields]
+        self.values = []
+        self.edges = []
+        bboxes = []
+        for record, shape in zip(r.records(), r.shapes()):
+            if not shape.points:
+                continue
+            points = np.array(shape.points, dtype=np.float64)
+            # Edges of each part (ring), without the edge between the last point of a part and the first one of the next
+            starts = list(shape.parts) + [len(points)]
+            x1, y1, x2, y2 = [], [], [], []
+            for start, end in zip(starts[:-1], starts[1:]):
+                ring = points[start:end]
+                if len(ring) < 3:
+                    continue
+                nxt = np.roll(ring, -1, axis=0)
+                x1.append(ring[:, 0]); y1.append(ring[:, 1]); x2.append(nxt[:, 0]); y2.append(nxt[:, 1])
+            if not x1:
+                continue
+            self.edges.append(tuple(np.concatenate(c) for c in (x1, y1, x2, y2)))
+            self.values.append(tuple(record[i] for i in indexes))
+            bboxes.append((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+        self.bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.build_grid()
+
+    def __len__(self):
+        return len(self.values)
+
+    def build_grid(self):
+        """ Register each polygon in the cells of a GRID_SIZE x GRID_SIZE grid overlapping its bounding box """
+        if not len(self):
+            self.x0, self.y0, self.dx, self.dy = 0.0, 0.0, 1.0, 1.0
+            self.cell_start = np.zeros(GRID_SIZE * GRID_SIZE + 1, dtype=np.int64)
+            self.cell_polygons = np.zeros(0, dtype=np.int64)
+            return
+        self.x0, self.y0 = self.bboxes[:, 0].min(), self.bboxes[:, 1].min()
+        self.dx = max((self.bboxes[:, 2].max() - self.x0) / GRID_SIZE, 1e-12)
+        self.dy = max((self.bboxes[:, 3].max() - self.y0) / GRID_SIZE, 1e-12)
+        cells, polygons = [], []
+        for polygon, (xmin, ymin, xmax, ymax) in enumerate(self.bboxes):
+            cx = np.arange(self.cell_x(xmin), self.cell_x(xmax) + 1)
+            cy = np.arange(self.cell_y(ymin), self.cell_y(ymax) + 1)
+            polygon_cells = (cy[:, None] * GRID_SIZE + cx[None, :]).ravel()
+            cells.append(polygon_cells)
+            polygons.append(np.full(len(polygon_cells), polygon))
+        cells, polygons = np.concatenate(cells), np.concatenate(polygons)
+        order = np.argsort(cells, kind='stable')
+        self.cell_polygons = polygons[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(GRID_SIZE * GRID_SIZE + 1))
+
+    def cell_x(self, x):
+        return np.clip(np.floor((np.asarray(x) - self.x0) / self.dx), 0, GRID_SIZE - 1).astype(np.int64)
+
+    def cell_y(self, y):
+        return np.clip(np.floor((np.asarray(y) - self.y0) / self.dy), 0, GRID_SIZE - 1).astype(np.int64)
+
+    def candidates(self, x, y):
+        """ Return the pairs (point, polygon) such that the bounding box of the polygon contains the point """
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        cells = self.cell_y(y[valid]) * GRID_SIZE + self.cell_x(x[valid])
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+        points = np.repeat(valid, counts)
+        if not len(points):
+            return points, points
+        ends = np.cumsum(counts)
+        polygons = self.cell_polygons[np.arange(ends[-1]) + np.repeat(starts - (ends - counts), counts)]
+        bbox = self.bboxes[polygons]
+        inside = (x[points] >= bbox[:, 0]) & (x[points] <= bbox[:, 2]) & (y[points] >= bbox[:, 1]) & (y[points] <= bbox[:, 3])
+        return points[inside], polygons[inside]
+
+    def contains(self, polygon, x, y):
+        """ Return the boolean array telling which points (x, y) are inside polygon """
+        x1, y1, x2, y2 = self.edges[polygon]
+        inside = np.zeros(len(x), dtype=bool)
+        step = max(1, MAX_PAIRS // len(x1))
+        for start in range(0, len(x), step):
+            px = x[start:start + step, None]
+            py = y[start:start + step, None]
+            crosses = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside[start:start + step] = np.logical_xor.reduce(crosses & (px < x_cross), axis=1)
+        return inside
+
+    def rasterize(self, extent, shape):
+        """
+        Return the (rows, columns) array of the index of the polygon containing the centre of each cell of a grid
+        covering extent = (x min, x max, y min, y max), row 0 at y min, or -1. Polygons are filled row by row between the
+        crossings of their edges with the row (same even-odd rule as contains), in time linear in the number of crossings and cells.
+        As in locate, a cell inside several polygons gets the first one.
+        """
+        rows, cols = shape
+        xmin, xmax, ymin, ymax = extent
+        dx, dy = (xmax - xmin) / cols, (ymax - ymin) / rows
+        raster = np.full((rows, cols), -1, dtype=np.int64)
+        for polygon, (x1, y1, x2, y2) in enumerate(self.edges):
+            # Rows whose centre may be crossed by each edge (one more row on each side against rounding), then the exact test
+            first = np.clip(np.ceil((np.minimum(y1, y2) - ymin) / dy - 0.5) - 1, 0, rows).astype(np.int64)
+            last = np.clip(np.ceil((np.maximum(y1, y2) - ymin) / dy - 0.5) + 1, 0, rows).astype(np.int64)
+            counts = np.maximum(last - first, 0)
+            edges = np.repeat(np.arange(len(x1)), counts)
+            row = np.arange(counts.sum()) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+            yc = ymin + (row + 0.5) * dy
+            crosses = (y1[edges] > yc) != (y2[edges] > yc)
+            edges, row, yc = edges[crosses], row[crosses], yc[crosses]
+            if not len(row):
+                continue
+            # Crossings computed from the lower end of the edges, so that an edge shared by two polygons crosses rows at the same x in both
+            up = y1[edges] < y2[edges]
+            xa, ya = np.where(up, x1[edges], x2[edges]), np.where(up, y1[edges], y2[edges])
+            xb, yb = np.where(up, x2[edges], x1[edges]), np.where(up, y2[edges], y1[edges])
+            xc = xa + (yc - ya) * (xb - xa) / (yb - ya)
+            # Each row is crossed an even number of times: the cells between crossings 2k and 2k + 1 are inside
+            order = np.lexsort((xc, row))
+            row, xc = row[order][0::2], xc[order]
+            start = np.clip(np.ceil((xc[0::2] - xmin) / dx - 0.5), 0, cols).astype(np.int64)
+            end = np.clip(np.ceil((xc[1::2] - xmin) / dx - 0.5), 0, cols).astype(np.int64)
+            # +1 at the first cell of each span and -1 after its last cell, summed along the rows of the bounding box of the spans
+            r0, c0 = row.min(), start.min()
+            diff = np.zeros((row.max() - r0 + 1, end.max() - c0 + 1), dtype=np.int32)
+            np.add.at(diff, (row - r0, start - c0), 1)
+            np.add.at(diff, (row - r0, end - c0), -1)
+            inside = np.cumsum(diff, axis=1)[:, :-1] > 0
+            window = raster[r0:r0 + inside.shape[0], c0:c0 + inside.shape[1]]
+            window[inside & (window < 0)] = polygon
+        return raster
+
+    def locate(self, lon, lat):
+        """ Return, for each point, the index of the polygon containing it, or -1 """
+        x = np.asarray(lon, dtype=np.float64)
+        y = np.asarray(lat, dtype=np.float64)
+        found = np.full(len(x), -1, dtype=np.int64)
+        points, polygons = self.candidates(x, y)
+        order = np.argsort(polygons, kind='stable')
+        points, polygons = points[order], polygons[order]
+        bounds = np.searchsorted(polygons, np.arange(len(self) + 1))
+        for polygon in np.flatnonzero(np.diff(bounds)):
+            group = points[bounds[polygon]:bounds[polygon + 1]]
+            group = group[found[group] < 0]
+            if len(group):
+                found[group[self.contains(polygon, x[group], y[group])]] = polygon
+        return found
+
+def gadm_code(id_1, id_2=None):
+    """ Return the code of a department (ID_1 of NIC_adm1) or of a municipality (ID_1 and ID_2 of NIC_adm2), e.g. 'NIC.9' or 'NIC.9.88' """
+    return 'NIC.%s' % id_1 if id_2 is None else 'NIC.%s.%s' % (id_1, id_2)
+
+class AdminAreas(object):
+    """
+    Departments and municipalities of Nicaragua.
+    adm1_fpath, adm2_fpath: the GADM shapefiles NIC_adm1 and NIC_adm2, without extension
+    """
+    def __init__(self, adm1_fpath, adm2_fpath):
+        self.departments = PolygonLayer(adm1_fpath, [('NAME_1', 4), ('ID_1', 3)])
+        self.municipalities = PolygonLayer(adm2_fpath, [('NAME_1', 4), ('NAME_2', 6), ('ID_1', 3), ('ID_2', 5)])
+
+    @classmethod
+    def from_gadm(cls, gadm_dir=GADM_DIR):
+        """ Load NIC_adm1 and NIC_adm2 from gadm_dir (default: plots/data/NIC_adm). Return None if they are missing """
+        adm1_fpath = os.path.join(gadm_dir, "NIC_adm1")
+        adm2_fpath = os.path.join(gadm_dir, "NIC_adm2")
+        if not (os.path.exists(adm1_fpath + '.shp') and os.path.exists(adm2_fpath + '.shp')):
+            return None
+        return cls(adm1_fpath, adm2_fpath)
+
+    def locate_areas(self, lat, lon):
+        """ Return the list of the (municipality, department, code) of the points (see gadm_code; '' if a point is outside all polygons) """
+        municipality_ix = self.municipalities.locate(lon, lat)
+        department_ix = self.departments.locate(lon, lat)
+        areas = []
+        for muni, dept in zip(municipality_ix, department_ix):
+            if muni >= 0:
+                department, municipality, id_1, id_2 = self.municipalities.values[muni]
+                areas.append((municipality, department, gadm_code(id_1, id_2)))
+            elif dept >= 0:
+                department, id_1 = self.departments.values[dept]
+                areas.append(('', department, gadm_code(id_1)))
+            else:
+                areas.append(('', '', ''))
+        return areas
+
+    def locate(self, lat, lon):
+        """ Return the lists of municipality and department names of the points ('' if a point is outside all polygons) """
+        areas = self.locate_areas(lat, lon)
+        return [area[0] for area in areas], [area[1] for area in areas]
+
+    def assign(self, places):
+        """
+        Set the municipality, department and gadm_code of places (dicts with lat, lon keys, e.g. rows of osm_places) inside the
+        boundaries, with a gadm_score of 1. Places outside all departments or without coordinates keep their values.
+        Places inside a department but in no municipality (gaps between the municipality polygons) keep their municipality and
+        gadm_code if it is a municipality of this department; otherwise their municipality is cleared and they get the code of
+        the department. Return the number of places assigned
+        """
+        lat = np.array([float(place['lat']) if place.get('lat') not in (None, '') else np.nan for place in places])
+        lon = np.array([float(place['lon']) if place.get('lon') not in (None, '') else np.nan for place in places])
+        count = 0
+        for place, (municipality, department, code) in zip(places, self.locate_areas(lat, lon)):
+            if municipality:
+                place['municipality'] = municipality
+                place['department'] = department
+                place['gadm_code'] = code
+                place['gadm_score'] = 1.0
+                count += 1
+            elif department:
+                place['department'] = department
+                if not (place.get('gadm_code') or '').startswith(code + '.'):
+                    place['municipality'] = ''
+                    place['gadm_code'] = code
+                    place['gadm_score'] = 1.0
+                count += 1
+        return count
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar binary copies of the tables written by extract_osm.py (osm_places, osm_altnames, osm_addresses).
+
+Each table is a folder (e.g. osm_places.columns/) holding a meta.json file and one .npy file per column:
+- lat, lon, gadm_score: float64 (NaN if missing)
+- type, facility_type, municipality, department, country, gadm_code: dictionary-encoded, int32 codes into meta.json categories
+- other columns (osm_id, name, source_ids, full_addr, postal_code): utf-8 strings as offsets (int64) into a data (uint8) array
+The reader memory-maps the columns, so that loading a table is instantaneous and filters are vectorized NumPy operations.
+Example:
+  places = read_table('places')
+  health = places.equals('type', 'health')
+  lat, lon = places['lat'][health], places['lon'][health]
+  names = places.decode('name', health)
+"""
+
+import os
+import csv
+import json
+import shutil
+
+import numpy as np
+
+TABLE_NAMES = ['places', 'altnames', 'addresses']
+FLOAT_COLUMNS = ['lat', 'lon', 'gadm_score']
+DICTIONARY_COLUMNS = ['type', 'facility_type', 'municipality', 'department', 'country', 'gadm_code']
+FORMAT_VERSION = 1
+
+def default_dir():
+    return os.path.dirname(os.path.realpath(__file__))
+
+def table_path(table, out_dir=None):
+    """ Return the folder of the columnar table ('places', 'altnames' or 'addresses') in out_dir (default: the folder of this script) """
+    return os.path.join(out_dir or default_dir(), 'osm_' + table + '.columns')
+
+def column_kind(colname):
+    if colname in FLOAT_COLUMNS:
+        return 'float'
+    if colname in DICTIONARY_COLUMNS:
+        return 'dictionary'
+    return 'string'
+
+def write_table(table_dir, colnames, rows):
+    """
+    Write rows (dicts, e.g. from csv.DictReader) into a columnar table in table_dir, replacing any previous one.
+    Return the number of rows
+    """
+    floats = dict((colname, []) for colname in colnames if column_kind(colname) == 'float')
+    codes = dict((colname, []) for colname in colnames if column_kind(colname) == 'dictionary')
+    categories = dict((colname, {}) for colname in codes)
+    offsets = dict((colname, [0]) for colname in colnames if column_kind(colname) == 'string')
+    data = dict((colname, bytearray()) for colname in offsets)
+    count = 0
+    for row in rows:
+        for colname in floats:
+            value = row.get(colname)
+            floats[colname].append(float(value) if value not in (None, '') else np.nan)
+        for colname in codes:
+            value = row.get(colname) or ''
+            codes[colname].append(categories[colname].setdefault(value, len(categories[colname])))
+        for colname in offsets:
+            data[colname].extend((row.get(colname) or '').encode('utf-8'))
+            offsets[colname].append(len(data[colname]))
+        count += 1
+
+    tmp_dir = table_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for colname, values in floats.items():
+        np.save(os.path.join(tmp_dir, colname + '.npy'), np.array(values, dtype=np.float64))
+    for colname, values in codes.items():
+        np.save(os.path.join(tmp_dir, colname + '.codes.npy'), np.array(values, dtype=np.int32))
+    for colname in offsets:
+        np.save(os.path.join(tmp_dir, colname + '.offsets.npy'), np.array(offsets[colname], dtype=np.int64))
+        np.save(os.path.join(tmp_dir, colname + '.data.npy'), np.frombuffer(bytes(data[colname]), dtype=np.uint8))
+    meta = { 'version'    : FORMAT_VERSION,
+             'rows'       : count,
+             'columns'    : [[colname, column_kind(colname)] for colname in colnames],
+             'categories' : dict((colname, sorted(values, key=values.get)) for colname, values in categories.items())
+           }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    if os.path.exists(table_dir):
+        shutil.rmtree(table_dir)
+    os.rename(tmp_dir, table_dir)
+    return count
+
+def write_csv_tables(out_dir=None):
+    """ Write the columnar copies of osm_places.csv, osm_altnames.csv and osm_addresses.csv in out_dir (default: the folder of this script) """
+    for table in TABLE_NAMES:
+        with open(os.path.join(out_dir or default_dir(), 'osm_' + table + '.csv'), newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            write_table(table_path(table, out_dir), reader.fieldnames, reader)
+
+class ColumnarTable(object):
+    """
+    Read-only view of a columnar table. Columns are memory-mapped when first accessed.
+    table['lat'] is a float64 array, table['type'] the int32 codes of a dictionary-encoded column,
+    table['name'] a (offsets, data) pair; use decode() to get strings.
+    """
+    def __init__(self, table_dir):
+        self.table_dir = table_dir
+        with open(os.path.join(table_dir, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported columnar table version: %s' % meta['version'])
+        self.rows = meta['rows']
+        self.kinds = dict((colname, kind) for colname, kind in meta['columns'])
+        self.columns = [colname for colname, kind in meta['columns']]
+        self.categories = meta['categories']
+        self.arrays = {}
+
+    def __len__(self):
+        return self.rows
+
+    def array(self, fname):
+        if fname not in self.arrays:
+            self.arrays[fname] = np.load(os.path.join(self.table_dir, fname), mmap_mode='r')
+        return self.arrays[fname]
+
+    def __getitem__(self, colname):
+        kind = self.kinds[colname]
+        if kind == 'float':
+            return self.array(colname + '.npy')
+        if kind == 'dictionary':
+            return self.array(colname + '.codes.npy')
+        return self.array(colname + '.offsets.npy'), self.array(colname + '.data.npy')
+
+    def code(self, colname, value):
+        """ Return the code of value in a dictionary-encoded column, or -1 if the column never takes this value """
+        try:
+            return self.categories[colname].index(value)
+        except ValueError:
+            return -1
+
+    def equals(self, colname, value):
+        """ Return the boolean mask of the rows where a dictionary-encoded column equals value """
+        return self[colname] == self.code(colname, value)
+
+    def isin(self, colname, values):
+        """ Return the boolean mask of the rows where a dictionary-encoded column takes one of values """
+        codes = [self.code(colname, value) for value in values]
+        return np.isin(self[colname], [code for code in codes if code >= 0])
+
+    def decode(self, colname, index=None):
+        """
+        Return the values of a dictionary-encoded or string column as a list of str.
+        index (optional): boolean mask or integer indices of the rows to decode
+        """
+        rows = np.arange(self.rows) if index is None else np.arange(self.rows)[index]
+        if self.kinds[colname] == 'dictionary':
+            categories = self.categories[colname]
+            return [categories[code] for code in self[colname][rows]]
+        if self.kinds[colname] == 'float':
+            raise ValueError(colname + ' is not a string column')
+        offsets, data = self[colname]
+        return [bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8') for i in rows]
+
+    def row(self, i):
+        """ Return row i as a dict of strings, as read from the csv file (floats are formatted with repr) """
+        row = {}
+        for colname in self.columns:
+            if self.kinds[colname] == 'float':
+                value = self[colname][i]
+                row[colname] = '' if np.isnan(value) else repr(float(value))
+            else:
+                row[colname] = self.decode(colname, [i])[0]
+        return row
+
+def read_table(table, out_dir=None):
+    """ Open the columnar table 'places', 'altnames' or 'addresses' written in out_dir (default: the folder of this script) """
+    return ColumnarTable(table_path(table, out_dir))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Coverage gaps of the health facilities: distance from every cell of a raster of Nicaragua to the nearest facility of each
+facility_type of osm_places.csv (and to the nearest health facility of any type), and coverage statistics by municipality.
+
+The raster is a regular grid of spatialindex.project (i.e. of longitude and latitude) over the GADM departments. Its cells are
+labelled with their municipality by rasterizing the GADM polygons (adminareas.PolygonLayer.rasterize); lakes are left out.
+Distances are computed for all the cells at once. The raster is divided into blocks of BLOCK_CELLS x BLOCK_CELLS cells, and
+batched queries of a spatialindex.GridIndex find the facilities that can be the nearest to some cell of each block: those
+within the distance from the block centre to its nearest facility plus the block diagonal. The distances from the cells
+to these few candidates are then computed as arrays, so a 250 m national raster takes seconds per facility type.
+The rasters are saved as .npz files (raster: distance in km, NaN outside the country, row 0 at the south;
+extent: lon min, lon max, lat min, lat max), drawn by plots/NICmap.py (NICBasemap.draw_raster), and the statistics as
+coverage_by_municipality.csv.
+Example:
+  grid = CoverageGrid(adminareas.AdminAreas.from_gadm(), cell_km=0.25)
+  raster = grid.distance_raster(lat, lon)         # of the facilities
+  stats = grid.municipality_stats(raster)
+Run: python coverage.py --cell-km 0.25
+"""
+
+import os
+import re
+import csv
+import math
+import time
+import argparse
+
+import numpy as np
+
+import adminareas
+import spatialindex
+
+DEFAULT_CELL_KM = 1.0
+# Side of the blocks of cells sharing a candidate search, in cells
+BLOCK_CELLS = 16
+# Number of blocks searched at once (blocks are sorted by search radius, so that each query uses a radius close to their own)
+SEARCH_BATCH = 1024
+# Maximum number of (candidate, cell) distances computed at once
+MAX_DISTANCES = 1 << 22
+THRESHOLDS_KM = (5, 10, 20)
+LAKES = ["Lago Nicaragua", "Lago de Nicaragua"]
+# Name of the raster of the distance to the nearest health facility of any type
+ALL_FACILITIES = 'all'
+OSM_DB_DIR = os.path.dirname(os.path.realpath(__file__))
+PLACES_FPATH = os.path.join(OSM_DB_DIR, "osm_places.csv")
+STATS_COLNAMES = ['department', 'municipality', 'facility_type', 'area_km2', 'mean_km', 'median_km', 'p90_km', 'max_km'] + \
+                 ['within_%gkm' % threshold for threshold in THRESHOLDS_KM]
+
+class CoverageGrid(object):
+    """
+    Raster of the municipalities of Nicaragua.
+    admin_areas: adminareas.AdminAreas; cell_km: size of the cells, in km
+    """
+    def __init__(self, admin_areas, cell_km=DEFAULT_CELL_KM):
+        self.cell_km = cell_km
+        self.dlon = cell_km / (spatialindex.KM_PER_DEGREE * math.cos(math.radians(spatialindex.LAT0)))
+        self.dlat = cell_km / spatialindex.KM_PER_DEGREE
+        bboxes = admin_areas.departments.bboxes
+        lon_min, lat_min = bboxes[:, 0].min(), bboxes[:, 1].min()
+        cols = int(math.ceil((bboxes[:, 2].max() - lon_min) / self.dlon))
+        rows = int(math.ceil((bboxes[:, 3].max() - lat_min) / self.dlat))
+        self.shape = (rows, cols)
+        self.extent = (lon_min, lon_min + cols * self.dlon, lat_min, lat_min + rows * self.dlat)
+
+        # Municipality of each cell (index in admin_areas.municipalities.values: (department, municipality, ID_1, ID_2)), -1 outside
+        self.names = admin_areas.municipalities.values
+        self.municipality = admin_areas.municipalities.rasterize(self.extent, self.shape)
+        lakes = [i for i, names in enumerate(self.names) if any(name in LAKES for name in names)]
+        self.municipality[np.isin(self.municipality, lakes)] = -1
+        self.inside = self.municipality >= 0
+
+    def block_centres(self, brows, bcols):
+        """ Return the (lat, lon) of the centres of the blocks (brows, bcols) """
+        size = BLOCK_CELLS / 2.
+        return self.extent[2] + (brows * BLOCK_CELLS + size) * self.dlat, self.extent[0] + (bcols * BLOCK_CELLS + size) * self.dlon
+
+    def distance_raster(self, lat, lon):
+        """
+        Return the (rows, columns) float32 raster of the distance (km) from the centre of each cell to the nearest of the points
+        (lat, lon), NaN outside the country (or everywhere if there are no points)
+        """
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        rows, cols = self.shape
+        raster = np.full(self.shape, np.nan, dtype=np.float32)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        if not valid.any():
+            return raster
+        # Cells of the index of about half the spacing of the points, so that searches visit few cells
+        index_cell_km = max(spatialindex.DEFAULT_CELL_KM, math.sqrt(self.inside.sum() * self.cell_km ** 2 / valid.sum()) / 2)
+        index = spatialindex.GridIndex(lat, lon, cell_km=index_cell_km)
+        nbrows, nbcols = -(-rows // BLOCK_CELLS), -(-cols // BLOCK_CELLS)
+        cell_rows, cell_cols = np.nonzero(self.inside)
+        blocks = np.unique((cell_rows // BLOCK_CELLS) * nbcols + cell_cols // BLOCK_CELLS)
+        brows, bcols = blocks // nbcols, blocks % nbcols
+
+        # The nearest point of any cell of a block is within d + 2 h of the block centre, d being the distance from the centre to
+        # its nearest point and h the half diagonal of the block
+        centre_lat, centre_lon = self.block_centres(brows, bcols)
+        nearest = index.knn(centre_lat, centre_lon, 1)[0][:, 0]
+        search_km = nearest + BLOCK_CELLS * self.cell_km * math.sqrt(2) + 1e-6
+        pair_blocks, pair_points = [], []
+        order = np.argsort(search_km)
+        for start in range(0, len(order), SEARCH_BATCH):
+            batch = order[start:start + SEARCH_BATCH]
+            ids, distances = index.radius(centre_lat[batch], centre_lon[batch], search_km[batch].max(), return_distance=True)
+            counts = np.array([len(d) for d in ids])
+            keep = np.concatenate(distances) <= np.repeat(search_km[batch], counts)
+            pair_blocks.append(np.repeat(batch, counts)[keep])
+            pair_points.append(np.concatenate(ids)[keep])
+        pair_blocks, pair_points = np.concatenate(pair_blocks), np.concatenate(pair_points)
+        order = np.argsort(pair_blocks, kind='stable')
+        pair_blocks, pair_points = pair_blocks[order], pair_points[order]
+
+        # Distances from the cells of each block to its candidates, in chunks of blocks; the raster is filled block by block
+        px, py = spatialindex.project(lat[pair_points], lon[pair_points])
+        x0, y0 = spatialindex.project(self.extent[2], self.extent[0])
+        offsets = (np.arange(BLOCK_CELLS) + 0.5) * self.cell_km
+        bx = x0 + bcols * BLOCK_CELLS * self.cell_km
+        by = y0 + brows * BLOCK_CELLS * self.cell_km
+        block_start = np.searchsorted(pair_blocks, np.arange(len(blocks) + 1))
+        values = np.empty((nbrows, nbcols, BLOCK_CELLS, BLOCK_CELLS), dtype=np.float32)
+        values.fill(np.nan)
+        blocks_per_chunk = max(1, MAX_DISTANCES // (BLOCK_CELLS ** 2 * max(1, len(pair_blocks) // len(blocks))))
+        for first in range(0, len(blocks), blocks_per_chunk):
+            last = min(first + blocks_per_chunk, len(blocks))
+            pairs = slice(block_start[first], block_start[last])
+            b = pair_blocks[pairs]
+            dx = bx[b][:, None] + offsets[None, :] - px[pairs][:, None]
+            dy = by[b][:, None] + offsets[None, :] - py[pairs][:, None]
+            d2 = dy[:, :, None] ** 2 + dx[:, None, :] ** 2
+            nearest_d2 = np.minimum.reduceat(d2, block_start[first:last] - block_start[first], axis=0)
+            values[brows[first:last], bcols[first:last]] = np.sqrt(nearest_d2)
+        raster[:] = values.transpose(0, 2, 1, 3).reshape(nbrows * BLOCK_CELLS, nbcols * BLOCK_CELLS)[:rows, :cols]
+        raster[~self.inside] = np.nan
+        return raster
+
+    def municipality_stats(self, raster, thresholds_km=THRESHOLDS_KM):
+        """
+        Aggregate a distance raster by municipality.
+        Return a list of dictionaries {department, municipality, area_km2, mean_km, median_km, p90_km, max_km, within_<t>km : share of the area}
+        """
+        cells = self.inside & np.isfinite(raster)
+        municipality, distance = self.municipality[cells], raster[cells].astype(np.float64)
+        order = np.lexsort((distance, municipality))
+        municipality, distance = municipality[order], distance[order]
+        bounds = np.searchsorted(municipality, np.arange(len(self.names) + 1))
+        counts = np.diff(bounds)
+        stats = []
+        for i in np.flatnonzero(counts):
+            d = distance[bounds[i]:bounds[i + 1]]
+            row = {'department': self.names[i][0], 'municipality': self.names[i][1],
+                   'area_km2': round(len(d) * self.cell_km ** 2, 2), 'mean_km': round(float(d.mean()), 2),
+                   'median_km': round(float(d[(len(d) - 1) // 2]), 2), 'p90_km': round(float(d[int(0.9 * (len(d) - 1))]), 2),
+                   'max_km': round(float(d[-1]), 2)}
+            for threshold in thresholds_km:
+                row['within_%gkm' % threshold] = round(float(np.searchsorted(d, threshold, side='right')) / len(d), 4)
+            stats.append(row)
+        return stats
+
+def save_raster(fpath, raster, extent, **metadata):
+    """ Save a raster and its extent (lon min, lon max, lat min, lat max) as a .npz file, with optional metadata arrays """
+    np.savez_compressed(fpath, raster=raster, extent=np.asarray(extent, dtype=np.float64), **metadata)
+
+def load_raster(fpath):
+    """ Return the (raster, extent) of a .npz file written by save_raster """
+    with np.load(fpath) as arrays:
+        return arrays['raster'], tuple(arrays['extent'])
+
+def raster_fpath(out_dir, facility_type):
+    """ Return the path of the raster of a facility type, e.g. coverage_health_post.npz """
+    return os.path.join(out_dir, 'coverage_%s.npz' % re.sub(r'\W+', '_', facility_type))
+
+def main(cell_km=DEFAULT_CELL_KM, type='health', facility_types=None, places_fpath=PLACES_FPATH, out_dir=OSM_DB_DIR):
+    """
+    Write the distance raster of each facility type (default: all the facility types of the places of type, and 'all')
+    and coverage_by_municipality.csv to out_dir
+    """
+    start = time.time()
+    admin_areas = adminareas.AdminAreas.from_gadm()
+    if admin_areas is None:
+        print('GADM boundaries not found in %s' % adminareas.GADM_DIR)
+        return
+    grid = CoverageGrid(admin_areas, cell_km)
+    print('Raster of %d x %d cells of %g km (%d in the country): %.1f s' % (grid.shape + (cell_km, grid.inside.sum(), time.time() - start)))
+
+    places = spatialindex.PlacesIndex.from_csv(places_fpath)
+    of_type = places.labels['type'] == type
+    if facility_types is None:
+        facility_types = sorted(set(places.labels['facility_type'][of_type]) - {''}) + [ALL_FACILITIES]
+    stats = []
+    for facility_type in facility_types:
+        start = time.time()
+        mask = of_type if facility_type == ALL_FACILITIES else of_type & (places.labels['facility_type'] == facility_type)
+        rows = np.flatnonzero(mask & np.isfinite(places.lat) & np.isfinite(places.lon))
+        raster = grid.distance_raster(places.lat[rows], places.lon[rows])
+        save_raster(raster_fpath(out_dir, facility_type), raster, grid.extent, cell_km=cell_km, facility_type=facility_type)
+        for row in grid.municipality_stats(raster):
+            row['facility_type'] = facility_type
+            stats.append(row)
+        print('%s: %d facilities, %.1f s' % (facility_type, len(rows), time.time() - start))
+
+    with open(os.path.join(out_dir, 'coverage_by_municipality.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=STATS_COLNAMES)
+        writer.writeheader()
+        writer.writerows(sorted(stats, key=lambda row: (row['department'], row['municipality'], row['facility_type'])))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distance to the nearest health facility and coverage by municipality')
+    parser.add_argument('--cell-km', type=float, default=DEFAULT_CELL_KM, help='size of the raster cells in km, e.g. 0.25')
+    parser.add_argument('--type', default='health', help='type of the places (default: health)')
+    parser.add_argument('--facility-types', nargs='+', help="facility types (default: all the facility types of the places of type, and 'all')")
+    args = parser.parse_args()
+    main(args.cell_km, args.type, args.facility_types)
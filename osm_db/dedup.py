@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Merge the places of different data sources (nicaragua-latest.osm, the imposm amenities and buildings shapefiles)
+that describe the same facility, e.g. a hospital mapped as a node and found again in both shapefiles.
+
+Places are blocked by a grid of cells of a few hundred metres: a place is only compared with the places of its cell
+and of the 8 neighbouring cells, so that merging is near-linear in the number of places.
+Two places match if they come from different sources, have the same type, are within MAX_DISTANCE_M
+and their normalized names are similar enough (see name_similarity).
+The canonical place keeps the osm_id of the source listed first; the ids of all merged places are kept in source_ids.
+Example:
+  merger = PlaceMerger([places_2, places_3])
+  for place in places_1:
+      merger.merge(place)
+  places = places_1 + merger.remaining()
+"""
+
+import re
+import difflib
+import unicodedata
+
+import spatialindex
+
+MAX_DISTANCE_M = 300
+MIN_SIMILARITY = 0.85
+SOURCE_IDS_SEPARATOR = ';'
+
+def normalize_name(name):
+    """ Lower case name, remove accents and punctuation and collapse spaces (e.g. 'Clínica  Médica-San José' -> 'clinica medica san jose') """
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    return ' '.join(re.findall(r'\w+', name))
+
+def name_similarity(name1, name2):
+    """ Similarity in [0, 1] of two normalized names: the best of the difflib ratio and of the Jaccard index of their words """
+    if not name1 or not name2:
+        return 0.0
+    if name1 == name2:
+        return 1.0
+    words1, words2 = set(name1.split()), set(name2.split())
+    jaccard = len(words1 & words2) / len(words1 | words2)
+    return max(jaccard, difflib.SequenceMatcher(None, name1, name2).ratio())
+
+class PlaceMerger(object):
+    """
+    Index of the places of one or more secondary sources, into which the places of the primary source are merged one at a time.
+    sources: lists of places (dicts with osm_id, name, type, lat, lon, and source_ids if they were merged before),
+    in order of priority. A place of a source matching a place of a previous source is merged into it when the index is built.
+    """
+    def __init__(self, sources, max_distance_m=MAX_DISTANCE_M, min_similarity=MIN_SIMILARITY):
+        self.cell_km = max_distance_m / 1000.
+        self.min_similarity = min_similarity
+        self.places = []        # canonical places of the sources
+        self.keys = []          # (source number, x, y, normalized name, type) of each canonical place
+        self.cells = {}         # grid cell -> numbers of the canonical places in the cell
+        self.merged = set()     # numbers of the canonical places merged into a place of the primary source
+        self.duplicates = 0
+        for source_number, places in enumerate(sources, 1):
+            for place in places:
+                place = dict(place)
+                key = self.place_key(place, source_number)
+                match = self.find(key)
+                if match is None:
+                    place['source_ids'] = place.get('source_ids') or str(place['osm_id'])
+                    self.add(place, key)
+                else:
+                    self.absorb(self.places[match], place)
+                    self.duplicates += 1
+
+    def place_key(self, place, source_number):
+        try:
+            x, y = spatialindex.project(float(place['lat']), float(place['lon']))
+        except (TypeError, ValueError):
+            x, y = float('nan'), float('nan')
+        return source_number, float(x), float(y), normalize_name(place.get('name')), place.get('type')
+
+    def cell(self, x, y):
+        return int(x // self.cell_km), int(y // self.cell_km)
+
+    def add(self, place, key):
+        self.places.append(place)
+        self.keys.append(key)
+        if key[1] == key[1]:   # not NaN
+            self.cells.setdefault(self.cell(key[1], key[2]), []).append(len(self.places) - 1)
+
+    def candidates(self, key):
+        """ Yield the numbers of the canonical places matching key, with their name similarity and squared distance """
+        source_number, x, y, name, type = key
+        if x != x or not name:
+            return
+        cx, cy = self.cell(x, y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for number in self.cells.get((cx + dx, cy + dy), ()):
+                    other_source, other_x, other_y, other_name, other_type = self.keys[number]
+                    if other_source == source_number or other_type != type or number in self.merged:
+                        continue
+                    if (other_x - x) ** 2 + (other_y - y) ** 2 > self.cell_km ** 2:
+                        continue
+                    similarity = name_similarity(name, other_name)
+                    if similarity >= self.min_similarity:
+                        yield number, similarity, (other_x - x) ** 2 + (other_y - y) ** 2
+
+    def find(self, key):
+        """ Return the number of the canonical place best matching key (most similar name, then nearest), or None """
+        best = None
+        for number, similarity, distance in self.candidates(key):
+            if best is None or (-similarity, distance, number) < best[0]:
+                best = ((-similarity, distance, number), number)
+        return best[1] if best else None
+
+    def absorb(self, place, duplicate):
+        """ Merge duplicate into place: add its ids to source_ids and fill the empty fields of place """
+        place['source_ids'] = (place.get('source_ids') or str(place['osm_id'])) + SOURCE_IDS_SEPARATOR + \
+                              (duplicate.get('source_ids') or str(duplicate['osm_id']))
+        for field in ('name', 'facility_type'):
+            if not place.get(field) and duplicate.get(field):
+                place[field] = duplicate[field]
+
+    def merge(self, place):
+        """
+        Merge into place (of the primary source, modified in place) all the canonical places matching it, which are then
+        not returned by remaining(). Return the number of merged places.
+        """
+        place['source_ids'] = str(place['osm_id'])
+        matches = sorted(number for number, similarity, distance in self.candidates(self.place_key(place, 0)))
+        for number in matches:
+            self.merged.add(number)
+            self.absorb(place, self.places[number])
+        self.duplicates += len(matches)
+        return len(matches)
+
+    def remaining(self):
+        """ Return the canonical places not merged into a place of the primary source """
+        return [place for number, place in enumerate(self.places) if number not in self.merged]
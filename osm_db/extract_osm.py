@@ -2,7 +2,7 @@
 """
 Extract health and education facilities from OpenStreetMap Nicaragua.
 Data sources are: 
-* nicaragua-latest.osm, 
+* nicaragua-latest.osm (or nicaragua-latest.osm.pbf), 
 * managua_nicaragua.imposm-shapefiles/managua_nicaragua_osm_amenities.shp, 
 * managua_nicaragua.imposm-shapefiles/managua_nicaragua_osm_buildings.shp
 Generate 3 csv tables: osm_places, osm_altnames, osm_addresses
@@ -12,9 +12,93 @@ RS 20/04/2016
 """
 
 import os
+import argparse
+import multiprocessing
 import xml.etree.cElementTree as ET
 import shapefile
+import osmpbf
+import osmstore
+import stagecache
+import columnar
+import adminareas
+import gazetteer
+import dedup
 import re, csv
+import time
+import json
+import hashlib
+import gzip
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Regular expressions used to classify OSM tags. They are compiled once by AmenityClassifier.
+# Name-like keys (node/tag."k")
+NAME_KEY_PATTERN = '^name|alt_name|official_name|\
+                           old_name|int_name|loc_name|reg_name|short_name'
+# Address keys and the address field each of them fills
+ADDRESS_KEY_PATTERN = 'addr:.*|postal_code|is_in'
+ADDRESS_FIELD_RULES = [ ('full_addr', 'addr:full|addr:postal'),
+                        ('building_no', 'addr:buildingnumber|addr:housenumber'),
+                        ('street', 'addr:street'),
+                        ('housename', 'addr:housename'),
+                        ('district', 'addr:district'),
+                        ('city', 'addr:city'),
+                        ('province', 'addr:province|is_in:state'),
+                        ('postal_code', 'addr:postcode')
+                      ]
+# Health and education keys
+HEALTH_KEY_PATTERN = 'healthcare|health_facility:type|health_specialty|hos?pital|\
+            doctor|cl.?n.?c|dentist|pharma|farma'
+EDUCATION_KEY_PATTERN = 'education|school'
+# Values of node/tag."k"=="amenity"
+HEALTH_AMENITY_PATTERN = 'hos?pital|cl.?n.?c|laborator|pharmacy|\
+                health_post|health_cent[er][re]|doctor|dentist|\
+                optic|medic|hospice'
+HEALTH_AMENITY_FACILITY_PATTERN = 'hos?pital|dentist|pharmacy|cl.?n.?c|\
+                    medic|optic|hospice|doctor'
+EDUCATION_AMENITY_PATTERN = 'school|university|kindergarten|college'
+# Amenity names
+HEALTH_NAME_PATTERN = 'hos?pital|dentist|pharmacy|farma|laborator|cl.?n.?c|\
+                  medic|optic|hospice|doctor|puesto m.?dico|puesto de salud|\
+                  centro de salud|centro m.?dic.?|unidad m.?dic.?|m.?dico.? unid.*|\
+                  health_post|health_cent[er][re]|casa de la mujer|\
+                  health_facility:type|health_specialty'
+EDUCATION_NAME_PATTERN = 'universidad|university|escuela|school|college|colegio|\
+                             academy|escolar|kindergarten'
+# Facility type given an amenity type, in order of precedence: [(pattern, facility_type), ...]
+FACILITY_RULES = { 'health' : [ ('hos?pital', 'hospital'),
+                                ('dentist', 'dentist'),
+                                ('pharmacy|farma', 'pharmacy'),
+                                ('cl.?n.?c', 'clinic'),
+                                ('puesto m.?dico|puesto de salud|health post', 'health_post'),
+                                ('centro de salud|centro m.?dic.?|unidad m.?dic.?|m.?dico.? unid.*', 'health_centre'),
+                                ('laborator', 'laboratory'),
+                                ('doctor|medic', 'medic'),
+                                ('maternas|maternity|casa de la mujer', "women's house/maternity_home"),
+                                ('hospice', 'other:hospice'),
+                                ('optic', 'other:optic')
+                              ],
+                   'education' : [ ('universidad|university', 'university'),
+                                   ('escuela|school|college|colegio|academy|escolar|kindergarten', 'school')
+                                 ]
+                 }
+
+# Version of the extraction code. Increase it when a change alters the extracted tables, so that cached stage results are recomputed.
+EXTRACTION_VERSION = 2
+
+# Number of rows whose administrative areas are assigned at once in streaming mode
+ADMIN_BATCH_SIZE = 10000
+
+# Extraction state file written by main(), see save_state_amenities()
+STATE_FILENAME = 'osm_state.jsonl'
+
+# Column names of each output table
+# gadm_code, gadm_score: GADM code of the municipality or department and confidence score, see gazetteer.py and adminareas.py
+TABLE_COLNAMES = { 'places' : ['osm_id', 'name', 'type', 'facility_type', \
+                               'lat', 'lon', 'municipality', 'department', 'country', 'source_ids', 'gadm_code', 'gadm_score'],
+                   'altnames' : ['osm_id', 'name'],
+                   'addresses' : ['osm_id', 'full_addr', 'postal_code', 'municipality', 'department', 'country', 'gadm_code', 'gadm_score']
+                 }
 
 def xml_count_tags(fpath):
     """ List the tags of all direct children of root as well as their counts """
@@ -46,14 +130,9 @@ def xml_list_node_tags(fpath, out_filename):
 def get_regexp(type):
     regexp = None
     if type == 'health':
-        regexp = re.compile( 'hos?pital|dentist|pharmacy|farma|laborator|cl.?n.?c|\
-                  medic|optic|hospice|doctor|puesto m.?dico|puesto de salud|\
-                  centro de salud|centro m.?dic.?|unidad m.?dic.?|m.?dico.? unid.*|\
-                  health_post|health_cent[er][re]|casa de la mujer|\
-                  health_facility:type|health_specialty' )
+        regexp = re.compile(HEALTH_NAME_PATTERN)
     elif type == 'education':
-        regexp = re.compile('universidad|university|escuela|school|college|colegio|\
-                             academy|escolar|kindergarten')
+        regexp = re.compile(EDUCATION_NAME_PATTERN)
     return regexp
 
 def classify_amenity_type(name):
@@ -82,23 +161,10 @@ def classify_amenity_type(name):
 def classify_facility_type(name, type):
     """ Classify facility type from its name, given a known amenity type (e.g., health, education) """
     facility_type = None
-    if type == 'health' :
-        if re.search('hos?pital', name) : facility_type = 'hospital'
-        elif re.search('dentist', name) : facility_type = 'dentist'
-        elif re.search('pharmacy|farma', name) : facility_type = 'pharmacy'
-        elif re.search('cl.?n.?c', name) : facility_type = 'clinic'
-        elif re.search('puesto m.?dico|puesto de salud|health post', name) : facility_type = 'health_post'
-        elif re.search('centro de salud|centro m.?dic.?|unidad m.?dic.?|m.?dico.? unid.*', name): facility_type = 'health_centre'
-        elif re.search('laborator', name) : facility_type = 'laboratory'
-        elif re.search('doctor|medic', name) : facility_type = 'medic'
-        elif re.search('maternas|maternity|casa de la mujer', name) : facility_type = "women's house/maternity_home"
-        elif re.search('hospice', name) : facility_type = 'other:hospice'
-        elif re.search('optic', name) : facility_type = 'other:optic'
-        
-    elif type == 'education' :
-        if re.search('universidad|university', name) : facility_type = 'university'
-        elif re.search('escuela|school|college|colegio|academy|escolar|kindergarten', name) : 
-            facility_type = 'school'
+    for pattern, rule_facility_type in FACILITY_RULES.get(type, []):
+        if re.search(pattern, name):
+            facility_type = rule_facility_type
+            break
             
     return facility_type
     
@@ -106,6 +172,7 @@ def xml_is_amenity(elem):
     """ 
     Check if a tree element with a tag 'node' corresponds to an amenity. Currently, only education and health types are supported.
     Return: is_amenity (bool), place (a dictionary containing the amenity's information; None if not an amenity) 
+    Reference implementation. AmenityClassifier().classify_element(elem) returns the same result much faster.
     """ 
     is_amenity = False
     place = None
@@ -130,31 +197,23 @@ def xml_is_amenity(elem):
             val = str(tag.get("v"))
             
             # name
-            regexp = re.compile('^name|alt_name|official_name|\
-                           old_name|int_name|loc_name|reg_name|short_name')
+            regexp = re.compile(NAME_KEY_PATTERN)
             if regexp.search(key):
                 names.append(val)
 
             # address
-            regexp = re.compile('addr:.*|postal_code|is_in')
+            regexp = re.compile(ADDRESS_KEY_PATTERN)
             if regexp.search(key):
                 if re.search('addr:|is_in:', key):
-                    address_dict['full_addr'] = val if re.match('addr:full|addr:postal', key) else None
-                    address_dict['building_no'] = val if re.match('addr:buildingnumber|addr:housenumber', key) else None
-                    address_dict['street'] = val if re.match('addr:street', key) else None
-                    address_dict['housename'] = val if re.match('addr:housename', key) else None
-                    address_dict['district'] = val if re.match('addr:district', key) else None
-                    address_dict['city'] = val if re.match('addr:city', key) else None
-                    address_dict['province'] = val if re.match('addr:province|is_in:state', key) else None
-                    address_dict['postal_code'] = val if re.match('addr:postcode', key) else None
+                    for field, field_pattern in ADDRESS_FIELD_RULES:
+                        address_dict[field] = val if re.match(field_pattern, key) else None
                 else: # re.search('postal_code', key):   
                     address_dict['postal_code'] = val if re.match('postal_code', key) else None
             
             # AMENITY_TYPE and FACILITY_TYPE
             # ----- Search at node/tag.key
             # Health
-            regexp = re.compile('healthcare|health_facility:type|health_specialty|hos?pital|\
-            doctor|cl.?n.?c|dentist|pharma|farma')
+            regexp = re.compile(HEALTH_KEY_PATTERN)
             if regexp.search(key):
                 amenity_type = 'health'
                 if re.search('health_facility:type|healthcare', key):
@@ -165,7 +224,7 @@ def xml_is_amenity(elem):
                     facility_type = key 
             
             # Education
-            regexp = re.compile('education|school')
+            regexp = re.compile(EDUCATION_KEY_PATTERN)
             if regexp.search(key):
                 amenity_type = 'education'
                 if key == 'education': facility_type = val
@@ -174,20 +233,17 @@ def xml_is_amenity(elem):
             # ----- Search at the attribute value ("v") of node/tag."k"=="amenity"
             if re.search('amenity', key):                        
                 # Health
-                regexp = re.compile('hos?pital|cl.?n.?c|laborator|pharmacy|\
-                health_post|health_cent[er][re]|doctor|dentist|\
-                optic|medic|hospice')
+                regexp = re.compile(HEALTH_AMENITY_PATTERN)
                           
                 if regexp.search(val):
                     amenity_type = 'health'
-                    if re.search('hos?pital|dentist|pharmacy|cl.?n.?c|\
-                    medic|optic|hospice|doctor', val):
+                    if re.search(HEALTH_AMENITY_FACILITY_PATTERN, val):
                         facility_type = val
                     elif re.search('laborator', val):
                         facility_type = 'laboratory'
             
                 # Education
-                regexp = re.compile('school|university|kindergarten|college')
+                regexp = re.compile(EDUCATION_AMENITY_PATTERN)
                 if regexp.search(val):
                     amenity_type = 'education'
                     facility_type = val
@@ -252,96 +308,616 @@ def xml_validate_amenity(amenity_dict):
 
     return is_valid
     
-def xml_get_amenities(fpath):
+class AmenityClassifier(object):
+    """
+    Precompiled, single-pass equivalent of xml_is_amenity, xml_validate_amenity, classify_amenity_type and classify_facility_type.
+    All rule tables are compiled once. Each distinct tag key and amenity value is analysed only once, and classifications by name are memoized.
+    Example:
+      classifier = AmenityClassifier()
+      is_amenity, place = classifier.classify_element(elem)
+    max_memo: maximum number of entries of each memo table. A full table is emptied, which keeps memory use bounded on large inputs.
+    """
+    def __init__(self, max_memo=100000):
+        self.max_memo = max_memo
+        self.name_key_re = re.compile(NAME_KEY_PATTERN)
+        self.address_key_re = re.compile(ADDRESS_KEY_PATTERN)
+        self.address_field_res = [(field, re.compile(pattern)) for field, pattern in ADDRESS_FIELD_RULES]
+        self.health_key_re = re.compile(HEALTH_KEY_PATTERN)
+        self.education_key_re = re.compile(EDUCATION_KEY_PATTERN)
+        self.health_amenity_re = re.compile(HEALTH_AMENITY_PATTERN)
+        self.health_amenity_facility_re = re.compile(HEALTH_AMENITY_FACILITY_PATTERN)
+        self.education_amenity_re = re.compile(EDUCATION_AMENITY_PATTERN)
+        self.health_name_re = re.compile(HEALTH_NAME_PATTERN)
+        self.education_name_re = re.compile(EDUCATION_NAME_PATTERN)
+        self.invalid_facility_re = re.compile('internet|access')
+        self.facility_res = { type : [(re.compile(pattern), facility_type) for pattern, facility_type in rules] 
+                              for type, rules in FACILITY_RULES.items() }
+        
+        # Memoized results, see remember()
+        self.key_rules = {}       # tag key -> rule, see key_rule()
+        self.value_rules = {}     # amenity value -> [(amenity_type, facility_type), ...]
+        self.name_types = {}      # name -> (amenity_type, facility_type)
+        self.facility_types = {}  # (name, amenity type) -> facility_type
+        
+    def key_rule(self, k):
+        """ 
+        Analyse a tag key ("k") once. 
+        Return a tuple (is_name, address_fields, health_facility, education_facility, is_amenity_key) where
+        - address_fields: None or [(field, bool), ...]; field is set to the tag value if bool is True, otherwise to None
+        - health_facility, education_facility: None or (prefix, use_value); facility_type = prefix + value if use_value else prefix
+        """
+        rule = self.key_rules.get(k)
+        if rule is None:
+            key = str(k).lower()
+            is_name = bool(self.name_key_re.search(key))
+            
+            address_fields = None
+            if self.address_key_re.search(key):
+                if re.search('addr:|is_in:', key):
+                    address_fields = [(field, bool(regexp.match(key))) for field, regexp in self.address_field_res]
+                else:
+                    address_fields = [('postal_code', bool(re.match('postal_code', key)))]
+                    
+            health_facility = None
+            if self.health_key_re.search(key):
+                if re.search('health_facility:type|healthcare', key):
+                    health_facility = ('', True)
+                elif re.search('health_specialty:.*', key):
+                    health_facility = (re.sub('health_specialty:(.*)', '\\1', key), False)
+                else:
+                    health_facility = (key, False)
+                    
+            education_facility = None
+            if self.education_key_re.search(key):
+                education_facility = ('', True) if key == 'education' else ('school:', True)
+                
+            rule = (is_name, address_fields, health_facility, education_facility, 'amenity' in key)
+            self.remember(self.key_rules, k, rule)
+        return rule
+        
+    def value_rule(self, val):
+        """ 
+        Analyse the value of an "amenity" tag once. 
+        Return a list of (amenity_type, facility_type) updates, in order. facility_type None leaves the current facility type unchanged.
+        """
+        rule = self.value_rules.get(val)
+        if rule is None:
+            rule = []
+            if self.health_amenity_re.search(val):
+                if self.health_amenity_facility_re.search(val):
+                    rule.append(('health', val))
+                elif re.search('laborator', val):
+                    rule.append(('health', 'laboratory'))
+                else:
+                    rule.append(('health', None))
+            if self.education_amenity_re.search(val):
+                rule.append(('education', val))
+            self.remember(self.value_rules, val, rule)
+        return rule
+        
+    def classify_tags(self, tags):
+        """ 
+        Classify a list of (key, value) tag pairs in a single pass.
+        Return names, amenity_type, facility_type, address_dict as computed by xml_is_amenity
+        """
+        names = []
+        amenity_type = None
+        facility_type = None
+        address_dict = { 'full_addr' : None,
+                         'housename' : None,
+                         'building_no' : None,
+                         'street' : None,
+                         'district' : None,
+                         'city' : None,
+                         'province' : None,
+                         'country' : 'Nicaragua',
+                         'postal_code' : None
+                        }
+        key_rules = self.key_rules
+        for k, v in tags:
+            is_name, address_fields, health_facility, education_facility, is_amenity_key = key_rules.get(k) or self.key_rule(k)
+            val = str(v)
+            if is_name:
+                names.append(val)
+            if address_fields:
+                for field, use_value in address_fields:
+                    address_dict[field] = val if use_value else None
+            if health_facility:
+                amenity_type = 'health'
+                facility_type = health_facility[0] + val if health_facility[1] else health_facility[0]
+            if education_facility:
+                amenity_type = 'education'
+                facility_type = education_facility[0] + val if education_facility[1] else education_facility[0]
+            if is_amenity_key:
+                for new_amenity_type, new_facility_type in self.value_rule(val):
+                    amenity_type = new_amenity_type
+                    if new_facility_type is not None:
+                        facility_type = new_facility_type
+        return names, amenity_type, facility_type, address_dict
+        
+    def classify_node(self, attrib, tags, by_name=True):
+        """ 
+        Same as xml_is_amenity, given the attributes (a dict with id, version, timestamp, changeset, uid, user, lat, lon) and the list of (key, value) tags of a node
+        by_name: if False, elements without a health or education tag are not classified by their names (see classify_way)
+        Return: is_amenity (bool), place (a dictionary containing the amenity's information; None if not an amenity) 
+        """
+        is_amenity = False
+        place = None
+        if tags:
+            names, amenity_type, facility_type, address_dict = self.classify_tags(tags)
+            if amenity_type or names:
+                if amenity_type: 
+                    is_amenity = True
+                elif by_name:
+                    for name in names:
+                        amenity_type, facility_type = self.classify_name(name)
+                        if amenity_type:
+                            is_amenity = True
+                            break
+                            
+                place = { '_id' : attrib.get('id'),
+                          'created' : {'version' : attrib.get('version'),
+                                       'ts' : attrib.get('timestamp'),
+                                       'changeset' : attrib.get('changeset'),
+                                       'uid' : attrib.get('uid'),
+                                       'user' : attrib.get('user')
+                                       },
+                          'names' : names,
+                          'amenity_type' : amenity_type,
+                          'facility_type': facility_type, 
+                          'location' : { 'lat' : attrib.get('lat') , 'lon' : attrib.get('lon') },
+                          'address' : address_dict
+                        }
+        return is_amenity, place
+        
+    def classify_element(self, elem):
+        """ Same as xml_is_amenity(elem) for a tree element with a tag 'node' """
+        tags = [(tag.get("k"), tag.get("v")) for tag in elem.iterfind('tag')]
+        return self.classify_node(elem.attrib, tags)
+        
+    def validate(self, amenity_dict):
+        """ Same as xml_validate_amenity(amenity_dict) """
+        is_valid = False
+        type = amenity_dict['amenity_type']
+        facility_type = amenity_dict['facility_type']
+        if type == 'health':
+            if facility_type and not self.invalid_facility_re.search(facility_type): 
+                is_valid = True
+            else:
+                for name in amenity_dict['names']:
+                    if self.classify_name(name)[0] == 'health':
+                        is_valid = True 
+                        break
+        elif type == 'education':
+            is_valid = True
+        return is_valid
+        
+    def classify_name(self, name):
+        """ Memoized classify_amenity_type(name) """
+        result = self.name_types.get(name)
+        if result is None:
+            lower_name = name.lower()
+            amenity_type = None
+            facility_type = None
+            if self.health_name_re.search(lower_name):
+                amenity_type = 'health'
+                facility_type = self.classify_facility(lower_name, 'health')
+            if self.education_name_re.search(lower_name):
+                amenity_type = 'education'
+                facility_type = self.classify_facility(lower_name, 'education')
+            result = (amenity_type, facility_type)
+            self.remember(self.name_types, name, result)
+        return result
+        
+    def classify_facility(self, name, type):
+        """ Memoized classify_facility_type(name, type) """
+        try:
+            return self.facility_types[(name, type)]
+        except KeyError:
+            facility_type = None
+            for regexp, rule_facility_type in self.facility_res.get(type, []):
+                if regexp.search(name):
+                    facility_type = rule_facility_type
+                    break
+            self.remember(self.facility_types, (name, type), facility_type)
+            return facility_type
+            
+    def remember(self, memo, key, value):
+        """ Add key: value to the memo table, emptying the table first if it has reached max_memo entries """
+        if len(memo) >= self.max_memo:
+            memo.clear()
+        memo[key] = value
+    
+def xml_get_amenities(fpath, classifier=None):
     """ 
     Given OSM Nicaragua XML file, return all facilities related to health and education.
+    classifier (optional): an AmenityClassifier. A new one is created if not given.
     Return : places (a list of dicts containing information about each facility), count (number of facilities found)
     """   
-    places = []
-    count = 0
-    for event, elem in ET.iterparse(fpath):
-        if elem.tag == 'node':
-            amenity_flag, amenity = xml_is_amenity(elem)
-            if amenity_flag:
-                if xml_validate_amenity(amenity):
-                    places.append(amenity)
-                    count += 1
+    places = list(xml_iter_amenities(fpath, classifier))
+    count = len(places)
     return places, count
 
-def xml_get_tables(amenities_dicts):
+def xml_iter_amenities(fpath, classifier=None, ways=False):
+    """ 
+    Generator version of xml_get_amenities: yield the validated amenity dict of each health and education facility, in file order.
+    Every direct child of root (node, way, relation, ...) is released as soon as it has been classified, 
+    so that memory use does not grow with the size of the input file.
+    ways: if True, ways and multipolygon relations are classified as well and placed at their centroid, see classify_way(). 
+    The coordinates of all nodes are then kept in a compact store (16 bytes per node).
+    """
+    if classifier is None:
+        classifier = AmenityClassifier()
+    resolver = osmstore.WayResolver() if ways else None
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(fpath, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if elem.tag == 'node':
+                if resolver:
+                    resolver.add_node(int(elem.get('id')), osmstore.to_units(elem.get('lat')), osmstore.to_units(elem.get('lon')))
+                amenity_flag, amenity = classifier.classify_element(elem)
+                if amenity_flag and classifier.validate(amenity):
+                    yield amenity
+            elif resolver and elem.tag in ('way', 'relation'):
+                tags = [(tag.get("k"), tag.get("v")) for tag in elem.iterfind('tag')]
+                if elem.tag == 'way':
+                    members = [int(nd.get('ref')) for nd in elem.iterfind('nd')]
+                else:
+                    members = [(member.get('type'), int(member.get('ref'))) for member in elem.iterfind('member')]
+                amenity = classify_way(classifier, resolver, elem.tag, elem.attrib, tags, members)
+                if amenity:
+                    yield amenity
+            elem.clear()
+            root.clear()
+
+def classify_way(classifier, resolver, kind, attrib, tags, members):
+    """ 
+    Classify a way or a relation with the same rules as nodes, once its nodes (resp. members) have been added to resolver (an osmstore.WayResolver).
+    kind: 'way' or 'relation'; members: the node ids of a way, or the [(type, id), ...] members of a relation.
+    Ways are added to resolver. Only multipolygon relations are classified, and only by their health or education tags: the names
+    of ways are not classified, as many streets, streams, etc. are named after facilities (e.g. 'Pista Hospital Militar').
+    Return the validated amenity dict, with '_id' = 'w' or 'r' + id and location = centroid, or None
+    """
+    if kind == 'way':
+        centroid = resolver.add_way(int(attrib['id']), members)
+    elif ('type', 'multipolygon') in tags:
+        centroid = resolver.relation_centroid(members)
+    else:
+        return None
+    if not tags or centroid is None:
+        return None
+    
+    attrib = dict(attrib)
+    attrib['id'] = kind[0] + attrib['id']
+    attrib['lat'], attrib['lon'] = osmstore.format_units(centroid[0]), osmstore.format_units(centroid[1])
+    amenity_flag, amenity = classifier.classify_node(attrib, tags, by_name=False)
+    if amenity_flag and classifier.validate(amenity):
+        return amenity
+    return None
+    
+def osm_id_sort_key(osm_id):
+    """ Sort key of the osm_id of an amenity: nodes, then ways ('w' + id), then relations ('r' + id), as in OSM files """
+    if osm_id[:1] in ('w', 'r'):
+        return (1 if osm_id[0] == 'w' else 2, int(osm_id[1:]))
+    return (0, int(osm_id))
+
+class XMLChunkReader(object):
+    """
+    Read-only file-like object over the bytes [start, end) of an OSM XML file, wrapped in an <osm> root element so that it can be parsed on its own.
+    The byte range must contain whole top-level elements, see xml_chunk_ranges(fpath, nchunks).
+    """
+    def __init__(self, fpath, start, end):
+        self.file = open(fpath, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.head = b'<osm>'
+        self.tail = b'</osm>'
+        
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            return data
+        if self.remaining > 0:
+            nbytes = self.remaining if size is None or size < 0 else min(size, self.remaining)
+            data = self.file.read(nbytes)
+            self.remaining = self.remaining - len(data) if data else 0
+            if data:
+                return data
+        data, self.tail = self.tail, b''
+        return data
+        
+    def close(self):
+        self.file.close()
+
+def xml_find_node_start(f, pos, end, window=1 << 20):
+    """ Return the offset of the first <node element of the open binary file f at or after pos (end if there is none before end) """
+    regexp = re.compile(rb'<node[\s>/]')
+    while pos < end:
+        f.seek(pos)
+        data = f.read(min(window, end - pos) + 6)
+        match = regexp.search(data)
+        if match and pos + match.start() < end:
+            return pos + match.start()
+        pos += window
+    return end
+    
+def xml_chunk_ranges(fpath, nchunks):
+    """ 
+    Split an OSM XML file into at most nchunks byte ranges [(start, end), ...] covering all its top-level elements from the first <node to </osm>.
+    Each range starts on a <node element boundary, so that it can be parsed independently with XMLChunkReader.
+    """
+    size = os.path.getsize(fpath)
+    with open(fpath, 'rb') as f:
+        f.seek(max(0, size - 4096))
+        tail = f.read()
+        end = size - len(tail) + tail.rfind(b'</osm>') if b'</osm>' in tail else size
+        first = xml_find_node_start(f, 0, end)
+        
+        starts = [first]
+        for n in range(1, nchunks):
+            start = xml_find_node_start(f, max(first + (end - first) * n // nchunks, starts[-1] + 1), end)
+            if start >= end:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    if first >= end:
+        return []
+    return list(zip(starts, starts[1:] + [end]))
+
+_worker_classifier = None
+
+def get_worker_classifier():
+    """ Return the AmenityClassifier of the current worker process, so that its memo tables are shared by all the chunks/blobs it processes """
+    global _worker_classifier
+    if _worker_classifier is None:
+        _worker_classifier = AmenityClassifier()
+    return _worker_classifier
+
+def xml_parse_chunk(chunk):
+    """ 
+    Worker of xml_iter_amenities_parallel. chunk = (fpath, start, end). 
+    Return the list of validated amenity dicts found in the byte range, in file order.
+    """
+    fpath, start, end = chunk
+    reader = XMLChunkReader(fpath, start, end)
+    try:
+        return list(xml_iter_amenities(reader, get_worker_classifier()))
+    finally:
+        reader.close()
+        
+def xml_iter_amenities_parallel(fpath, processes=None, chunks_per_process=4):
+    """ 
+    Parallel version of xml_iter_amenities(fpath). The file is split into byte ranges on <node boundaries which are parsed and classified in a process pool.
+    Amenities are yielded in file order (i.e. in osm_id order, OSM extracts being sorted by id), so the output is identical to the one of the serial version.
+    processes: number of worker processes (default: number of CPUs)
+    """
+    processes = processes or multiprocessing.cpu_count()
+    chunks = [(fpath, start, end) for start, end in xml_chunk_ranges(fpath, processes * chunks_per_process)]
+    with multiprocessing.Pool(processes) as pool:
+        for amenities in pool.imap(xml_parse_chunk, chunks):
+            for amenity in amenities:
+                yield amenity
+
+def pbf_iter_amenities(fpath, classifier=None, ways=False):
+    """ 
+    Same as xml_iter_amenities for an OSM PBF file (.osm.pbf): yield the validated amenity dict of each health and education facility, in file order.
+    """
+    if classifier is None:
+        classifier = AmenityClassifier()
+    if not ways:
+        for offset, size in osmpbf.data_blob_offsets(fpath):
+            for amenity in pbf_classify_blob(fpath, offset, size, classifier):
+                yield amenity
+        return
+        
+    resolver = osmstore.WayResolver()
+    for offset, size in osmpbf.data_blob_offsets(fpath):
+        for kind, id, attrib, tags, extra in osmpbf.iter_block_elements(osmpbf.read_blob(fpath, offset, size), ways=True):
+            if kind == 'node':
+                resolver.add_node(id, int(round(extra[0] / 100.0)), int(round(extra[1] / 100.0)))
+                if attrib is None:
+                    continue
+                amenity_flag, amenity = classifier.classify_node(attrib, tags)
+                if not (amenity_flag and classifier.validate(amenity)):
+                    amenity = None
+            else:
+                amenity = classify_way(classifier, resolver, kind, attrib, tags, extra)
+            if amenity:
+                yield amenity
+
+def pbf_classify_blob(fpath, offset, size, classifier):
+    """ Return the list of validated amenity dicts of the OSMData blob at offset in a PBF file, in file order """
+    amenities = []
+    for attrib, tags in osmpbf.decode_primitive_block(osmpbf.read_blob(fpath, offset, size)):
+        amenity_flag, amenity = classifier.classify_node(attrib, tags)
+        if amenity_flag and classifier.validate(amenity):
+            amenities.append(amenity)
+    return amenities
+
+def pbf_parse_blob(blob):
+    """ Worker of pbf_iter_amenities_parallel. blob = (fpath, offset, size) of an OSMData blob """
+    fpath, offset, size = blob
+    return pbf_classify_blob(fpath, offset, size, get_worker_classifier())
+    
+def pbf_iter_amenities_parallel(fpath, processes=None):
+    """ 
+    Parallel version of pbf_iter_amenities(fpath). Blobs are decompressed, decoded and classified in a process pool.
+    Amenities are yielded in file order.
+    processes: number of worker processes (default: number of CPUs)
+    """
+    processes = processes or multiprocessing.cpu_count()
+    blobs = [(fpath, offset, size) for offset, size in osmpbf.data_blob_offsets(fpath)]
+    with multiprocessing.Pool(processes) as pool:
+        for amenities in pool.imap(pbf_parse_blob, blobs):
+            for amenity in amenities:
+                yield amenity
+
+def osm_iter_amenities(fpath, classifier=None, processes=1, ways=False):
+    """ 
+    Yield the validated amenity dicts of the facilities of an OSM file, either XML (.osm) or PBF (.osm.pbf), in file order.
+    processes: if greater than 1, parse the file in parallel with this number of worker processes
+    ways: if True, also classify ways and multipolygon relations. They need the coordinates of all the nodes before them, so the file is then read by a single process.
+    """
+    if ways and processes > 1:
+        print('Ways and relations are resolved in a single process. Ignoring processes = ' + str(processes))
+        processes = 1
+    if fpath.endswith('.pbf'):
+        if processes > 1:
+            return pbf_iter_amenities_parallel(fpath, processes)
+        return pbf_iter_amenities(fpath, classifier, ways)
+    if processes > 1:
+        return xml_iter_amenities_parallel(fpath, processes)
+    return xml_iter_amenities(fpath, classifier, ways)
+
+def benchmark_classifier(fpath, repeat=3):
+    """ 
+    Compare the throughput of xml_is_amenity/xml_validate_amenity against AmenityClassifier on the nodes of an OSM XML file, 
+    and check that both return the same places. All nodes are loaded in memory first so that only the classification is timed.
+    Return a dict: {'nodes' : int, 'legacy_nodes_per_s' : float, 'classifier_nodes_per_s' : float, 'speedup' : float}
+    """
+    nodes = [elem for event, elem in ET.iterparse(fpath) if elem.tag == 'node']
+    
+    def run_legacy():
+        results = []
+        for elem in nodes:
+            amenity_flag, amenity = xml_is_amenity(elem)
+            results.append((amenity_flag, amenity, amenity_flag and xml_validate_amenity(amenity)))
+        return results
+        
+    def run_classifier():
+        # A new classifier each time, so that building the memo tables is included in the timing
+        classifier = AmenityClassifier()
+        results = []
+        for elem in nodes:
+            amenity_flag, amenity = classifier.classify_element(elem)
+            results.append((amenity_flag, amenity, amenity_flag and classifier.validate(amenity)))
+        return results
+    
+    assert run_legacy() == run_classifier(), "AmenityClassifier and xml_is_amenity disagree"
+    
+    timings = {}
+    for label, run in [('legacy', run_legacy), ('classifier', run_classifier)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+        
+    result = { 'nodes' : len(nodes),
+               'legacy_nodes_per_s' : len(nodes) / timings['legacy'],
+               'classifier_nodes_per_s' : len(nodes) / timings['classifier'],
+               'speedup' : timings['legacy'] / timings['classifier'] }
+    print('%d nodes. xml_is_amenity: %.0f nodes/s, AmenityClassifier: %.0f nodes/s (x%.1f)' 
+          % (result['nodes'], result['legacy_nodes_per_s'], result['classifier_nodes_per_s'], result['speedup']))
+    return result
+
+def xml_get_tables(amenities_dicts, gazetteer=None):
     """ 
     Transform amenities_dicts into 3 lists of dictionaries (tables): places, altnames, and addresses
     Each table has a prescribed key value pairs.
+    gazetteer (optional): a gazetteer.Gazetteer resolving the municipality and department of the places and addresses
+    to the GADM names and codes (see Gazetteer.normalize)
     """       
     places, altnames, addresses = [], [], []
     
     for facility in amenities_dicts:
-        # Municipality, department, and country
-        # District, city and municipality are the same. Use one of them as municipality.
-        if facility['address']['city']:
-            municipality = facility['address']['city']
-        elif facility['address']['district']:
-            municipality = facility['address']['district']
-        else: municipality = ''
-        department = facility['address']['province']
-        country = 'Nicaragua' 
-        
-        # Add to places.csv
-        new_place = {'osm_id' : facility['_id'],
-                    'name' : facility['names'][0] if facility['names'] else '', 
-                    'type' : facility['amenity_type'],
-                    'facility_type' : facility['facility_type'],
-                    'lat' : facility['location']['lat'],
-                    'lon' : facility['location']['lon'],
-                    'municipality' : municipality,
-                    'department' : department,
-                    'country'    : country
-                   }
+        new_place, new_altnames, new_address = xml_get_rows(facility)
         places.append(new_place)
-        
-        # Add to altnames.csv
-        if facility['names']:
-            for name in facility['names']:
-                new_altname =  { 'osm_id' : facility['_id'],
-                                 'name'   : name }
-                altnames.append(new_altname)
-        
-        # Add to addresses.csv
-        address = facility['address']
-        if address:
-            if address['full_addr']:
-                full_addr = address['full_addr']
-            else:
-                building_no = address['building_no']
-                street = address['street']
-                if building_no and street:
-                    full_addr = address['building_no'] + "," + address['street']
-                else: full_addr = ''
-                
-            new_address = { 'osm_id'    : facility['_id'],
-                            'full_addr' : full_addr,
-                            'postal_code'  : address['postal_code'],
-                            'municipality' : municipality,
-                            'department'   : department,
-                            'country'      : country
-                           }
+        altnames.extend(new_altnames)
+        if new_address:
             addresses.append(new_address) 
+    if gazetteer:
+        start = time.time()
+        count = gazetteer.normalize(places) + gazetteer.normalize(addresses)
+        print('Resolved the municipality or department of %d of %d places and addresses in %.2f s' 
+              % (count, len(places) + len(addresses), time.time() - start))
     return places, altnames, addresses
-                
-def print_tables(places, altnames, addresses):
+    
+def xml_get_rows(facility):
     """ 
-    Print places, altnames, and addresses tables into csv files
-    """       
-    # Column names of each table
-    colnames = { 'places' : ['osm_id', 'name', 'type', 'facility_type', \
-                             'lat', 'lon', 'municipality', 'department', 'country'],
-                 'altnames' : ['osm_id', 'name'],
-                 'addresses' : ['osm_id', 'full_addr', 'postal_code', 'municipality', 'department', 'country']
-                }
-        
-    fpath_places = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'osm_places.csv')
-    fpath_altnames = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'osm_altnames.csv')
-    fpath_addresses = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'osm_addresses.csv')
+    Transform one amenity dict into its rows of the 3 tables.
+    Return: place (dict), altnames (list of dicts), address (dict or None)
+    """
+    # Municipality, department, and country
+    # District, city and municipality are the same. Use one of them as municipality.
+    if facility['address']['city']:
+        municipality = facility['address']['city']
+    elif facility['address']['district']:
+        municipality = facility['address']['district']
+    else: municipality = ''
+    department = facility['address']['province']
+    country = 'Nicaragua' 
+    
+    # Add to places.csv
+    new_place = {'osm_id' : facility['_id'],
+                'name' : facility['names'][0] if facility['names'] else '', 
+                'type' : facility['amenity_type'],
+                'facility_type' : facility['facility_type'],
+                'lat' : facility['location']['lat'],
+                'lon' : facility['location']['lon'],
+                'municipality' : municipality,
+                'department' : department,
+                'country'    : country
+               }
+    
+    # Add to altnames.csv
+    new_altnames = []
+    if facility['names']:
+        for name in facility['names']:
+            new_altname =  { 'osm_id' : facility['_id'],
+                             'name'   : name }
+            new_altnames.append(new_altname)
+    
+    # Add to addresses.csv
+    new_address = None
+    address = facility['address']
+    if address:
+        if address['full_addr']:
+            full_addr = address['full_addr']
+        else:
+            building_no = address['building_no']
+            street = address['street']
+            if building_no and street:
+                full_addr = address['building_no'] + "," + address['street']
+            else: full_addr = ''
+            
+        new_address = { 'osm_id'    : facility['_id'],
+                        'full_addr' : full_addr,
+                        'postal_code'  : address['postal_code'],
+                        'municipality' : municipality,
+                        'department'   : department,
+                        'country'      : country
+                       }
+    return new_place, new_altnames, new_address
+    
+def xml_iter_rows(amenities_dicts, gazetteer=None):
+    """ Generator version of xml_get_tables: yield (place, altnames, address) for each amenity dict """
+    for facility in amenities_dicts:
+        place, altnames, address = xml_get_rows(facility)
+        if gazetteer:
+            gazetteer.normalize([place, address] if address else [place])
+        yield place, altnames, address
+    
+@contextmanager
+def open_table_writers(out_dir=None):
+    """ 
+    Open osm_places.csv, osm_altnames.csv and osm_addresses.csv in out_dir (default: the folder of this script) and write their headers.
+    Yield 3 csv.DictWriter: places, altnames, addresses
+    """
+    if out_dir is None:
+        out_dir = os.path.dirname(os.path.realpath(__file__))
+    fpath_places = os.path.join(out_dir, 'osm_places.csv')
+    fpath_altnames = os.path.join(out_dir, 'osm_altnames.csv')
+    fpath_addresses = os.path.join(out_dir, 'osm_addresses.csv')
     
     csvargs = {'newline': '', 'encoding': 'utf-8'}
     with open(fpath_places,'w', **csvargs) as csv_places,\
@@ -349,31 +925,265 @@ def print_tables(places, altnames, addresses):
          open(fpath_addresses,'w', **csvargs) as csv_addresses:
         
         dwargs = {'delimiter' : ",", 'quotechar' : '"'}        
-        writers = [ csv.DictWriter(csv_places, colnames['places'], **dwargs), 
-                    csv.DictWriter(csv_altnames, colnames['altnames'], **dwargs),
-                    csv.DictWriter(csv_addresses, colnames['addresses'], **dwargs) ]
+        writers = [ csv.DictWriter(csv_places, TABLE_COLNAMES['places'], **dwargs), 
+                    csv.DictWriter(csv_altnames, TABLE_COLNAMES['altnames'], **dwargs),
+                    csv.DictWriter(csv_addresses, TABLE_COLNAMES['addresses'], **dwargs) ]
+        for writer in writers:
+            writer.writeheader()
+        yield writers
+                
+def print_tables(places, altnames, addresses, out_dir=None, admin_areas=None):
+    """ 
+    Print places, altnames, and addresses tables into csv files
+    admin_areas (optional): an adminareas.AdminAreas used to set the municipality and department of the places from their coordinates
+    """       
+    if admin_areas:
+        print('Assigned administrative areas to ' + str(admin_areas.assign(places)) + ' of ' + str(len(places)) + ' places')
+    with open_table_writers(out_dir) as writers:
         tables = [places, altnames, addresses]
-        
         for writer, table in zip(writers, tables):
-            writer.writeheader()
             writer.writerows(table) 
             
-def process_xml(folder_path):
+def print_tables_stream(xml_rows, other_places=(), out_dir=None, admin_areas=None, merger=None):
+    """ 
+    Streaming version of print_tables. Write each (place, altnames, address) of xml_rows (e.g. from process_xml_stream) as soon as it is produced, 
+    then other_places (e.g. places from the shapefiles). The csv files are identical to the ones written by print_tables.
+    admin_areas (optional): see print_tables. The places are then assigned and written in batches of ADMIN_BATCH_SIZE rows.
+    merger (optional): a dedup.PlaceMerger holding the places of the other sources, written instead of other_places. 
+    Its places are merged into the matching places of xml_rows as they are produced, and the others are written at the end.
+    """
+    if merger:
+        xml_rows = iter_merge_duplicates(xml_rows, merger)
+    if admin_areas:
+        xml_rows = iter_assign_admin_areas(xml_rows, admin_areas)
+    with open_table_writers(out_dir) as (places_writer, altnames_writer, addresses_writer):
+        count = 0
+        for place, altnames, address in xml_rows:
+            places_writer.writerow(place)
+            altnames_writer.writerows(altnames)
+            if address:
+                addresses_writer.writerow(address)
+            count += 1
+        if merger:
+            other_places = merger.remaining()
+            print('Merged ' + str(merger.duplicates) + ' duplicate places across sources')
+        if admin_areas:
+            other_places = [dict(place) for place in other_places]
+            admin_areas.assign(other_places)
+        places_writer.writerows(other_places)
+    return count
+            
+def iter_merge_duplicates(rows, merger):
+    """ Yield the (place, altnames, address) of rows, after merging into each place its duplicates from the other sources (see dedup.PlaceMerger) """
+    for place, altnames, address in rows:
+        merger.merge(place)
+        yield place, altnames, address
+
+def iter_assign_admin_areas(rows, admin_areas, batch_size=ADMIN_BATCH_SIZE):
+    """ Yield the (place, altnames, address) of rows, after setting the administrative areas of the places in batches (see print_tables) """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            admin_areas.assign([place for place, altnames, address in batch])
+            yield from batch
+            batch = []
+    admin_areas.assign([place for place, altnames, address in batch])
+    yield from batch
+
+def load_gazetteer():
+    """ Load the gazetteer of the GADM departments and municipalities, or return None if the boundaries are missing """
+    admin_gazetteer = gazetteer.Gazetteer.from_gadm()
+    if admin_gazetteer is None:
+        print('GADM boundaries not found in ' + adminareas.GADM_DIR + ', municipalities and departments of addresses are not resolved')
+    return admin_gazetteer
+
+def load_admin_areas():
+    """ Load the GADM boundaries used to set the municipality and department of the places, or return None if they are missing """
+    admin_areas = adminareas.AdminAreas.from_gadm()
+    if admin_areas is None:
+        print('GADM boundaries not found in ' + adminareas.GADM_DIR + ', municipalities and departments are taken from the tags')
+    return admin_areas
+
+def osm_input_path(folder_path):
+    """ Return the path of nicaragua-latest.osm.pbf in folder_path if it exists, otherwise the path of nicaragua-latest.osm """
+    fpath = os.path.join(folder_path, "nicaragua-latest.osm.pbf")
+    if not os.path.exists(fpath):
+        fpath = os.path.join(folder_path, "nicaragua-latest.osm")
+    return fpath
+
+def process_xml(folder_path, classifier=None, processes=1, state_file=None, ways=False, cache=None, gazetteer=None):
     """ 
-    Parse and transform nicaragua-latest.osm file.
+    Parse and transform nicaragua-latest.osm.pbf or, if there is none, nicaragua-latest.osm file.
+    processes: if greater than 1, parse the file in parallel with this number of worker processes
+    state_file (optional): an open text file where the extraction state is saved, see save_state_amenities()
+    ways: if True, facilities mapped as ways or multipolygon relations are extracted as well, at their centroid
+    cache (optional): a stagecache.StageCache. The facilities are loaded from it if the input file and the rules have not changed.
+    gazetteer (optional): see xml_get_tables
     Return 3 tables: places, altnames, addresses
     """
-    fpath = os.path.join(folder_path, "nicaragua-latest.osm")
-    amenities, count = xml_get_amenities(fpath) 
-    print('nicaragua-latest.osm : Found ' + str(count) + ' facilities \n')
+    fpath = osm_input_path(folder_path)
+    if cache:
+        amenities = cache.get_or_compute('xml', [fpath], lambda: list(osm_iter_amenities(fpath, classifier, processes, ways)), 
+                                         params=(ways, ))
+    else:
+        amenities = osm_iter_amenities(fpath, classifier, processes, ways)
+    if state_file:
+        amenities = save_state_amenities(amenities, state_file)
+    amenities = list(amenities)
+    print(os.path.basename(fpath) + ' : Found ' + str(len(amenities)) + ' facilities \n')
     
-    places, altnames, addresses = xml_get_tables(amenities)    
+    places, altnames, addresses = xml_get_tables(amenities, gazetteer)    
     return places, altnames, addresses
 
-def process_amenities_shp(folder_path):
+def process_xml_stream(folder_path, classifier=None, processes=1, state_file=None, ways=False, gazetteer=None):
+    """ 
+    Streaming version of process_xml. 
+    Return a generator of (place, altnames, address) rows, one per facility found in nicaragua-latest.osm(.pbf)
+    """
+    amenities = osm_iter_amenities(osm_input_path(folder_path), classifier, processes, ways)
+    if state_file:
+        amenities = save_state_amenities(amenities, state_file)
+    return xml_iter_rows(amenities, gazetteer)
+    
+def save_state_amenities(amenities, state_file):
+    """ 
+    Write each amenity dict to the extraction state file as it passes through. 
+    The state file has one JSON object per line: {"amenity": amenity dict} for each facility of the OSM file, in file order, 
+    followed by {"place": place} for each place from the other sources (see save_state_places()). It is the input of update_from_osc().
+    """
+    for amenity in amenities:
+        state_file.write(json.dumps({'amenity' : amenity}, ensure_ascii=False) + '\n')
+        yield amenity
+        
+def save_state_places(places, state_file):
+    """ Write the places of the other data sources (e.g. shapefiles) to the extraction state file """
+    for place in places:
+        state_file.write(json.dumps({'place' : place}, ensure_ascii=False) + '\n')
+        
+def load_state(state_fpath):
+    """ 
+    Load an extraction state file written by main() or update_from_osc(). 
+    Return amenities (an OrderedDict {osm_id: amenity dict}), other_places (a list of place dicts)
+    """
+    amenities = OrderedDict()
+    other_places = []
+    with open(state_fpath, encoding='utf-8') as state_file:
+        for line in state_file:
+            item = json.loads(line)
+            if 'amenity' in item:
+                amenities[item['amenity']['_id']] = item['amenity']
+            else:
+                other_places.append(item['place'])
+    return amenities, other_places
+    
+def osc_iter_nodes(fpath):
+    """ 
+    Iterate over the nodes of an OSM change file (.osc or .osc.gz), releasing each one once it has been used.
+    Yield (action, elem) where action is 'create', 'modify' or 'delete' and elem is the <node> element
+    """
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'rb') as f:
+        depth = 0
+        root = None
+        action = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                elif depth == 1:
+                    action = elem.tag
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 2:
+                if elem.tag == 'node':
+                    yield action, elem
+                elem.clear()
+            elif depth == 1:
+                root.clear()
+                
+def apply_osc(amenities, osc_fpath, classifier=None):
+    """ 
+    Apply the node creations, modifications and deletions of an OSM change file to amenities ({osm_id: amenity dict}, modified in place). 
+    A change is skipped if its version is not newer than the version of the amenity already known.
+    Return a dict counting the changes: {'added' : int, 'updated' : int, 'removed' : int, 'skipped' : int}
+    """
+    if classifier is None:
+        classifier = AmenityClassifier()
+    counts = {'added' : 0, 'updated' : 0, 'removed' : 0, 'skipped' : 0}
+    for action, elem in osc_iter_nodes(osc_fpath):
+        osm_id = elem.get('id')
+        known = amenities.get(osm_id)
+        if known and int(elem.get('version') or 0) <= int(known['created']['version'] or 0):
+            counts['skipped'] += 1
+            continue
+            
+        amenity = None
+        if action != 'delete':
+            amenity_flag, amenity = classifier.classify_element(elem)
+            if not (amenity_flag and classifier.validate(amenity)):
+                amenity = None
+                
+        if amenity:
+            counts['updated' if known else 'added'] += 1
+            amenities[osm_id] = amenity
+        elif known:
+            counts['removed'] += 1
+            del amenities[osm_id]
+    return counts
+    
+def update_from_osc(state_fpath, osc_fpaths, out_dir=None, classifier=None):
+    """ 
+    Update the extraction state, the 3 csv tables (osm_places, osm_altnames, osm_addresses) and their columnar copies with one or more OSM change files (.osc or .osc.gz), 
+    applied in the given order, instead of extracting nicaragua-latest.osm again.
+    The change files are read once; the tables are rewritten from the state, which only holds the facilities.
+    Only node changes are applied; facilities extracted from ways and relations are kept as they are until the next full extraction.
+    Return the number of changes, see apply_osc()
+    """
+    if classifier is None:
+        classifier = AmenityClassifier()
+    amenities, other_places = load_state(state_fpath)
+    
+    total = {'added' : 0, 'updated' : 0, 'removed' : 0, 'skipped' : 0}
+    for osc_fpath in osc_fpaths:
+        counts = apply_osc(amenities, osc_fpath, classifier)
+        print(os.path.basename(osc_fpath) + ' : %(added)d added, %(updated)d updated, %(removed)d removed, %(skipped)d skipped' % counts)
+        for key in total:
+            total[key] += counts[key]
+            
+    # Facilities are kept in osm_id order, as in nicaragua-latest.osm
+    ordered = sorted(amenities.values(), key=lambda amenity: osm_id_sort_key(amenity['_id']))
+    tmp_fpath = state_fpath + '.tmp'
+    with open(tmp_fpath, 'w', encoding='utf-8') as state_file:
+        rows = xml_iter_rows(save_state_amenities(ordered, state_file), load_gazetteer())
+        print_tables_stream(rows, out_dir=out_dir, admin_areas=load_admin_areas(), merger=dedup.PlaceMerger([other_places]))
+        save_state_places(other_places, state_file)
+    os.replace(tmp_fpath, state_fpath)
+    columnar.write_csv_tables(out_dir)
+    return total
+
+def shapefile_paths(shp_fpath):
+    """ Return the paths of the files of a shapefile given without extension """
+    return [shp_fpath + ext for ext in ('.shp', '.shx', '.dbf')]
+
+def rules_version():
+    """ Return a version stamp of the classification rules and of the extraction code, used as part of the keys of the stage cache """
+    rules = [ NAME_KEY_PATTERN, ADDRESS_KEY_PATTERN, ADDRESS_FIELD_RULES, HEALTH_KEY_PATTERN, EDUCATION_KEY_PATTERN,
+              HEALTH_AMENITY_PATTERN, HEALTH_AMENITY_FACILITY_PATTERN, EDUCATION_AMENITY_PATTERN,
+              HEALTH_NAME_PATTERN, EDUCATION_NAME_PATTERN, FACILITY_RULES, EXTRACTION_VERSION ]
+    return hashlib.sha1(repr(rules).encode('utf-8')).hexdigest()[:12]
+
+def process_amenities_shp(folder_path, classifier=None, cache=None):
     """ 
     Transform managua_nicaragua_osm_amenities shapefiles into a data structure similar to places_xml_table
+    cache (optional): a stagecache.StageCache. The places are loaded from it if the shapefiles and the rules have not changed.
     """
+    if cache:
+        return cache.get_or_compute('amenities_shp', shapefile_paths(os.path.join(folder_path, "managua_nicaragua_osm_amenities")), 
+                                    lambda: process_amenities_shp(folder_path, classifier))
+    if classifier is None:
+        classifier = AmenityClassifier()
     places = []
                        
     shp_fpath = os.path.join(folder_path, "managua_nicaragua_osm_amenities")
@@ -392,7 +1202,7 @@ def process_amenities_shp(folder_path):
         # type contains the following values: university, fuel, library, school, hospital, fire_station, police, townhall. However, many health facilities were classified as hospitals even though they are not. Classify facility_type by its name
         if temp_type == 'hospital':
             type = 'health'
-            facility_type = classify_facility_type(name, 'health') if name else None
+            facility_type = classifier.classify_facility(name, 'health') if name else None
         elif temp_type in ['university', 'school'] :
             type = 'education'
             facility_type = temp_type
@@ -416,10 +1226,16 @@ def process_amenities_shp(folder_path):
     print("managua_nicaragua_osm_amenities: " + str(len(places)) + " places found.")
     return places 
 
-def process_buildings_shp(folder_path):
+def process_buildings_shp(folder_path, classifier=None, cache=None):
     """ 
     Transform managua_nicaragua_osm_buildings shapefiles into a data structure similar to xml_places_table
+    cache (optional): a stagecache.StageCache. The places are loaded from it if the shapefiles and the rules have not changed.
     """
+    if cache:
+        return cache.get_or_compute('buildings_shp', shapefile_paths(os.path.join(folder_path, "managua_nicaragua_osm_buildings")), 
+                                    lambda: process_buildings_shp(folder_path, classifier))
+    if classifier is None:
+        classifier = AmenityClassifier()
     places = []
                        
     shp_fpath = os.path.join(folder_path, "managua_nicaragua_osm_buildings")
@@ -439,16 +1255,16 @@ def process_buildings_shp(folder_path):
         temp_type = temp_type.lower()
         if temp_type in ['hospital', 'salud']:
             type = 'health'
-            facility_type = classify_facility_type(name, 'health') if name else None
-        elif get_regexp('education').search(temp_type):
+            facility_type = classifier.classify_facility(name, 'health') if name else None
+        elif classifier.education_name_re.search(temp_type):
             type = 'education'
-            facility_type = classify_facility_type(temp_type, 'education')
+            facility_type = classifier.classify_facility(temp_type, 'education')
         elif temp_type in ['church', 'chapel']:
             type = 'community'
             facility_type = 'church'
         elif temp_type in ['yes', 'no']:
             if name: 
-                type, facility_type = classify_amenity_type(name)
+                type, facility_type = classifier.classify_name(name)
             else:
                 type, facility_type = None, None
         else:
@@ -482,29 +1298,76 @@ def print_man_amenities(managua_amenities):
         writer.writeheader()
         writer.writerows(managua_amenities) 
     
-def main():
+def main(stream=False, processes=1, state_fpath=None, ways=False, cache_dir=None):
     """ 
     Process all data sources and generate 3 tables: osm_places, osm_altnames, osm_addresses, 
-    then print all tables into csv files of the same names
+    then print all tables into csv files of the same names and into columnar copies (see columnar.py)
+    stream: if True, nicaragua-latest.osm is processed in constant memory and its rows are written as they are found
+    processes: number of processes used to parse nicaragua-latest.osm
+    state_fpath: where to save the extraction state used by update_from_osc() (default: osm_state.jsonl next to this script)
+    ways: if True, facilities mapped as ways or multipolygon relations in nicaragua-latest.osm are extracted as well
+    cache_dir: folder of the stage cache (default: .cache next to this script). If False, nothing is cached.
+    The cache is not used for nicaragua-latest.osm in stream mode.
     """
-    # DATA SOURCE #1: nicaragua-latest.osm
-    folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/nicaragua-latest.osm/")
-    places_1, altnames, addresses = process_xml(folder_dir)
-    
-    # DATA SOURCE #2: managua_nicaragua_osm_amenities.shp
-    folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/managua_nicaragua.imposm-shapefiles/")
-    places_2 = process_amenities_shp(folder_dir)
-    
-    # DATA SOURCE #3: managua_nicaragua_osm_buildings.shp
-    folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/managua_nicaragua.imposm-shapefiles/")
-    places_3 = process_buildings_shp(folder_dir)
-    
-    # Combine data sources #1, #2 and #3 then print
-    places_combined = []
-    for places in [places_1, places_2, places_3]:
-        places_combined.extend(places)
-    
-    print_tables(places_combined, altnames, addresses)
+    if state_fpath is None:
+        state_fpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), STATE_FILENAME)
+    cache = None
+    if cache_dir is not False:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache")
+        cache = stagecache.StageCache(cache_dir, version=rules_version())
+    admin_areas = load_admin_areas()
+    admin_gazetteer = load_gazetteer()
+    # The state is written next to the previous one and replaces it only if the extraction succeeds, as in update_from_osc
+    tmp_fpath = state_fpath + '.tmp'
+    with open(tmp_fpath, 'w', encoding='utf-8') as state_file:
+        # DATA SOURCE #1: nicaragua-latest.osm
+        classifier = AmenityClassifier()
+        xml_folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/nicaragua-latest.osm/")
+        if not stream:
+            places_1, altnames, addresses = process_xml(xml_folder_dir, classifier, processes, state_file, ways, cache, admin_gazetteer)
+        
+        # DATA SOURCE #2: managua_nicaragua_osm_amenities.shp
+        folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/managua_nicaragua.imposm-shapefiles/")
+        places_2 = process_amenities_shp(folder_dir, classifier, cache)
+        
+        # DATA SOURCE #3: managua_nicaragua_osm_buildings.shp
+        folder_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "OSM_DATA/managua_nicaragua.imposm-shapefiles/")
+        places_3 = process_buildings_shp(folder_dir, classifier, cache)
+        
+        # Duplicates of data source #3 are merged into #2, then duplicates of #2 and #3 into #1
+        merger = dedup.PlaceMerger([places_2, places_3])
+        if stream:
+            count = print_tables_stream(process_xml_stream(xml_folder_dir, classifier, processes, state_file, ways, admin_gazetteer), 
+                                        admin_areas=admin_areas, merger=merger)
+            print('nicaragua-latest.osm : Found ' + str(count) + ' facilities \n')
+        else:
+            # Combine data sources #1, #2 and #3 then print
+            places_combined = []
+            for place in places_1:
+                merger.merge(place)
+                places_combined.append(place)
+            places_combined.extend(merger.remaining())
+            print('Merged ' + str(merger.duplicates) + ' duplicate places across sources')
+            
+            print_tables(places_combined, altnames, addresses, admin_areas=admin_areas)
+        save_state_places(merger.places, state_file)
+    os.replace(tmp_fpath, state_fpath)
+    columnar.write_csv_tables()
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Extract health and education facilities from OpenStreetMap Nicaragua')
+    parser.add_argument('--stream', action='store_true', help='process nicaragua-latest.osm in constant memory')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes used to parse nicaragua-latest.osm')
+    parser.add_argument('--ways', action='store_true', help='also extract facilities mapped as ways or multipolygon relations')
+    parser.add_argument('--cache-dir', help='folder of the stage cache (default: .cache next to this script)')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the stage cache')
+    parser.add_argument('--osc', nargs='+', metavar='OSC', help='update the tables from these OSM change files (.osc, .osc.gz) instead of a full extraction')
+    parser.add_argument('--state', help='extraction state file (default: %s next to this script)' % STATE_FILENAME)
+    args = parser.parse_args()
+    if args.osc:
+        state_fpath = args.state or os.path.join(os.path.dirname(os.path.realpath(__file__)), STATE_FILENAME)
+        update_from_osc(state_fpath, args.osc)
+    else:
+        main(stream=args.stream, processes=args.processes, state_fpath=args.state, ways=args.ways, 
+             cache_dir=False if args.no_cache else args.cache_dir)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Resolve the free-text municipality and department of addresses (addr:city, addr:district, addr:province tags, with their
+misspellings and variants, e.g. 'Leon', 'MANAGUA', 'Chinandga') to the GADM departments and municipalities and their codes
+(see adminareas.gadm_code).
+
+The names of NIC_adm1 (NAME_1) and NIC_adm2 (NAME_2) are normalized (dedup.normalize_name) and indexed by their character
+trigrams (each word padded with 2 spaces before and 1 after, as in PostgreSQL pg_trgm). A value is looked up first by its
+normalized name in a hash table, then only compared with the names sharing at least one trigram, found in the inverted index.
+Its confidence score is the trigram similarity: shared trigrams / all the trigrams of both names (1 for the same normalized name).
+Resolved values are memoized, so the many repeated values of a table cost one dict lookup each.
+Example:
+  gazetteer = Gazetteer.from_gadm()
+  municipality, department, code, score = gazetteer.resolve('Leon', '')    # ('León', 'León', 'NIC.<ID_1>.<ID_2>' of León, 1.0)
+"""
+
+import os
+
+import shapefile
+
+import adminareas
+import dedup
+
+# Minimum trigram similarity of a name to be resolved
+MIN_SCORE = 0.45
+
+def trigrams(name):
+    """ Return the set of the trigrams of the words of a normalized name (e.g. 'leon' -> {'  l', ' le', 'leo', 'eon', 'on '}) """
+    grams = set()
+    for word in name.split():
+        word = '  ' + word + ' '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+class TrigramIndex(object):
+    """
+    Inverted index of the trigrams of names.
+    names: list of names, normalized or not; min_score: minimum similarity of the names returned by lookup
+    """
+    def __init__(self, names, min_score=MIN_SCORE):
+        self.min_score = min_score
+        self.keys = [dedup.normalize_name(name) for name in names]
+        self.sizes = []
+        self.exact = {}         # normalized name -> number of its first name
+        self.postings = {}      # trigram -> numbers of the names having it, in order
+        for number, key in enumerate(self.keys):
+            grams = trigrams(key)
+            self.sizes.append(len(grams))
+            self.exact.setdefault(key, number)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(number)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def scores(self, name, numbers=None):
+        """ Return {number: trigram similarity} of the names sharing a trigram with name (restricted to numbers if given) """
+        grams = trigrams(dedup.normalize_name(name))
+        shared = {}
+        for gram in grams:
+            for number in self.postings.get(gram, ()):
+                shared[number] = shared.get(number, 0) + 1
+        if numbers is not None:
+            shared = dict((number, count) for number, count in shared.items() if number in numbers)
+        return dict((number, count / float(len(grams) + self.sizes[number] - count)) for number, count in shared.items())
+
+    def lookup(self, name, numbers=None):
+        """
+        Return (number, score) of the name most similar to name, first in order if there are ties (restricted to numbers if given),
+        or (None, 0.) if no name has a score of at least min_score
+        """
+        key = dedup.normalize_name(name)
+        if not key:
+            return None, 0.
+        number = self.exact.get(key)
+        if number is not None and (numbers is None or number in numbers):
+            return number, 1.
+        best, best_score = None, 0.
+        for number, score in self.scores(key, numbers).items():
+            if score >= self.min_score and (score > best_score or (score == best_score and number < best)):
+                best, best_score = number, score
+        return best, best_score
+
+class Gazetteer(object):
+    """
+    Departments and municipalities of Nicaragua, with the trigram indexes of their names.
+    departments: list of (name, code); municipalities: list of (name, department number, code)
+    """
+    def __init__(self, departments, municipalities, min_score=MIN_SCORE):
+        self.departments = departments
+        self.municipalities = municipalities
+        self.department_index = TrigramIndex([name for name, code in departments], min_score)
+        self.municipality_index = TrigramIndex([name for name, department, code in municipalities], min_score)
+        self.department_municipalities = {}     # department number -> set of the numbers of its municipalities
+        for number, (name, department, code) in enumerate(municipalities):
+            self.department_municipalities.setdefault(department, set()).add(number)
+        self.memo = {}
+
+    @classmethod
+    def from_gadm(cls, gadm_dir=adminareas.GADM_DIR, min_score=MIN_SCORE):
+        """ Build the gazetteer from the records of NIC_adm1 and NIC_adm2 in gadm_dir. Return None if they are missing """
+        adm1_fpath = os.path.join(gadm_dir, "NIC_adm1")
+        adm2_fpath = os.path.join(gadm_dir, "NIC_adm2")
+        if not (os.path.exists(adm1_fpath + '.shp') and os.path.exists(adm2_fpath + '.shp')):
+            return None
+        r = shapefile.Reader(adm1_fpath)
+        name_1, id_1 = adminareas.record_field(r, 'NAME_1', 4), adminareas.record_field(r, 'ID_1', 3)
+        departments, department_numbers = [], {}
+        for record in r.records():
+            department_numbers.setdefault(record[id_1], len(departments))
+            departments.append((record[name_1], adminareas.gadm_code(record[id_1])))
+        r.close()
+        r = shapefile.Reader(adm2_fpath)
+        fields = [adminareas.record_field(r, name, default_index) for name, default_index in (('ID_1', 3), ('ID_2', 5), ('NAME_2', 6))]
+        municipalities = []
+        for record in r.records():
+            id_1, id_2, name_2 = [record[i] for i in fields]
+            municipalities.append((name_2, department_numbers.get(id_1), adminareas.gadm_code(id_1, id_2)))
+        r.close()
+        return cls(departments, municipalities, min_score)
+
+    def resolve(self, municipality, department=''):
+        """
+        Resolve free-text municipality and department names (either may be empty).
+        The municipality is looked up among the municipalities of the department if it is resolved, else among all of them.
+        Return (municipality, department, code, score): the GADM names and the code of the municipality if it is resolved,
+        else of the department, else the given names, '' and 0.
+        """
+        if (municipality, department) in self.memo:
+            return self.memo[municipality, department]
+        department_number, department_score = self.department_index.lookup(department)
+        number, score = None, 0.
+        if municipality:
+            if department_number is not None:
+                number, score = self.municipality_index.lookup(municipality, self.department_municipalities.get(department_number, ()))
+            if number is None:
+                number, score = self.municipality_index.lookup(municipality)
+        if number is not None:
+            name, department_number, code = self.municipalities[number]
+            result = (name, self.departments[department_number][0] if department_number is not None else department, code, score)
+        elif department_number is not None:
+            name, code = self.departments[department_number]
+            result = (municipality, name, code, department_score)
+        else:
+            result = (municipality, department, '', 0.)
+        self.memo[municipality, department] = result
+        return result
+
+    def normalize(self, rows):
+        """
+        Replace the municipality and department of rows (dicts, e.g. of osm_places or osm_addresses) by the GADM names they
+        resolve to, and set their gadm_code and gadm_score (rounded to 3 decimals; '' if unresolved). Return the number of rows resolved
+        """
+        count = 0
+        for row in rows:
+            municipality, department, code, score = self.resolve(row.get('municipality') or '', row.get('department') or '')
+            row['municipality'], row['department'] = municipality, department
+            row['gadm_code'], row['gadm_score'] = code, round(score, 3) if code else ''
+            count += bool(code)
+        return count
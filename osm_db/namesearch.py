@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Search places by name in the SQLite database loaded by osmsqlite.py and old/insert_data.py, e.g. 'hosp. bautista' or
+'centro de salud socrates'.
+
+Names of Places and AltNames are indexed in the FTS5 table PlaceNames (see old/create_tables.sql), with accents removed and
+prefix indexes, and kept in sync by triggers whichever loader inserts or deletes the places. Each word of a query matches the
+words starting with it, accents and case ignored. A word that starts no indexed word (a misspelling) is replaced by the most
+similar words of the index vocabulary (difflib). Places are ranked by the best bm25 rank of their names.
+Example:
+  conn = osmsqlite.connect()
+  search_osm_ids(conn, 'hosp. bautista')      # ['123456', ...]
+  search_places(conn, 'centro de salud socrates', limit=5)   # [(placeid, name, source, osm or Google id), ...]
+"""
+
+import re
+import time
+import difflib
+import argparse
+
+import dedup
+import osmsqlite
+
+DEFAULT_LIMIT = 20
+# Number and minimum difflib similarity of the words of the vocabulary replacing a misspelled word
+MAX_CORRECTIONS = 3
+MIN_SIMILARITY = 0.75
+
+def query_words(text):
+    """ Return the words of a query as tokenized by the index (lower case, without accents and punctuation) """
+    return re.findall(r'[^\W_]+', dedup.normalize_name(text))
+
+def create_vocabulary(conn):
+    """ Create the fts5vocab table of the words of PlaceNames, if it does not exist """
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.PlaceNamesVocab USING fts5vocab(main, PlaceNames, 'row');")
+
+def has_prefix(conn, word):
+    """ Return True if an indexed word starts with word """
+    row = conn.execute('SELECT 1 FROM PlaceNamesVocab WHERE term >= ? AND term < ? LIMIT 1;', (word, word + '\U0010ffff')).fetchone()
+    return row is not None
+
+def vocabulary(conn):
+    return [row[0] for row in conn.execute('SELECT term FROM PlaceNamesVocab;')]
+
+def match_expression(conn, text):
+    """ Return the FTS5 MATCH expression of a query: all of its words, as prefixes or replaced by their corrections, or None """
+    create_vocabulary(conn)
+    words = query_words(text)
+    terms, vocab = [], None
+    for word in words:
+        if has_prefix(conn, word):
+            terms.append('"%s"*' % word)
+            continue
+        if vocab is None:
+            vocab = vocabulary(conn)
+        corrections = difflib.get_close_matches(word, vocab, MAX_CORRECTIONS, MIN_SIMILARITY)
+        if not corrections:
+            return None
+        terms.append('(' + ' OR '.join('"%s"' % correction for correction in corrections) + ')')
+    return ' AND '.join(terms) or None
+
+def search_places(conn, text, limit=DEFAULT_LIMIT, source=None):
+    """
+    Return the [(placeid, name, source, source id), ...] of the places whose names match text, best first (at most limit places),
+    only of source if given (e.g. 'OSM'). The source id is the OSM id (OSMMetadata.nodeid) or the Google place id
+    (GoogleMetadata.google_id), or None
+    """
+    expression = match_expression(conn, text)
+    if expression is None:
+        return []
+    query = '''SELECT M.placeid, P.name, P.source, COALESCE(O.nodeid, G.google_id)
+               FROM (SELECT placeid, MIN(rank) AS best FROM PlaceNames WHERE PlaceNames MATCH ? GROUP BY placeid) AS M
+               JOIN Places AS P ON P.placeid = M.placeid
+               LEFT JOIN OSMMetadata AS O ON O.id = M.placeid
+               LEFT JOIN GoogleMetadata AS G ON G.id = M.placeid
+               WHERE ? IS NULL OR P.source = ?
+               ORDER BY M.best, M.placeid LIMIT ?;'''
+    return conn.execute(query, (expression, source, source, limit)).fetchall()
+
+def search_osm_ids(conn, text, limit=DEFAULT_LIMIT):
+    """ Return the osm_ids of the OSM places whose names match text, best first (at most limit ids) """
+    return [source_id for placeid, name, source, source_id in search_places(conn, text, limit, osmsqlite.SOURCE)]
+
+def build_name_index(conn):
+    """ Rebuild PlaceNames from Places and AltNames, e.g. for a database loaded before the index existed. Return the number of names indexed """
+    with conn:
+        conn.execute('DELETE FROM PlaceNames;')
+        conn.execute("INSERT INTO PlaceNames(rowid, name, placeid) SELECT -placeid, name, placeid FROM Places WHERE name IS NOT NULL AND name != '';")
+        conn.execute('INSERT INTO PlaceNames(rowid, name, placeid) SELECT rowid, name, placeid FROM AltNames;')
+    return conn.execute('SELECT COUNT(*) FROM PlaceNames;').fetchone()[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search places by name')
+    parser.add_argument('query', help='name or part of a name, e.g. "hosp. bautista"')
+    parser.add_argument('--db', default=osmsqlite.DB_FPATH, help='SQLite database (default: old/NICA.db)')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help='maximum number of places')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the name index from Places and AltNames first')
+    args = parser.parse_args()
+    conn = osmsqlite.connect(args.db)
+    if args.rebuild:
+        print('%d names indexed' % build_name_index(conn))
+    start = time.time()
+    for placeid, name, source, source_id in search_places(conn, args.query, args.limit):
+        print('%s\t%s\t%s' % (source, source_id, name))
+    print('%.1f ms' % ((time.time() - start) * 1000))
+    conn.close()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal reader of OpenStreetMap PBF files (.osm.pbf), written in pure Python (only the standard library is needed).
+See https://wiki.openstreetmap.org/wiki/PBF_Format for the format.
+
+Nodes are returned in the same view as the <node> elements of an OSM XML file used by extract_osm.py:
+a dictionary of attributes (id, version, timestamp, changeset, uid, user, lat, lon, as strings) and a list of (key, value) tags.
+Example:
+  for offset, size in data_blob_offsets(fpath):
+      for attrib, tags in decode_primitive_block(read_blob(fpath, offset, size)):
+          ...
+"""
+
+import struct
+import time
+import zlib
+
+def read_varint(buf, pos):
+    """ Decode a protobuf varint starting at buf[pos]. Return value, position after the varint """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def iter_fields(buf):
+    """ Iterate over the fields of a protobuf message. Yield (field number, wire type, value) """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type: %d' % wire_type)
+        yield field, wire_type, value
+
+def zigzag(n):
+    """ Decode a zigzag-encoded signed integer (sint32, sint64) """
+    return (n >> 1) ^ -(n & 1)
+
+def unpack_varints(buf):
+    """ Decode a packed repeated field of unsigned varints """
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+def unpack_deltas(buf):
+    """ Decode a packed repeated field of delta-coded sint64 (e.g. DenseNodes.id). Return the absolute values """
+    values = []
+    total = 0
+    for value in unpack_varints(buf):
+        total += zigzag(value)
+        values.append(total)
+    return values
+
+def format_coordinate(nanodegrees):
+    """
+    Format a coordinate given in nanodegrees as in OSM XML files: 7 decimals at most, without trailing zeros (e.g. '12.1365817', '-86.28445')
+    """
+    if nanodegrees % 100:
+        return repr(nanodegrees / 1e9)
+    units = nanodegrees // 100
+    sign = '-' if units < 0 else ''
+    integer, fraction = divmod(abs(units), 10000000)
+    fraction = ('%07d' % fraction).rstrip('0')
+    return sign + str(integer) + ('.' + fraction if fraction else '')
+
+def format_timestamp(milliseconds):
+    """ Format a timestamp in milliseconds since the epoch as in OSM XML files (e.g. '2016-04-20T10:00:00Z') """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(milliseconds // 1000))
+
+def iter_blob_offsets(fpath):
+    """
+    Iterate over the blobs of a PBF file without decoding them.
+    Yield (blob type, offset, size) where offset and size locate the Blob message in the file
+    """
+    with open(fpath, 'rb') as f:
+        while True:
+            header_size = f.read(4)
+            if len(header_size) < 4:
+                break
+            header = f.read(struct.unpack('>I', header_size)[0])
+            blob_type, data_size = None, 0
+            for field, wire_type, value in iter_fields(header):
+                if field == 1:
+                    blob_type = value.decode('utf-8')
+                elif field == 3:
+                    data_size = value
+            offset = f.tell()
+            yield blob_type, offset, data_size
+            f.seek(offset + data_size)
+
+def data_blob_offsets(fpath):
+    """ Return [(offset, size), ...] of the OSMData blobs of a PBF file """
+    return [(offset, size) for blob_type, offset, size in iter_blob_offsets(fpath) if blob_type == 'OSMData']
+
+def read_blob(fpath, offset, size):
+    """ Read the Blob message at offset in a PBF file and return its uncompressed content """
+    with open(fpath, 'rb') as f:
+        f.seek(offset)
+        blob = f.read(size)
+    for field, wire_type, value in iter_fields(blob):
+        if field == 1:   # raw
+            return bytes(value)
+        elif field == 3: # zlib_data
+            return zlib.decompress(value)
+        elif field in (4, 5, 6, 7):
+            raise ValueError('Unsupported PBF blob compression (field %d). Only raw and zlib blobs are supported.' % field)
+    return b''
+
+def decode_primitive_block(data, tagged_only=True):
+    """
+    Decode the nodes of an uncompressed OSMData blob (PrimitiveBlock), plain or dense.
+    tagged_only: if True, nodes without tags are skipped
+    Yield (attrib, tags) for each node, in file order
+    """
+    for kind, id, attrib, tags, extra in iter_block_elements(data, untagged_attrib=not tagged_only):
+        if attrib is not None:
+            yield attrib, tags
+
+def iter_block_elements(data, ways=False, untagged_attrib=False):
+    """
+    Decode the elements of an uncompressed OSMData blob (PrimitiveBlock), in file order. Yield (kind, id, attrib, tags, extra) where
+    - kind = 'node': attrib is None for a node without tags unless untagged_attrib is True; extra = (lat, lon) in nanodegrees
+    - kind = 'way' (only if ways is True): attrib has no lat, lon; extra = the list of node ids
+    - kind = 'relation' (only if ways is True): attrib has no lat, lon; extra = the list of members [(type, id), ...], type being 'node', 'way' or 'relation'
+    """
+    data = memoryview(data)
+    strings = []
+    groups = []
+    granularity, lat_offset, lon_offset, date_granularity = 100, 0, 0, 1000
+    for field, wire_type, value in iter_fields(data):
+        if field == 1:
+            strings = [bytes(s).decode('utf-8') for f, w, s in iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 18:
+            date_granularity = value
+        elif field == 19:
+            lat_offset = _signed(value)
+        elif field == 20:
+            lon_offset = _signed(value)
+
+    block = (strings, granularity, lat_offset, lon_offset, date_granularity)
+    for group in groups:
+        for field, wire_type, value in iter_fields(group):
+            if field == 1:
+                yield _decode_node(value, block, untagged_attrib)
+            elif field == 2:
+                for element in _decode_dense_nodes(value, block, untagged_attrib):
+                    yield element
+            elif field == 3 and ways:
+                yield _decode_way(value, block)
+            elif field == 4 and ways:
+                yield _decode_relation(value, block)
+
+def _signed(value):
+    """ Interpret a decoded varint as a two's complement int64 """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _make_attrib(block, id, lat=None, lon=None, version=None, timestamp=None, changeset=None, uid=None, user_sid=None):
+    strings, granularity, lat_offset, lon_offset, date_granularity = block
+    attrib = { 'id' : str(id) }
+    if lat is not None:
+        attrib['lat'] = format_coordinate(lat)
+        attrib['lon'] = format_coordinate(lon)
+    if version is not None:
+        attrib['version'] = str(version)
+        attrib['timestamp'] = format_timestamp(timestamp * date_granularity)
+        attrib['changeset'] = str(changeset)
+        attrib['uid'] = str(uid)
+        attrib['user'] = strings[user_sid]
+    return attrib
+
+def _info_attrib(block, id, info, lat=None, lon=None):
+    """ Make the attrib of an element given its Info message as a dict {field: value} """
+    if info:
+        return _make_attrib(block, id, lat, lon, _signed(info.get(1, 0)), _signed(info.get(2, 0)), _signed(info.get(3, 0)),
+                            _signed(info.get(4, 0)), info.get(5, 0))
+    return _make_attrib(block, id, lat, lon)
+
+def _decode_node(buf, block, untagged_attrib):
+    strings, granularity, lat_offset, lon_offset = block[:4]
+    id, lat, lon = 0, 0, 0
+    keys, vals, info = [], [], {}
+    for field, wire_type, value in iter_fields(buf):
+        if field == 1:
+            id = zigzag(value)
+        elif field == 2:
+            keys = unpack_varints(value)
+        elif field == 3:
+            vals = unpack_varints(value)
+        elif field == 4:
+            info = dict((f, v) for f, w, v in iter_fields(value))
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    tags = [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    lat, lon = lat_offset + granularity * lat, lon_offset + granularity * lon
+    attrib = _info_attrib(block, id, info, lat, lon) if tags or untagged_attrib else None
+    return 'node', id, attrib, tags, (lat, lon)
+
+def _decode_dense_nodes(buf, block, untagged_attrib):
+    strings, granularity, lat_offset, lon_offset = block[:4]
+    ids, lats, lons, keys_vals, info = [], [], [], [], None
+    for field, wire_type, value in iter_fields(buf):
+        if field == 1:
+            ids = unpack_deltas(value)
+        elif field == 5:
+            info = dict((f, v) for f, w, v in iter_fields(value))
+        elif field == 8:
+            lats = unpack_deltas(value)
+        elif field == 9:
+            lons = unpack_deltas(value)
+        elif field == 10:
+            keys_vals = unpack_varints(value)
+
+    has_info = info is not None and 1 in info
+    if has_info:
+        versions = unpack_varints(info.get(1, b''))
+        timestamps = unpack_deltas(info.get(2, b''))
+        changesets = unpack_deltas(info.get(3, b''))
+        uids = unpack_deltas(info.get(4, b''))
+        user_sids = unpack_deltas(info.get(5, b''))
+
+    pos = 0
+    for i, id in enumerate(ids):
+        tags = []
+        if keys_vals:
+            while keys_vals[pos]:
+                tags.append((strings[keys_vals[pos]], strings[keys_vals[pos + 1]]))
+                pos += 2
+            pos += 1
+        lat, lon = lat_offset + granularity * lats[i], lon_offset + granularity * lons[i]
+        attrib = None
+        if tags or untagged_attrib:
+            if has_info:
+                attrib = _make_attrib(block, id, lat, lon, versions[i], timestamps[i], changesets[i], uids[i], user_sids[i])
+            else:
+                attrib = _make_attrib(block, id, lat, lon)
+        yield 'node', id, attrib, tags, (lat, lon)
+
+def _decode_way(buf, block):
+    strings = block[0]
+    id = 0
+    keys, vals, info, refs = [], [], {}, []
+    for field, wire_type, value in iter_fields(buf):
+        if field == 1:
+            id = _signed(value)
+        elif field == 2:
+            keys = unpack_varints(value)
+        elif field == 3:
+            vals = unpack_varints(value)
+        elif field == 4:
+            info = dict((f, v) for f, w, v in iter_fields(value))
+        elif field == 8:
+            refs = unpack_deltas(value)
+    tags = [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    return 'way', id, _info_attrib(block, id, info), tags, refs
+
+MEMBER_TYPES = ['node', 'way', 'relation']
+
+def _decode_relation(buf, block):
+    strings = block[0]
+    id = 0
+    keys, vals, info, memids, types = [], [], {}, [], []
+    for field, wire_type, value in iter_fields(buf):
+        if field == 1:
+            id = _signed(value)
+        elif field == 2:
+            keys = unpack_varints(value)
+        elif field == 3:
+            vals = unpack_varints(value)
+        elif field == 4:
+            info = dict((f, v) for f, w, v in iter_fields(value))
+        elif field == 9:
+            memids = unpack_deltas(value)
+        elif field == 10:
+            types = unpack_varints(value)
+    tags = [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    members = [(MEMBER_TYPES[type], ref) for type, ref in zip(types, memids)]
+    return 'relation', id, _info_attrib(block, id, info), tags, members
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Load the tables written by extract_osm.py (osm_places, osm_altnames, osm_addresses) and the OSM metadata of the
+facilities (version, timestamp, changeset, uid, user, kept in the extraction state file osm_state.jsonl) into the SQLite
+database of old/create_tables.sql: Places, AltNames, AmenityTypes (type and facility_type, source 'OSM') and OSMMetadata.
+
+Rows are inserted with executemany in batches of BATCH_SIZE, in one transaction that first removes the places of the previous
+load, so that the database always holds one complete extraction. The coordinates of all the Places (OSM and Google) are
+indexed in the R*Tree PlacesRTree, kept in sync by the triggers of the schema, which the bounding box and nearby queries below
+use instead of scanning Places.
+R*Tree boxes are stored as 32-bit floats rounded outwards, so candidates are filtered again on the exact coordinates.
+The names of the places are indexed for namesearch.py by the triggers of the schema.
+Example:
+  conn = connect()
+  load_tables(conn)
+  places = places_in_bbox(conn, 12.0, -86.4, 12.2, -86.1, amtype='hospital')   # [(placeid, name, lat, lng), ...]
+  nearest = nearby_places(conn, 12.13, -86.25, 5.0, amtype='health', limit=3)  # [(placeid, name, lat, lng, km), ...]
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import argparse
+import sqlite3
+
+import spatialindex
+
+FDIR = os.path.dirname(os.path.realpath(__file__))
+SCHEMA_FPATH = os.path.join(os.path.dirname(FDIR), "old", "create_tables.sql")
+DB_FPATH = os.path.join(os.path.dirname(FDIR), "old", "NICA.db")
+STATE_FPATH = os.path.join(FDIR, "osm_state.jsonl")
+SOURCE = 'OSM'
+# Number of rows inserted by each executemany
+BATCH_SIZE = 5000
+PRAGMAS = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL', 'PRAGMA cache_size=-65536', 'PRAGMA temp_store=MEMORY']
+# km per degree of longitude and latitude of the projection of spatialindex, used for the distances of nearby_places
+KM_PER_DEGREE_LON = spatialindex.KM_PER_DEGREE * math.cos(math.radians(spatialindex.LAT0))
+KM_PER_DEGREE_LAT = spatialindex.KM_PER_DEGREE
+
+def connect(db_fpath=DB_FPATH, schema_fpath=SCHEMA_FPATH):
+    """ Open the database db_fpath with the pragmas of the bulk loaders, and create the tables of schema_fpath that do not exist """
+    conn = sqlite3.connect(db_fpath)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with open(schema_fpath, encoding='utf-8') as f:
+        # Lines starting with '.' are commands of the sqlite3 shell (e.g. .open NICA.db)
+        conn.executescript(''.join(line for line in f if not line.startswith('.')))
+    return conn
+
+def read_csv(fpath):
+    with open(fpath, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def read_metadata(state_fpath=STATE_FPATH):
+    """ Return {osm_id: created dict (version, ts, changeset, uid, user)} of the facilities of the extraction state file, {} if it is missing """
+    metadata = {}
+    if not os.path.exists(state_fpath):
+        return metadata
+    with open(state_fpath, encoding='utf-8') as f:
+        for line in f:
+            item = json.loads(line)
+            if 'amenity' in item:
+                metadata[str(item['amenity']['_id'])] = item['amenity'].get('created') or {}
+    return metadata
+
+def batches(rows, size=BATCH_SIZE):
+    """ Yield the lists of size rows of rows (an iterable) """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def delete_source(cur, source=SOURCE):
+    """ Delete the places of a previous load (the places with OSMMetadata) and their rows in the other tables (PlacesRTree by its triggers) """
+    for table in ('AltNames', 'AmenityTypes', 'Places'):
+        cur.execute('DELETE FROM %s WHERE placeid IN (SELECT id FROM OSMMetadata);' % table)
+    cur.execute('DELETE FROM OSMMetadata;')
+
+def iter_rows(places, altnames, addresses, metadata, first_placeid, date_retrieved):
+    """
+    Yield the (Places, OSMMetadata, [AltNames], [AmenityTypes]) rows of each place of places, with consecutive placeids from
+    first_placeid. Places without coordinates and repeated osm_ids are skipped.
+    altnames, addresses: {osm_id: [rows]} and {osm_id: row}; metadata: see read_metadata
+    """
+    placeid = first_placeid
+    seen = set()
+    for place in places:
+        osm_id = place['osm_id']
+        if osm_id in seen or place['lat'] == '' or place['lon'] == '':
+            continue
+        seen.add(osm_id)
+        address = addresses.get(osm_id, {})
+        created = metadata.get(osm_id, {})
+        yield ((placeid, place['name'], float(place['lat']), float(place['lon']), SOURCE, date_retrieved,
+                address.get('full_addr') or None, address.get('postal_code') or None,
+                place['municipality'] or None, place['department'] or None),
+               (placeid, osm_id, created.get('ts'), created.get('user'), created.get('uid'), created.get('version'), created.get('changeset')),
+               [(placeid, name) for name in sorted(set(altname['name'] for altname in altnames.get(osm_id, ()) if altname['name']))],
+               [(placeid, amtype, SOURCE) for amtype in sorted(set((place['type'], place['facility_type'])) - {''})])
+        placeid += 1
+
+def build_spatial_index(conn):
+    """ Rebuild PlacesRTree from the coordinates of all the Places, e.g. for a database loaded before the index existed. Return the number of places indexed """
+    with conn:
+        conn.execute('DELETE FROM PlacesRTree;')
+        conn.execute('''INSERT INTO PlacesRTree(placeid, min_lat, max_lat, min_lng, max_lng)
+                        SELECT placeid, lat, lat, lng, lng FROM Places;''')
+    return conn.execute('SELECT COUNT(*) FROM PlacesRTree;').fetchone()[0]
+
+def load_tables(conn, table_dir=FDIR, state_fpath=STATE_FPATH):
+    """
+    Replace the OSM places of the database by the ones of osm_places.csv, osm_altnames.csv and osm_addresses.csv in table_dir,
+    with the metadata of the extraction state file state_fpath. The spatial index is rebuilt if places loaded before it existed
+    are missing from it. Return the number of places loaded
+    """
+    start = time.time()
+    places_fpath = os.path.join(table_dir, 'osm_places.csv')
+    date_retrieved = time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(places_fpath)))
+    altnames = {}
+    for altname in read_csv(os.path.join(table_dir, 'osm_altnames.csv')):
+        altnames.setdefault(altname['osm_id'], []).append(altname)
+    addresses = {}
+    for address in read_csv(os.path.join(table_dir, 'osm_addresses.csv')):
+        addresses.setdefault(address['osm_id'], address)
+    metadata = read_metadata(state_fpath)
+
+    count = 0
+    with conn:
+        cur = conn.cursor()
+        delete_source(cur)
+        first_placeid = cur.execute('SELECT COALESCE(MAX(placeid), 0) + 1 FROM Places;').fetchone()[0]
+        rows = iter_rows(read_csv(places_fpath), altnames, addresses, metadata, first_placeid, date_retrieved)
+        for batch in batches(rows):
+            cur.executemany('''INSERT INTO Places(placeid, name, lat, lng, source, date_retrieved, address, postalcode, citytown, province)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', [row[0] for row in batch])
+            cur.executemany('''INSERT INTO OSMMetadata(id, nodeid, datatime, author, authorid, version, changeset)
+                               VALUES (?, ?, ?, ?, ?, ?, ?);''', [row[1] for row in batch])
+            cur.executemany('INSERT INTO AltNames(placeid, name) VALUES (?, ?);', [altname for row in batch for altname in row[2]])
+            cur.executemany('INSERT INTO AmenityTypes(placeid, amtype, source) VALUES (?, ?, ?);', [amtype for row in batch for amtype in row[3]])
+            count += len(batch)
+    indexed = conn.execute('SELECT COUNT(*) FROM PlacesRTree;').fetchone()[0]
+    if indexed != conn.execute('SELECT COUNT(*) FROM Places;').fetchone()[0]:
+        indexed = build_spatial_index(conn)
+    print('Loaded %d OSM places (%d places indexed) in %.2f s' % (count, indexed, time.time() - start))
+    return count
+
+def places_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, amtype=None):
+    """ Return the [(placeid, name, lat, lng), ...] of the places inside a box, with amenity type amtype if given, by placeid """
+    query = '''SELECT P.placeid, P.name, P.lat, P.lng FROM PlacesRTree AS R JOIN Places AS P ON P.placeid = R.placeid
+               WHERE R.max_lat >= ? AND R.min_lat <= ? AND R.max_lng >= ? AND R.min_lng <= ?
+                 AND P.lat BETWEEN ? AND ? AND P.lng BETWEEN ? AND ?'''
+    params = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+    if amtype is not None:
+        query += ' AND EXISTS (SELECT 1 FROM AmenityTypes AS A WHERE A.placeid = P.placeid AND A.amtype = ?)'
+        params.append(amtype)
+    return conn.execute(query + ' ORDER BY P.placeid;', params).fetchall()
+
+def nearby_places(conn, lat, lon, radius_km, amtype=None, limit=None):
+    """
+    Return the [(placeid, name, lat, lng, distance in km), ...] of the places within radius_km of (lat, lon), with amenity
+    type amtype if given, nearest first (at most limit places). Distances are computed as in spatialindex
+    """
+    dlat, dlon = radius_km / KM_PER_DEGREE_LAT, radius_km / KM_PER_DEGREE_LON
+    distance2 = '((P.lat - ?) * ?) * ((P.lat - ?) * ?) + ((P.lng - ?) * ?) * ((P.lng - ?) * ?)'
+    query = '''SELECT P.placeid, P.name, P.lat, P.lng, %s AS distance2
+               FROM PlacesRTree AS R JOIN Places AS P ON P.placeid = R.placeid
+               WHERE R.max_lat >= ? AND R.min_lat <= ? AND R.max_lng >= ? AND R.min_lng <= ?''' % distance2
+    params = [lat, KM_PER_DEGREE_LAT] * 2 + [lon, KM_PER_DEGREE_LON] * 2 + [lat - dlat, lat + dlat, lon - dlon, lon + dlon]
+    if amtype is not None:
+        query += ' AND EXISTS (SELECT 1 FROM AmenityTypes AS A WHERE A.placeid = P.placeid AND A.amtype = ?)'
+        params.append(amtype)
+    query += ' AND distance2 <= ? ORDER BY distance2, P.placeid'
+    params.append(radius_km ** 2)
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return [row[:4] + (math.sqrt(row[4]), ) for row in conn.execute(query + ';', params)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load osm_places, osm_altnames and osm_addresses into the SQLite database')
+    parser.add_argument('--db', default=DB_FPATH, help='SQLite database (default: old/NICA.db)')
+    parser.add_argument('--state', default=STATE_FPATH, help='extraction state file with the OSM metadata (default: osm_state.jsonl next to this script)')
+    parser.add_argument('--index-only', action='store_true', help='only rebuild the spatial index, e.g. of a database loaded before it existed')
+    args = parser.parse_args()
+    conn = connect(args.db)
+    if args.index_only:
+        print('%d places indexed' % build_spatial_index(conn))
+    else:
+        load_tables(conn, state_fpath=args.state)
+    conn.close()
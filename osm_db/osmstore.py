@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Compact coordinate stores used to place OSM ways and relations (e.g. hospitals mapped as building outlines) at their centroid.
+
+Coordinates are kept as integers in units of 1e-7 degree (the precision of OSM) in typed arrays,
+i.e. 16 bytes per node instead of a dict of Python objects, so that millions of nodes fit in a few hundred MB.
+Example:
+  resolver = WayResolver()
+  resolver.add_node(1, 121365817, -862844507)
+  ...
+  lat, lon = resolver.add_way(10, [1, 2, 3, 1])
+"""
+
+from array import array
+from bisect import bisect_left
+
+import osmpbf
+
+def to_units(coordinate):
+    """ Convert a coordinate in degrees (float or string) to units of 1e-7 degree """
+    return int(round(float(coordinate) * 1e7))
+
+def format_units(units):
+    """ Format a coordinate in units of 1e-7 degree as in OSM XML files """
+    return osmpbf.format_coordinate(units * 100)
+
+class CoordinateStore(object):
+    """
+    id -> (lat, lon) store backed by three arrays (int64 ids, int32 latitudes and longitudes in units of 1e-7 degree).
+    Ids are expected in increasing order, as in OSM files; lookups are binary searches.
+    If ids are added out of order, the arrays are sorted once before the next lookup.
+    """
+    def __init__(self):
+        self.ids = array('q')
+        self.lats = array('i')
+        self.lons = array('i')
+        self.is_sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, lat, lon):
+        """ Add id with coordinates lat, lon in units of 1e-7 degree """
+        if self.ids and id <= self.ids[-1]:
+            self.is_sorted = False
+        self.ids.append(id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+
+    def sort(self):
+        """ Sort the arrays by id """
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('q', (self.ids[i] for i in order))
+        self.lats = array('i', (self.lats[i] for i in order))
+        self.lons = array('i', (self.lons[i] for i in order))
+        self.is_sorted = True
+
+    def get(self, id):
+        """ Return (lat, lon) of id in units of 1e-7 degree, or None if id is unknown """
+        if not self.is_sorted:
+            self.sort()
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return self.lats[i], self.lons[i]
+        return None
+
+    def centroid(self, ids):
+        """ Return the mean (lat, lon) of the known ids in units of 1e-7 degree, or None if none of them is known """
+        sum_lat, sum_lon, count = 0, 0, 0
+        for id in ids:
+            point = self.get(id)
+            if point:
+                sum_lat += point[0]
+                sum_lon += point[1]
+                count += 1
+        if not count:
+            return None
+        return int(round(sum_lat / count)), int(round(sum_lon / count))
+
+class WayResolver(object):
+    """
+    Resolve the centroids of ways and relations while reading an OSM file in order (nodes, then ways, then relations).
+    The centroid of a way is the mean of its vertices (the closing vertex of a closed way is counted once).
+    The centroid of a relation is the mean of the centroids of its member ways and of its member nodes.
+    """
+    def __init__(self):
+        self.nodes = CoordinateStore()
+        self.ways = CoordinateStore()
+
+    def add_node(self, id, lat, lon):
+        self.nodes.add(id, lat, lon)
+
+    def add_way(self, id, refs):
+        """ Store and return the centroid (lat, lon) of way id, given the ids of its nodes. Return None if none of its nodes is known """
+        if len(refs) > 1 and refs[0] == refs[-1]:
+            refs = refs[:-1]
+        centroid = self.nodes.centroid(refs)
+        if centroid:
+            self.ways.add(id, centroid[0], centroid[1])
+        return centroid
+
+    def relation_centroid(self, members):
+        """ Return the centroid (lat, lon) of a relation given its members [(type, ref), ...], or None if none of its members is known """
+        points = []
+        for type, ref in members:
+            if type == 'way':
+                point = self.ways.get(ref)
+            elif type == 'node':
+                point = self.nodes.get(ref)
+            else:
+                point = None
+            if point:
+                points.append(point)
+        if not points:
+            return None
+        return (int(round(sum(point[0] for point in points) / len(points))),
+                int(round(sum(point[1] for point in points) / len(points))))
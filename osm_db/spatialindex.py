@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index over the extracted places (osm_places), for nearest-facility, radius and bounding box queries.
+
+Coordinates are projected to kilometres with an equirectangular projection centred on Nicaragua
+(error below 1% over the country), then bucketed into a regular grid of square cells.
+All queries take arrays of points (or boxes) and are answered with vectorized NumPy operations, in batches.
+Example:
+  index = PlacesIndex.from_table(columnar.read_table('places'))
+  distances, rows = index.knn(lats, lons, k=3, type='health')
+  counts = index.count_radius(lats, lons, 5.0, type='education')
+"""
+
+import csv
+import math
+
+import numpy as np
+
+# Projection centre (Nicaragua) and mean Earth radius
+LAT0, LON0 = 12.9, -85.2
+KM_PER_DEGREE = 6371.0088 * math.pi / 180
+DEFAULT_CELL_KM = 2.0
+# Number of queries processed at once, to bound the memory used by the candidate pairs
+BATCH_SIZE = 32768
+
+def project(lat, lon):
+    """ Project lat, lon (degrees, arrays) to x, y in km """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    x = (lon - LON0) * (KM_PER_DEGREE * math.cos(math.radians(LAT0)))
+    y = (lat - LAT0) * KM_PER_DEGREE
+    return x, y
+
+def _ring_offsets(r):
+    """ Return the (dx, dy) offsets of the cells at Chebyshev distance r from a cell """
+    if r == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    side = np.arange(-r, r + 1)
+    inner = np.arange(-r + 1, r)
+    dx = np.concatenate([side, side, np.full(len(inner), -r), np.full(len(inner), r)])
+    dy = np.concatenate([np.full(len(side), -r), np.full(len(side), r), inner, inner])
+    return dx, dy
+
+def _expand(starts, counts):
+    """ Return the concatenation of the ranges [start, start + count) """
+    total = counts.sum()
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.arange(total) + np.repeat(starts - (ends - counts), counts)
+
+class GridIndex(object):
+    """
+    Uniform grid over projected points.
+    lat, lon: coordinates of the points (points with NaN coordinates are left out)
+    ids: values returned by the queries for each point (default: the position of the point in lat, lon)
+    cell_km: size of the grid cells, about the typical query radius or distance to the nearest point
+    """
+    def __init__(self, lat, lon, ids=None, cell_km=DEFAULT_CELL_KM):
+        x, y = project(lat, lon)
+        if ids is None:
+            ids = np.arange(len(x))
+        ids = np.asarray(ids)
+        valid = np.isfinite(x) & np.isfinite(y)
+        x, y, ids = x[valid], y[valid], ids[valid]
+        self.cell_km = float(cell_km)
+        if len(x):
+            self.x0, self.y0 = x.min(), y.min()
+            self.nx = int((x.max() - self.x0) // self.cell_km) + 1
+            self.ny = int((y.max() - self.y0) // self.cell_km) + 1
+        else:
+            self.x0, self.y0, self.nx, self.ny = 0.0, 0.0, 1, 1
+
+        # Points sorted by cell; cell c holds the points cell_start[c]:cell_start[c + 1]
+        cells = self._cell_y(y) * self.nx + self._cell_x(x)
+        order = np.argsort(cells, kind='stable')
+        self.x, self.y, self.ids = x[order], y[order], ids[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+
+    def __len__(self):
+        return len(self.x)
+
+    def _cell_x(self, x):
+        return np.clip(np.floor((x - self.x0) / self.cell_km), 0, self.nx - 1).astype(np.int64)
+
+    def _cell_y(self, y):
+        return np.clip(np.floor((y - self.y0) / self.cell_km), 0, self.ny - 1).astype(np.int64)
+
+    def _candidates(self, queries, cx, cy):
+        """
+        Given query numbers and cell coordinates (cells outside the grid are ignored),
+        return the pairs (query number, point position) of the points of these cells
+        """
+        inside = (cx >= 0) & (cx < self.nx) & (cy >= 0) & (cy < self.ny)
+        queries, cells = queries[inside], cy[inside] * self.nx + cx[inside]
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+        return np.repeat(queries, counts), _expand(starts, counts)
+
+    def knn(self, lat, lon, k=1):
+        """
+        Find the k nearest points of each query point.
+        Return distances (km) and ids, arrays of shape (number of queries, k) sorted by distance.
+        If there are fewer than k points, missing neighbours have distance inf and id -1.
+        """
+        qx, qy = project(np.atleast_1d(lat), np.atleast_1d(lon))
+        distances = np.full((len(qx), k), np.inf)
+        positions = np.full((len(qx), k), -1, dtype=np.int64)
+        for start in range(0, len(qx), BATCH_SIZE):
+            batch = slice(start, start + BATCH_SIZE)
+            distances[batch], positions[batch] = self._knn(qx[batch], qy[batch], k)
+        ids = np.where(positions >= 0, self.ids[np.maximum(positions, 0)] if len(self) else -1, -1)
+        return distances, ids
+
+    def _knn(self, qx, qy, k):
+        n = len(qx)
+        best_d = np.full((n, k), np.inf)
+        best_p = np.full((n, k), -1, dtype=np.int64)
+        if not len(self):
+            return best_d, best_p
+        cx, cy = self._cell_x(qx), self._cell_y(qy)
+        # Ring beyond which the whole grid has been searched
+        last_ring = np.maximum.reduce([cx, self.nx - 1 - cx, cy, self.ny - 1 - cy])
+        active = np.arange(n)
+        r = 0
+        while len(active):
+            dx, dy = _ring_offsets(r)
+            queries = np.repeat(active, len(dx))
+            q, p = self._candidates(queries, cx[queries] + np.tile(dx, len(active)), cy[queries] + np.tile(dy, len(active)))
+            if len(q):
+                d = np.hypot(self.x[p] - qx[q], self.y[p] - qy[q])
+                # Merge the candidates with the current k best, keeping the k nearest per query
+                all_q = np.concatenate([np.repeat(active, k), q])
+                all_d = np.concatenate([best_d[active].ravel(), d])
+                all_p = np.concatenate([best_p[active].ravel(), p])
+                order = np.lexsort((all_d, all_q))
+                all_q, all_d, all_p = all_q[order], all_d[order], all_p[order]
+                group_start = np.searchsorted(all_q, all_q, side='left')
+                rank = np.arange(len(all_q)) - group_start
+                keep = rank < k
+                best_d[all_q[keep], rank[keep]] = all_d[keep]
+                best_p[all_q[keep], rank[keep]] = all_p[keep]
+            # Points outside the searched square are at least r cells away
+            done = (best_d[active, k - 1] <= r * self.cell_km) | (r >= last_ring[active])
+            active = active[~done]
+            r += 1
+        return best_d, best_p
+
+    def _radius_pairs(self, qx, qy, radius_km):
+        """ Return (query numbers, point positions, distances) of the points within radius_km of the query points """
+        reach = int(math.ceil(radius_km / self.cell_km))
+        dx, dy = np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))
+        dx, dy = dx.ravel(), dy.ravel()
+        cx, cy = self._cell_x(qx), self._cell_y(qy)
+        queries = np.repeat(np.arange(len(qx)), len(dx))
+        q, p = self._candidates(queries, cx[queries] + np.tile(dx, len(qx)), cy[queries] + np.tile(dy, len(qx)))
+        d = np.hypot(self.x[p] - qx[q], self.y[p] - qy[q])
+        within = d <= radius_km
+        return q[within], p[within], d[within]
+
+    def radius(self, lat, lon, radius_km, return_distance=False):
+        """
+        Find the points within radius_km of each query point.
+        Return a list with, for each query point, the array of ids of these points sorted by distance
+        (and the list of arrays of their distances if return_distance is True)
+        """
+        qx, qy = project(np.atleast_1d(lat), np.atleast_1d(lon))
+        ids, distances = [], []
+        for start in range(0, len(qx), BATCH_SIZE):
+            q, p, d = self._radius_pairs(qx[start:start + BATCH_SIZE], qy[start:start + BATCH_SIZE], radius_km)
+            order = np.lexsort((d, q))
+            q, p, d = q[order], p[order], d[order]
+            bounds = np.searchsorted(q, np.arange(len(qx[start:start + BATCH_SIZE]) + 1))
+            ids.extend(np.split(self.ids[p], bounds[1:-1]))
+            distances.extend(np.split(d, bounds[1:-1]))
+        if return_distance:
+            return ids, distances
+        return ids
+
+    def count_radius(self, lat, lon, radius_km):
+        """ Return the number of points within radius_km of each query point """
+        qx, qy = project(np.atleast_1d(lat), np.atleast_1d(lon))
+        counts = np.zeros(len(qx), dtype=np.int64)
+        for start in range(0, len(qx), BATCH_SIZE):
+            q, p, d = self._radius_pairs(qx[start:start + BATCH_SIZE], qy[start:start + BATCH_SIZE], radius_km)
+            counts[start:start + BATCH_SIZE] = np.bincount(q, minlength=len(qx[start:start + BATCH_SIZE]))
+        return counts
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Find the points inside one or more boxes (arguments are scalars or arrays of the same length).
+        Return a list with, for each box, the array of ids of the points inside it, in no particular order
+        """
+        min_lat, min_lon, max_lat, max_lon = np.broadcast_arrays(*[np.atleast_1d(np.asarray(v, dtype=np.float64))
+                                                                   for v in (min_lat, min_lon, max_lat, max_lon)])
+        x_min, y_min = project(min_lat, min_lon)
+        x_max, y_max = project(max_lat, max_lon)
+        n = len(x_min)
+        if not len(self):
+            return [self.ids[:0] for i in range(n)]
+        # Cell ranges of the boxes, then one (box, cell) pair for each cell of each box
+        cx0, cx1 = self._cell_x(x_min), self._cell_x(x_max)
+        cy0, cy1 = self._cell_y(y_min), self._cell_y(y_max)
+        width = np.maximum(cx1 - cx0 + 1, 0)
+        height = np.maximum(cy1 - cy0 + 1, 0)
+        boxes = np.repeat(np.arange(n), width * height)
+        cell_rank = _expand(np.zeros(n, dtype=np.int64), width * height)
+        cx = cx0[boxes] + cell_rank % width[boxes]
+        cy = cy0[boxes] + cell_rank // width[boxes]
+        q, p = self._candidates(boxes, cx, cy)
+        inside = (self.x[p] >= x_min[q]) & (self.x[p] <= x_max[q]) & (self.y[p] >= y_min[q]) & (self.y[p] <= y_max[q])
+        q, p = q[inside], p[inside]
+        bounds = np.searchsorted(q, np.arange(n + 1))
+        return np.split(self.ids[p], bounds[1:-1])
+
+class PlacesIndex(object):
+    """
+    Spatial index over places, with filters on type and facility_type.
+    Each query accepts type and facility_type (a value or a list of values); a grid index is built and kept
+    for each combination of filters used. Ids returned by the queries are row numbers in lat, lon.
+    """
+    def __init__(self, lat, lon, type=None, facility_type=None, cell_km=DEFAULT_CELL_KM):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.labels = { 'type' : None if type is None else np.asarray(type),
+                        'facility_type' : None if facility_type is None else np.asarray(facility_type) }
+        self.cell_km = cell_km
+        self.indexes = {}
+
+    @classmethod
+    def from_table(cls, table, cell_km=DEFAULT_CELL_KM):
+        """ Build the index from a columnar places table (see columnar.read_table) """
+        return cls(table['lat'], table['lon'], np.array(table.decode('type')), np.array(table.decode('facility_type')), cell_km)
+
+    @classmethod
+    def from_csv(cls, fpath, cell_km=DEFAULT_CELL_KM):
+        """ Build the index from osm_places.csv """
+        with open(fpath, newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        lat = [float(row['lat']) if row['lat'] else np.nan for row in rows]
+        lon = [float(row['lon']) if row['lon'] else np.nan for row in rows]
+        return cls(lat, lon, [row['type'] for row in rows], [row['facility_type'] for row in rows], cell_km)
+
+    def index(self, type=None, facility_type=None):
+        """ Return the GridIndex of the places matching the filters """
+        filters = []
+        for name, value in (('type', type), ('facility_type', facility_type)):
+            if value is not None:
+                if self.labels[name] is None:
+                    raise ValueError('The index was built without ' + name)
+                filters.append((name, (value, ) if isinstance(value, str) else tuple(value)))
+        key = tuple(filters)
+        if key not in self.indexes:
+            mask = np.ones(len(self.lat), dtype=bool)
+            for name, values in filters:
+                mask &= np.isin(self.labels[name], values)
+            rows = np.flatnonzero(mask)
+            self.indexes[key] = GridIndex(self.lat[rows], self.lon[rows], rows, self.cell_km)
+        return self.indexes[key]
+
+    def knn(self, lat, lon, k=1, type=None, facility_type=None):
+        """ See GridIndex.knn """
+        return self.index(type, facility_type).knn(lat, lon, k)
+
+    def radius(self, lat, lon, radius_km, type=None, facility_type=None, return_distance=False):
+        """ See GridIndex.radius """
+        return self.index(type, facility_type).radius(lat, lon, radius_km, return_distance)
+
+    def count_radius(self, lat, lon, radius_km, type=None, facility_type=None):
+        """ See GridIndex.count_radius """
+        return self.index(type, facility_type).count_radius(lat, lon, radius_km)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, type=None, facility_type=None):
+        """ See GridIndex.bbox """
+        return self.index(type, facility_type).bbox(min_lat, min_lon, max_lat, max_lon)
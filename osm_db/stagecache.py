@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the results of the extraction stages (e.g. process_xml, process_amenities_shp in extract_osm.py).
+
+A result is stored under a key derived from the stage name, a fingerprint of each input file, a version stamp
+(e.g. of the classification rules) and the stage parameters, so that a rerun with unchanged inputs and rules loads it
+instead of recomputing it. The least recently used entries are evicted when the cache grows beyond max_bytes.
+Example:
+  cache = StageCache('.cache', version=rules_version())
+  places = cache.get_or_compute('amenities_shp', [shp_path], lambda: process_amenities_shp(folder_path))
+"""
+
+import os
+import hashlib
+import pickle
+
+class StageCache(object):
+    """
+    cache_dir: folder of the cache entries (created if needed)
+    version: version stamp included in every key; changing it invalidates all entries
+    max_bytes: maximum total size of the entries
+    fingerprint: 'stat' to identify an input file by its path, size and modification time (fast),
+                 'hash' to identify it by the SHA-1 of its content (survives copies and touches)
+    """
+    def __init__(self, cache_dir, version='', max_bytes=512 * 1024 * 1024, fingerprint='stat'):
+        if fingerprint not in ('stat', 'hash'):
+            raise ValueError("fingerprint should be 'stat' or 'hash'")
+        self.cache_dir = cache_dir
+        self.version = version
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_fingerprint(self, fpath):
+        """ Return a string identifying the content of fpath """
+        if not os.path.exists(fpath):
+            return 'missing:' + os.path.realpath(fpath)
+        if self.fingerprint == 'hash':
+            sha1 = hashlib.sha1()
+            with open(fpath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+            return 'sha1:' + sha1.hexdigest()
+        stat = os.stat(fpath)
+        return 'stat:%s:%d:%d' % (os.path.realpath(fpath), stat.st_size, stat.st_mtime_ns)
+
+    def key(self, stage, input_paths, params=()):
+        """ Return the cache key of a stage given its input files and parameters """
+        parts = [stage, self.version, repr(params)] + [self.file_fingerprint(fpath) for fpath in input_paths]
+        return stage + '-' + hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def load(self, key):
+        """ Return (True, value) if key is in the cache, (False, None) otherwise """
+        fpath = self.entry_path(key)
+        try:
+            with open(fpath, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(fpath)   # mark as recently used
+        return True, value
+
+    def store(self, key, value):
+        """ Store value under key, then evict the least recently used entries if the cache is too large """
+        fpath = self.entry_path(key)
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fpath, fpath)
+        self.evict(keep=fpath)
+
+    def evict(self, keep=None):
+        """ Delete the least recently used entries until the cache holds at most max_bytes. The entry keep is never deleted. """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.pickle'):
+                stat = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(self.cache_dir, fname)))
+        total = sum(size for mtime, size, fpath in entries)
+        for mtime, size, fpath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fpath != keep:
+                os.remove(fpath)
+                total -= size
+
+    def get_or_compute(self, stage, input_paths, compute, params=()):
+        """ Return the cached result of stage for these inputs and parameters, or compute() it and cache it """
+        key = self.key(stage, input_paths, params)
+        found, value = self.load(key)
+        if found:
+            print(stage + ': loaded from cache')
+            return value
+        value = compute()
+        self.store(key, value)
+        return value
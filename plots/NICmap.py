@@ -8,12 +8,96 @@ Visualization of Nicaragua health care system and socio-economic indicators on m
 import os, sys
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-from matplotlib.collections import LineCollection
+from matplotlib.collections import LineCollection, PolyCollection
 from matplotlib import cm
 from mpl_toolkits.basemap import Basemap
-import shapefile
 import numpy as np
 import csv
+import geomcache
+import density
+
+# Tolerance of the simplification of boundaries, in pixels
+SIMPLIFY_PIXELS = 0.5
+
+# Places extracted by osm_db/extract_osm.py
+PLACES_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "osm_db", "osm_places.csv")
+
+def read_adm_nums(fpath, delimiter=',', skip_rows=1):
+    """
+    Read a csv file of (administrative area, number) rows, skipping the first skip_rows rows (e.g. headers)
+    Return a list of dictionaries {'adm' : str, 'num' : float or None if empty}, as expected by NICBasemap.choropleth
+    """
+    adm_num_dicts = []
+    with open(fpath, encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile, fieldnames = ['adm', 'num'], delimiter=delimiter) 
+        for nrow, row in enumerate(reader):
+            if nrow >= skip_rows:
+                adm_num_dicts.append({'adm' : row['adm'], 'num' : float(row['num']) if row['num'] else None})
+    return adm_num_dicts
+
+def read_places(fpath=PLACES_FPATH, type=None, facility_type=None):
+    """
+    Read the places of osm_db/osm_places.csv which have coordinates, optionally only those of a type ('health', 'education')
+    and of a facility_type (a str or a list of them, e.g. ['hospital', 'clinic'])
+    Return a list of dictionaries (the csv rows, with lat and lon as floats)
+    """
+    if isinstance(facility_type, str):
+        facility_type = [facility_type]
+    places = []
+    with open(fpath, encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if (type and row['type'] != type) or (facility_type and row['facility_type'] not in facility_type):
+                continue
+            try:
+                row['lat'], row['lon'] = float(row['lat']), float(row['lon'])
+            except ValueError:
+                continue
+            places.append(row)
+    return places
+
+def choropleth_colors(adm_num_dicts, adm_names, cmap_base=plt.cm.YlOrRd, bin_lims=None, nbins=5):
+    """
+    Divide the numbers of adm_num_dicts into bins and color the administrative areas named adm_names by bin
+    (see NICBasemap.choropleth for the parameters). Areas without data are white, lakes are aqua.
+    Return (facecolors: (len(adm_names), 4) array of RGBA colors, colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap})
+    """
+    # Divide nums into bins. For each entry in nums, assign to which bin it belongs to, then assign a color to each bin.
+    adms = [item['adm'] for item in adm_num_dicts]
+    nums  = [item['num'] for item in adm_num_dicts]  
+    
+    # Define bin_lims by dividing the range of nums into equally spaced portions
+    if bin_lims:
+        nbins = len(bin_lims)                
+    else:
+        temp_nums = [num for num in nums if num]
+        bin_spacing = (max(temp_nums) - min(temp_nums) + 1) / nbins                
+        bin_lims = np.arange(min(temp_nums), max(temp_nums) + bin_spacing, bin_spacing)
+        nbins = len(bin_lims) 
+        
+    # Use only nbins values from the colormap (cmap)
+    cmaplist = [cmap_base(i) for i in range(cmap_base.N)]
+    del_colors = int(np.ceil(cmap_base.N/float(nbins-1)))
+    map_colors = cmaplist[0::del_colors]
+    map_colors.insert(0, (1.0, 1.0, 1.0, 1.0))             # fill with white if no data (num is None)
+    
+    # Join the data to the areas by name (the first entry of a name is used)
+    adm_idx = {}
+    for idx, adm in enumerate(adms):
+        adm_idx.setdefault(adm, idx)
+    area_nums = np.array([nums[adm_idx[name]] if name in adm_idx and nums[adm_idx[name]] is not None else np.nan 
+                          for name in adm_names], dtype=float)
+    
+    # Assign each area into its respective bin (no data and values out of the bins: 0, i.e. white) and a facecolor to each area 
+    color_ix = np.digitize(area_nums, bin_lims)
+    color_ix[color_ix >= nbins] = 0
+    facecolors = np.array([mpl.colors.to_rgba(color) for color in map_colors])[color_ix]
+    lakes = np.isin(adm_names, ["Lago Nicaragua", "Lago de Nicaragua"])
+    facecolors[lakes] = mpl.colors.to_rgba('aqua')
+    
+    custom_cmap = mpl.colors.ListedColormap(map_colors[1: ], name='from_list')
+    bins = [(i1,i2) for i1,i2 in zip(bin_lims[0:nbins], bin_lims[1:nbins+1])]
+    bin_labels = ["(%d - %d)" % (b[0],b[1]) for b in bins]
+    return facecolors, {'bin_labels' : bin_labels, 'colormap' : custom_cmap}
 
 class NICBasemap(Basemap):
     """
@@ -36,6 +120,13 @@ class NICBasemap(Basemap):
         # Data directory
         self.data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
         
+        # Projected geometry of the shapefile layers, cached on disk
+        self.geometry_cache = geomcache.GeometryCache(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".cache", "geometry"))
+        
+        # Level of detail of the boundaries: vertices closer than SIMPLIFY_PIXELS pixels to the simplified boundary are dropped.
+        # detail_dpi is the DPI of the saved figure (default: the DPI of the figure)
+        self.detail_dpi = None
+        
         # map won't show if this line is omitted
         self.drawmapboundary() 
         
@@ -48,38 +139,57 @@ class NICBasemap(Basemap):
         self.drawmapscale(MAP_SCALE_LON, MAP_SCALE_LAT, MAP_SCALE_LON0,                 MAP_SCALE_LAT0, 
                          MAP_SCALE_LENGTH, barstyle='fancy', fontcolor = '0.3', fillcolor2 = '0.3')
                          
-    def draw_shp_polygons(self, shp_filepath, linewidths=0.2, colors='k', antialiaseds=None, linestyles='solid'):
+    def simplify_tolerance(self, pixels=SIMPLIFY_PIXELS):
+        """
+        Return the length in map units of pixels pixels, given the size of the figure, the position of the axis and detail_dpi
+        """
+        dpi = self.detail_dpi or self.fig.dpi
+        width_in, height_in = self.fig.get_size_inches()
+        position = self.ax.get_position()
+        width_px = width_in * position.width * dpi
+        height_px = height_in * position.height * dpi
+        return pixels * max((self.urcrnrx - self.llcrnrx) / width_px, (self.urcrnry - self.llcrnry) / height_px)
+        
+    def map_units_per_km(self):
+        """
+        Return the number of map units (Mercator metres) per km on the ground at the centre of the map
+        """
+        return 1000. / np.cos(np.radians((self.llcrnrlat + self.urcrnrlat) / 2.))
+        
+    def national_clip_path(self):
+        """
+        Return a patch of the area of the departments (without the lakes), to clip images to the country
+        """
+        layer = self.load_shp_layer(os.path.join(self.data_dir, "NIC_adm/NIC_adm1"))
+        paths = [mpl.path.Path(part, closed=True) 
+                 for record, parts in zip(layer.records, layer.iter_shape_parts()) if record[4] not in ["Lago Nicaragua", "Lago de Nicaragua"]
+                 for part in parts if len(part) > 2]
+        return mpl.patches.PathPatch(mpl.path.Path.make_compound_path(*paths), transform=self.ax.transData)
+        
+    def load_shp_layer(self, shp_filepath, simplify=False):
+        """
+        Return the polygons of a shapefile projected on the map (a geomcache.ShapeLayer), from the geometry cache if possible
+        simplify: if True, the polygons are simplified to the level of detail the figure can show (see simplify_tolerance)
+        """
+        layer = self.geometry_cache.load(shp_filepath, self)
+        if simplify:
+            layer = layer.simplified(self.simplify_tolerance())
+        return layer
+        
+    def draw_shp_polygons(self, shp_filepath, linewidths=0.2, colors='k', antialiaseds=None, linestyles='solid', simplify=True):
         """
         Draw a shapefile containing polygons
+        simplify: if True, draw only the detail the figure can show, without gaps between neighbouring polygons
         """   
-        # Read the shapefile as shapes and records. For each polygon in shapes, draw its boundaries
-        r = shapefile.Reader(shp_filepath)
-        shapes = r.shapes()
-        records = r.records()
-
-        for record, shape in zip(records, shapes):
-            lons, lats = zip(*shape.points)
-            data = [(x, y) for x, y in zip(*self(lons, lats))]
-            
-            # shape.parts is a list containing the starting index of each part of shape (e.g. a lake inside the shape) on xy_pts. If shape contains only 1 part, a list containing 0 is returned.
-            if len(shape.parts) == 1: 
-                segs = [data, ]
-            else:
-                segs = []
-                for npart in range(1, len(shape.parts)):
-                    ix1 = shape.parts[npart-1]
-                    ix2 = shape.parts[npart]
-                    segs.append(data[ix1:ix2])
-                    
-                segs.append(data[ix2: ])
-            
-            lines = LineCollection(segs, antialiaseds = [1, ])
-            lines.set_edgecolors(colors)
-            lines.set_linestyle(linestyles)
-            lines.set_linewidth(linewidths)
-            self.ax.add_collection(lines)
+        # Draw the boundaries of all parts of all polygons (e.g. a lake inside a polygon is a part) as one collection
+        layer = self.load_shp_layer(shp_filepath, simplify)
+        lines = LineCollection(layer.all_parts(), antialiaseds = [1, ])
+        lines.set_edgecolors(colors)
+        lines.set_linestyle(linestyles)
+        lines.set_linewidth(linewidths)
+        self.ax.add_collection(lines)
    
-    def draw_depts(self, source = 'gadm', linewidth=0.4, color='k', antialiaseds=None, linestyle='solid'):
+    def draw_depts(self, source = 'gadm', linewidth=0.4, color='k', antialiaseds=None, linestyle='solid', simplify=True):
         """
         Draw department boundaries.
         """
@@ -90,10 +200,10 @@ class NICBasemap(Basemap):
             fpath = os.path.join(self.data_dir, "OSM/mapanica-nicaragua-departamentos-2015-01-27")
         else:
             print('Source unknown. Using GADM boundaries.')
-        self.draw_shp_polygons(fpath, linewidth, color, linestyles=linestyle)
+        self.draw_shp_polygons(fpath, linewidth, color, linestyles=linestyle, simplify=simplify)
         
         
-    def draw_municipalities(self, source = 'gadm', linewidth=0.2, color='k', antialiaseds=None, linestyle='--'):
+    def draw_municipalities(self, source = 'gadm', linewidth=0.2, color='k', antialiaseds=None, linestyle='--', simplify=True):
         """
         Draw municipality boundaries.
         """
@@ -105,10 +215,10 @@ class NICBasemap(Basemap):
         else:
             print('Source unknown. Using OSM boundaries.')
 
-        self.draw_shp_polygons(fpath, linewidth, color, linestyles=linestyle)
+        self.draw_shp_polygons(fpath, linewidth, color, linestyles=linestyle, simplify=simplify)
         
 
-    def choropleth(self, adm_num_dicts, level = 'department', source='gadm', cmap_base=plt.cm.YlOrRd, ret_colormap_and_label=True, bin_lims=None, nbins=5, linewidth=0.4):
+    def choropleth(self, adm_num_dicts, level = 'department', source='gadm', cmap_base=plt.cm.YlOrRd, ret_colormap_and_label=True, bin_lims=None, nbins=5, linewidth=0.4, simplify=True):
         """
         A choropleth map by department  or municipality. The dataset for boundaries of administrative areas is taken from GADM database 
         Original code is from here: https://github.com/astivim/Nicaragua-Population-Density-Map    
@@ -119,31 +229,10 @@ class NICBasemap(Basemap):
         - nbins (optional): number of bins, default = 5. Ignored if bin_lims is specified. 
         - cmap_base: base colormap. Default is plt.cm.YlOrRd (red)  
         - ret_colormap_and_label=True. If True, return colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap} used for plotting. If False, colormap_label = None  
+        - simplify: if True, draw only the detail the figure can show, without gaps between neighbouring polygons
 
         Return: colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap}
         """	
-        # Divide nums into bins. For each entry in nums, assign to which bin it belongs to, then assign a color to each bin.
-        
-        adms = [item['adm'] for item in adm_num_dicts]
-        nums  = [item['num'] for item in adm_num_dicts]  
-        
-        # Define bin_lims by dividing the range of nums into equally spaced portions
-        if bin_lims:
-            nbins = len(bin_lims)                
-        else:
-            temp_nums = [num for num in nums if num]
-            bin_spacing = (max(temp_nums) - min(temp_nums) + 1) / nbins                
-            bin_lims = np.arange(min(temp_nums), max(temp_nums) + bin_spacing, bin_spacing)
-            nbins = len(bin_lims) 
-            
-        # Assign each num in nums into its respective bin and assign color. Use only nbins values from the colormap (cmap)
-        nums_bin_ix = np.digitize(nums, bin_lims)      
-        nums_bin_ix = [idx if idx < nbins else 0 for idx in nums_bin_ix]    
-        cmaplist = [cmap_base(i) for i in range(cmap_base.N)]
-        del_colors = np.int(np.ceil(cmap_base.N/float(nbins-1)))
-        map_colors = cmaplist[0::del_colors]
-        map_colors.insert(0, (1.0, 1.0, 1.0, 1.0))             # fill with white if no data (num is None)
-        
         # Load the geographical data (shapefile and record)
         if level == 'department':
             fpath = os.path.join(self.data_dir, "NIC_adm/NIC_adm1")
@@ -153,54 +242,107 @@ class NICBasemap(Basemap):
             print("Level unrecognized. Use 'department'")
             fpath = os.path.join(self.data_dir, "NIC_adm/NIC_adm1")
             
-        r = shapefile.Reader(fpath)
-        shapes = r.shapes()
-        records = r.records()
-        
-        # Extract lat and lon data from the GADM shapefile and assign a facecolor to each department 
-        for record, shape in zip(records, shapes):
-            lons, lats = zip(*shape.points)
-            data = [(lon, lat) for lon, lat in zip(*self(lons, lats))]
-            if level == 'department':
-                adm_name = record[4]
-            else:
-                adm_name = record[6]
-            
-            try:
-                adm_idx = adms.index(adm_name)
-                adm_num = adm_num_dicts[adm_idx]['num']
-                color_idx = nums_bin_ix[adm_idx] 
-            except ValueError:
-                adm_num = None
-                color_idx = 0
-
-            if len(shape.parts) == 1:
-                segs = [data, ]
-            else:
-                segs = []
-                for i in range(1,len(shape.parts)):
-                    index = shape.parts[i-1]
-                    index2 = shape.parts[i]
-                    segs.append(data[index:index2])
-                
-                segs.append(data[index2:])
-            lines = LineCollection(segs, antialiaseds=(1,))            
-            
-            color = map_colors[color_idx] if adm_name not in ["Lago Nicaragua", "Lago de Nicaragua"] else 'aqua'
-            lines.set_facecolors(color)
-            lines.set_linewidth(linewidth)
-            self.ax.add_collection(lines)
-        
-        if ret_colormap_and_label:
-            custom_cmap = mpl.colors.ListedColormap(map_colors[1: ], name='from_list')
-            bins = [(i1,i2) for i1,i2 in zip(bin_lims[0:nbins], bin_lims[1:nbins+1])]
-            bin_labels = ["(%d - %d)" % (b[0],b[1]) for b in bins]
-            colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap}
-        else:
+        layer = self.load_shp_layer(fpath, simplify)
+        
+        # Join the data to the records of the GADM shapefile by name and color each record
+        name_field = 4 if level == 'department' else 6
+        adm_names = [record[name_field] for record in layer.records]
+        facecolors, colormap_label = choropleth_colors(adm_num_dicts, adm_names, cmap_base, bin_lims, nbins)
+        
+        # Draw all parts of all polygons as one collection, each part with the facecolor of its polygon
+        parts_per_record = np.diff(layer.shapes)
+        polygons = PolyCollection(layer.all_parts(), facecolors=np.repeat(facecolors, parts_per_record, axis=0), 
+                                  edgecolors=mpl.rcParams['lines.color'], linewidths=linewidth, antialiaseds=(1,))
+        self.ax.add_collection(polygons)
+        
+        if not ret_colormap_and_label:
             colormap_label = None
         
         return colormap_label
         
+    def facility_density(self, places=None, type='health', facility_type=None, weights=None, bandwidth_km=10., cell_km=1., 
+                         cmap_base=plt.cm.YlOrRd, bin_lims=None, nbins=5, alpha=0.9):
+        """
+        A density map of facilities (number of facilities per km^2, smoothed with a Gaussian kernel), clipped to the country.
+        
+        Input:
+        - places (optional): a list of places as returned by read_places. Default: the places of osm_places.csv of type and facility_type 
+        - type, facility_type: filters of the places of osm_places.csv, see read_places
+        - weights (optional): a dictionary {facility_type : weight} (e.g. {'hospital' : 5}, other facility types weigh 1), or a list of weights of the places
+        - bandwidth_km: standard deviation of the Gaussian kernel, in km. cell_km: size of the cells of the density grid, in km
+        - bin_lims, nbins (optional): bins of the densities (facilities per km^2), see draw_binned_image
+        
+        Return: colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap}, see add_colorbar
+        """
+        if places is None:
+            places = read_places(PLACES_FPATH, type, facility_type)
+        if isinstance(weights, dict):
+            weights = [weights.get(place['facility_type'], 1.) for place in places]
+        x, y = self([place['lon'] for place in places], [place['lat'] for place in places])
+        
+        # Density per km^2 on a grid covering the map, drawn clipped to the area of the departments
+        units_per_km = self.map_units_per_km()
+        extent = (self.llcrnrx, self.urcrnrx, self.llcrnry, self.urcrnry)
+        grid = density.kde_grid(x, y, extent, cell_km * units_per_km, bandwidth_km * units_per_km, weights) * units_per_km ** 2
+        
+        rows, cols = grid.shape
+        image_extent = (extent[0], extent[0] + cols * cell_km * units_per_km, extent[2], extent[2] + rows * cell_km * units_per_km)
+        return self.draw_binned_image(grid, image_extent, cmap_base, bin_lims, nbins, alpha)
+        
+    def draw_raster(self, raster, extent=None, cmap_base=plt.cm.YlOrRd, bin_lims=None, nbins=5, alpha=0.9):
+        """
+        Draw a raster of longitude and latitude cells (e.g. the distance to the nearest facility written by osm_db/coverage.py), clipped to the country.
+        
+        Input:
+        - raster: a (rows, columns) array, row 0 at the south and NaN where there is no data, or the path of a .npz file with raster and extent arrays
+        - extent: (lon min, lon max, lat min, lat max) of the raster. Ignored if raster is a path.
+        - bin_lims, nbins (optional): bins of the values, see draw_binned_image
+        
+        Return: colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap}, see add_colorbar
+        """
+        if isinstance(raster, str):
+            with np.load(raster) as arrays:
+                raster, extent = arrays['raster'], tuple(arrays['extent'])
+        lon_min, lon_max, lat_min, lat_max = extent
+        rows = raster.shape[0]
+        
+        # Rows are evenly spaced in latitude, not in projected y: take for each row of the image the raster row at its latitude
+        lon_mid = (lon_min + lon_max) / 2.
+        row_lats = lat_min + (np.arange(rows) + 0.5) * (lat_max - lat_min) / rows
+        row_y = self(np.full(rows, lon_mid), row_lats)[1]
+        x_min, y_min = self(lon_min, lat_min)
+        x_max, y_max = self(lon_max, lat_max)
+        image_y = y_min + (np.arange(rows) + 0.5) * (y_max - y_min) / rows
+        image_rows = np.rint(np.interp(image_y, row_y, np.arange(rows))).astype(int)
+        return self.draw_binned_image(raster[image_rows], (x_min, x_max, y_min, y_max), cmap_base, bin_lims, nbins, alpha)
+        
+    def draw_binned_image(self, grid, image_extent, cmap_base=plt.cm.YlOrRd, bin_lims=None, nbins=5, alpha=0.9):
+        """
+        Draw a grid of values (row 0 at the bottom) covering image_extent = (x min, x max, y min, y max) in map units,
+        colored by bin and clipped to the area of the departments.
+        - bin_lims (optional): values of bin edges (values below the first edge and NaN are not drawn, values above the last one are in the last bin)
+        - nbins (optional): number of bins between 0 and the maximum value, default = 5. Ignored if bin_lims is specified.
+        
+        Return: colormap_label = {'bin_labels' : bin_labels, 'colormap' : custom_cmap}, see add_colorbar
+        """
+        # Divide the values into bins, each with a color of the colormap
+        if bin_lims is None:
+            bin_lims = np.linspace(0, np.nanmax(grid), nbins + 1)
+        bin_lims = np.asarray(bin_lims, dtype=float)
+        nbins = len(bin_lims) - 1
+        color_ix = np.ma.masked_where(~np.isfinite(grid) | (grid < bin_lims[0]), np.digitize(grid, bin_lims) - 1)
+        color_ix = np.ma.minimum(color_ix, nbins - 1)
+        custom_cmap = mpl.colors.ListedColormap(cmap_base(np.linspace(0, 1, nbins)), name='from_list')
+        
+        image = self.ax.imshow(color_ix, cmap=custom_cmap, vmin=-0.5, vmax=nbins - 0.5, origin='lower', extent=image_extent, 
+                               interpolation='nearest', alpha=alpha)
+        image.set_clip_path(self.national_clip_path())
+        self.ax.set_xlim(self.llcrnrx, self.urcrnrx)
+        self.ax.set_ylim(self.llcrnry, self.urcrnry)
+        
+        bin_labels = ["(%.3g - %.3g)" % (b0, b1) for b0, b1 in zip(bin_lims[:-1], bin_lims[1:])]
+        return {'bin_labels' : bin_labels, 'colormap' : custom_cmap}
+        
     def add_colorbar(self, colorbar, ax_pos = [0.83, 0.1, 0.02, 0.8]):
         """
         Add a colorbar with position and dimension defined by ax_pos
@@ -224,7 +366,7 @@ class NICBasemap(Basemap):
             xticks = [TickSpacing*x-delta for x in range(1,numbins+1)]
             cb.set_ticks(xticks)
             cb.ax.tick_params(color='k',labelcolor='k')
-            cb.set_ticklabels(bin_labels, update_ticks=True)
+            cb.set_ticklabels(bin_labels)
             cb.outline.set_edgecolor('k')
         
     def show_reference(self, txt_source):
@@ -246,12 +388,7 @@ class NICBasemap(Basemap):
         Plot a choropleth map of maternal mortality rate by department (per 100,000). Source:  The Nicaraguan Health System, PATH, 2011
         """
         fpath = os.path.join(self.data_dir, "PATH_Maternal_Mortality_GADM_ADM1.csv") 
-        dept_num_dicts = []
-        with open(fpath, encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile, fieldnames = ['adm', 'num'], delimiter=';') 
-            for nrow, row in enumerate(reader):
-                if nrow > 4:
-                    dept_num_dicts.append({'adm' : row['adm'], 'num' : float(row['num'])})
+        dept_num_dicts = read_adm_nums(fpath, delimiter=';', skip_rows=5)
         
         colorbar = self.choropleth(dept_num_dicts, level='department', nbins=4)
         self.add_colorbar(colorbar)
@@ -264,12 +401,7 @@ class NICBasemap(Basemap):
         Plot a choropleth map of population density by municipality. Source: OpenStreetMap
         """
         fpath = os.path.join(self.data_dir, "Population/Population_Density_by_Municipality.csv") 
-        dept_num_dicts = []
-        with open(fpath, encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile, fieldnames = ['adm', 'num'], delimiter=',', ) 
-            for nrow, row in enumerate(reader):
-                if nrow > 0:
-                    dept_num_dicts.append({'adm' : row['adm'], 'num' : float(row['num']) if row['num'] else None})   
+        dept_num_dicts = read_adm_nums(fpath, delimiter=',', skip_rows=1)
                     
         binlims = [3, 50, 100, 200, 500, 1000, 2000, 3000, 4000]
         colorbar = self.choropleth(dept_num_dicts, level='municipality', bin_lims = binlims, linewidth=0)
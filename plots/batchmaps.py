@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Render many choropleth maps (e.g. the indicator maps of a report) in parallel.
+
+Maps are described by specifications (a JSON list of objects), for example:
+  [ {"csv": "Population/Population_Density_by_Municipality.csv", "level": "municipality",
+     "bin_lims": [3, 50, 100, 200, 500, 1000, 2000, 3000, 4000], "linewidth": 0,
+     "title": "Nicaragua \\nPopulation Density \\nper km^2", "reference": "Source: OpenStreetMap. Retrieved: Nov 2015",
+     "boundaries": ["depts"], "output": "Population_Density_by_Municipality.png"} ]
+Keys:
+- csv: data file of (administrative area, number) rows, relative to plots/data/; delimiter (default ','), skip_rows (default 1)
+- level: 'department' or 'municipality'; bin_lims or nbins; linewidth (optional), see NICBasemap.choropleth
+- title, reference (optional); boundaries (optional): list of 'depts', 'municipalities' drawn over the choropleth
+- output: image file, relative to the folder of the specification file; dpi (default 200), size (default [10, 8] inches)
+
+Each worker process uses the non-interactive Agg backend and builds the base map (Basemap, scale, cached boundary layers)
+once; the layers added by a map are removed after it is saved, so the next map reuses the base map.
+Run: python batchmaps.py report_maps.json --processes 4
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+
+DEFAULT_DPI = 200
+DEFAULT_SIZE = [10, 8]
+
+_worker_map = None
+
+def get_worker_map():
+    """ Return the base map of this process, created on first use """
+    global _worker_map
+    if _worker_map is None:
+        import NICmap
+        _worker_map = NICmap.NICBasemap()
+        # Layers of the base map, kept between maps
+        _worker_map.base_artists = set(_worker_map.ax.get_children())
+        _worker_map.base_axes = list(_worker_map.fig.axes)
+    return _worker_map
+
+def clear_map(map):
+    """ Remove what was drawn on the base map since it was created (choropleth, colorbar, texts, ...) """
+    for ax in map.fig.axes:
+        if ax not in map.base_axes:
+            map.fig.delaxes(ax)
+    for artist in map.ax.get_children():
+        if artist not in map.base_artists:
+            artist.remove()
+
+def render_map(spec):
+    """ Render a map specification (see the module documentation) with the base map of this process. Return (output path, seconds) """
+    import NICmap
+    start = time.time()
+    map = get_worker_map()
+    try:
+        map.fig.set_size_inches(spec.get('size', DEFAULT_SIZE), forward=True)
+        map.detail_dpi = spec.get('dpi', DEFAULT_DPI)
+        fpath = os.path.join(map.data_dir, spec['csv'])
+        adm_num_dicts = NICmap.read_adm_nums(fpath, spec.get('delimiter', ','), spec.get('skip_rows', 1))
+        colorbar = map.choropleth(adm_num_dicts, level=spec.get('level', 'department'), bin_lims=spec.get('bin_lims'),
+                                  nbins=spec.get('nbins', 5), linewidth=spec.get('linewidth', 0.4))
+        map.add_colorbar(colorbar)
+        for boundaries in spec.get('boundaries', []):
+            if boundaries == 'depts':
+                map.draw_depts()
+            elif boundaries == 'municipalities':
+                map.draw_municipalities()
+        if spec.get('title'):
+            map.show_title(spec['title'])
+        if spec.get('reference'):
+            map.show_reference(spec['reference'])
+        map.fig.savefig(spec['output'], bbox_inches='tight', dpi=spec.get('dpi', DEFAULT_DPI))
+    finally:
+        clear_map(map)
+    return spec['output'], time.time() - start
+
+def load_specs(spec_fpath):
+    """ Load a JSON list of map specifications; outputs are made relative to the folder of spec_fpath """
+    with open(spec_fpath, encoding='utf-8') as f:
+        specs = json.load(f)
+    spec_dir = os.path.dirname(os.path.realpath(spec_fpath))
+    for spec in specs:
+        spec['output'] = os.path.join(spec_dir, spec['output'])
+    return specs
+
+def render_maps(specs, processes=None):
+    """
+    Render map specifications with processes worker processes (default: the number of CPUs; 1: in this process).
+    Return [(output path, seconds), ...] in the order of specs
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(specs))
+    if processes <= 1:
+        return [render_map(spec) for spec in specs]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(render_map, specs, chunksize=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render map specifications in parallel')
+    parser.add_argument('specs', help='JSON file with a list of map specifications')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+    start = time.time()
+    for output, seconds in render_maps(load_specs(args.specs), args.processes):
+        print('%s: %.1f s' % (output, seconds))
+    print('Total: %.1f s' % (time.time() - start))
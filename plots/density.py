@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Binned kernel density estimation of points (e.g. facilities) on a regular grid of projected coordinates.
+
+Points are first distributed over the 4 nearest grid nodes (linear binning), then the grid is convolved with a Gaussian
+kernel by FFT. The cost depends on the size of the grid (n log n), not on the number of points times the number of cells,
+so that a national grid at 1 km with thousands of facilities takes a fraction of a second.
+Example:
+  grid = kde_grid(x, y, (xmin, xmax, ymin, ymax), cell_size=1000., bandwidth=10000.)
+  # grid[i, j]: sum of the weights per unit area around (xmin + (j + 0.5) * cell_size, ymin + (i + 0.5) * cell_size)
+"""
+
+import math
+
+import numpy as np
+
+# The grid is padded with this number of bandwidths, so that the circular convolution of the FFT does not wrap densities around
+PAD_BANDWIDTHS = 4
+
+def grid_shape(extent, cell_size):
+    """ Return the (rows, columns) of a grid of cells of cell_size covering extent = (xmin, xmax, ymin, ymax) """
+    xmin, xmax, ymin, ymax = extent
+    return max(int(math.ceil((ymax - ymin) / cell_size)), 1), max(int(math.ceil((xmax - xmin) / cell_size)), 1)
+
+def linear_binning(x, y, extent, cell_size, weights=None):
+    """
+    Distribute the weights of the points (x, y) over the centres of the cells of a grid covering extent, in proportion to
+    their proximity (bilinear interpolation weights). Points outside the grid are dropped.
+    Return the (rows, columns) grid of the binned weights
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=np.float64)
+    rows, cols = grid_shape(extent, cell_size)
+    # Position of the points in cells, relative to the centre of the first cell
+    gx = (x - extent[0]) / cell_size - 0.5
+    gy = (y - extent[2]) / cell_size - 0.5
+    ix, iy = np.floor(gx).astype(np.int64), np.floor(gy).astype(np.int64)
+    fx, fy = gx - ix, gy - iy
+    grid = np.zeros(rows * cols)
+    for dx, dy, w in ((0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)), (0, 1, (1 - fx) * fy), (1, 1, fx * fy)):
+        cx, cy = ix + dx, iy + dy
+        inside = (cx >= 0) & (cx < cols) & (cy >= 0) & (cy < rows)
+        grid += np.bincount(cy[inside] * cols + cx[inside], weights=(weights * w)[inside], minlength=rows * cols)
+    return grid.reshape(rows, cols)
+
+def fast_fft_size(n):
+    """ Return the smallest integer >= n whose prime factors are 2, 3 and 5 (fast FFT sizes) """
+    best = 2 ** int(math.ceil(math.log2(max(n, 1))))
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            size = power35
+            while size < n:
+                size *= 2
+            best = min(best, size)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+def gaussian_smooth(grid, sigma):
+    """ Convolve grid with a Gaussian kernel of standard deviation sigma (in cells) by FFT; the sum of the grid is preserved """
+    if sigma <= 0:
+        return grid.copy()
+    pad = int(math.ceil(PAD_BANDWIDTHS * sigma))
+    shape = (fast_fft_size(grid.shape[0] + pad), fast_fft_size(grid.shape[1] + pad))
+    # Fourier transform of the Gaussian kernel, in cycles per cell
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    kernel = np.exp(-2 * np.pi ** 2 * sigma ** 2 * (fx ** 2 + fy ** 2))
+    smoothed = np.fft.irfft2(np.fft.rfft2(grid, shape) * kernel, shape)[:grid.shape[0], :grid.shape[1]]
+    return np.maximum(smoothed, 0)
+
+def kde_grid(x, y, extent, cell_size, bandwidth, weights=None):
+    """
+    Gaussian kernel density of the points (x, y) with optional weights, on a grid of cells of cell_size covering
+    extent = (xmin, xmax, ymin, ymax). bandwidth: standard deviation of the kernel, in the units of x and y.
+    Return the (rows, columns) grid of the density (sum of the weights per unit area); row 0 is at ymin
+    """
+    grid = linear_binning(x, y, extent, cell_size, weights)
+    return gaussian_smooth(grid, bandwidth / cell_size) / cell_size ** 2
+
+def scott_bandwidth(x, y):
+    """ Scott's rule of thumb bandwidth of 2D points: n^(-1/6) times the mean standard deviation of the coordinates """
+    n = len(x)
+    if n < 2:
+        return 0.
+    return n ** (-1. / 6) * (np.std(x, ddof=1) + np.std(y, ddof=1)) / 2
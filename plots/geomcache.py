@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the projected geometry of shapefile layers drawn by NICmap.NICBasemap.
+
+The vertices of all polygons of a shapefile are projected once, with a single vectorized call to the map projection,
+and saved as NumPy arrays (.npz) with the records (.json) and the simplification importance of the vertices (see simplify.py).
+The cache key is made of the shapefile path, the modification times and sizes of its files, and the projection parameters
+of the map, so a cached layer is reused until the shapefile or the projection changes.
+Example:
+  cache = GeometryCache(cache_dir)
+  layer = cache.load(shp_fpath, map)
+  for segs in layer.iter_shape_parts():
+      ...
+"""
+
+import os
+import json
+import math
+import hashlib
+
+import numpy as np
+import shapefile
+
+import simplify
+
+# Version of the cached arrays, part of the cache keys
+CACHE_VERSION = 2
+
+class ShapeLayer(object):
+    """
+    Projected polygons of a shapefile.
+    xy: (number of vertices, 2) array of projected coordinates
+    parts: offsets of the parts (rings) of all shapes into xy, of length number of parts + 1
+    shapes: offsets of the parts of each shape into parts, of length number of shapes + 1
+    records: the records of the shapes (lists of values)
+    importance: the simplification importance of each vertex (see simplify.vertex_importance), computed if not given
+    """
+    def __init__(self, xy, parts, shapes, records, importance=None):
+        self.xy = xy
+        self.parts = parts
+        self.shapes = shapes
+        self.records = records
+        self.importance = simplify.vertex_importance(xy, parts) if importance is None else importance
+        self.levels = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def shape_parts(self, i):
+        """ Return the list of the (n, 2) vertex arrays of the parts of shape i """
+        return [self.xy[self.parts[j]:self.parts[j + 1]] for j in range(self.shapes[i], self.shapes[i + 1])]
+
+    def iter_shape_parts(self):
+        """ Yield the list of the vertex arrays of the parts of each shape """
+        for i in range(len(self)):
+            yield self.shape_parts(i)
+
+    def all_parts(self):
+        """ Return the list of the vertex arrays of the parts of all shapes """
+        return [self.xy[start:end] for start, end in zip(self.parts[:-1], self.parts[1:])]
+
+    def simplified(self, tolerance):
+        """
+        Return the layer simplified with a tolerance (in projected units) without gaps between neighbouring polygons.
+        Levels are kept for tolerances rounded down to a power of sqrt(2), so that close tolerances share a level.
+        """
+        if tolerance <= 0:
+            return self
+        level = math.floor(2 * math.log2(tolerance))
+        if level not in self.levels:
+            xy, parts = simplify.simplify_parts(self.xy, self.parts, self.importance, 2 ** (level / 2.))
+            self.levels[level] = ShapeLayer(xy, parts, self.shapes, self.records, np.full(len(xy), np.inf))
+        return self.levels[level]
+
+def projection_params(basemap):
+    """ Return a string identifying the projection of a Basemap (projection parameters and map corners) """
+    params = sorted((str(key), str(value)) for key, value in getattr(basemap, 'projparams', {}).items())
+    corners = [getattr(basemap, name, None) for name in ('llcrnrlon', 'llcrnrlat', 'urcrnrlon', 'urcrnrlat')]
+    return repr((params, corners))
+
+def read_layer(shp_fpath, project):
+    """
+    Read a shapefile and project its vertices with project(lons, lats) -> (x, y), called once with arrays of all vertices.
+    Return a ShapeLayer
+    """
+    r = shapefile.Reader(shp_fpath)
+    points, parts, shapes, records = [], [0], [0], []
+    count = 0
+    for record, shape in zip(r.records(), r.shapes()):
+        starts = list(shape.parts) if shape.points else []
+        for start, end in zip(starts, starts[1:] + [len(shape.points)]):
+            parts.append(count + end)
+        points.extend(shape.points)
+        count += len(shape.points)
+        shapes.append(len(parts) - 1)
+        records.append(list(record))
+    lonlat = np.array(points, dtype=np.float64).reshape(-1, 2)
+    x, y = project(lonlat[:, 0], lonlat[:, 1])
+    xy = np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+    return ShapeLayer(xy, np.array(parts, dtype=np.int64), np.array(shapes, dtype=np.int64), records)
+
+class GeometryCache(object):
+    """
+    Projected layers, kept in memory and in cache_dir (created if needed)
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.layers = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, shp_fpath, basemap):
+        """ Return the cache key of a shapefile (path without extension) projected by basemap """
+        parts = [str(CACHE_VERSION), os.path.realpath(shp_fpath), projection_params(basemap)]
+        for ext in ('.shp', '.shx', '.dbf'):
+            if os.path.exists(shp_fpath + ext):
+                stat = os.stat(shp_fpath + ext)
+                parts.append('%s:%d:%d' % (ext, stat.st_size, stat.st_mtime_ns))
+        return os.path.basename(shp_fpath) + '-' + hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def load(self, shp_fpath, basemap):
+        """ Return the ShapeLayer of a shapefile (path without extension) projected by basemap, from the cache if possible """
+        key = self.key(shp_fpath, basemap)
+        if key in self.layers:
+            return self.layers[key]
+        fpath = os.path.join(self.cache_dir, key)
+        try:
+            arrays = np.load(fpath + '.npz')
+            with open(fpath + '.json', encoding='utf-8') as f:
+                records = json.load(f)
+            layer = ShapeLayer(arrays['xy'], arrays['parts'], arrays['shapes'], records, arrays['importance'])
+        except (OSError, ValueError, KeyError):
+            layer = read_layer(shp_fpath, basemap)
+            # Write the records first: the arrays file marks a complete entry
+            with open(fpath + '.json', 'w', encoding='utf-8') as f:
+                json.dump(layer.records, f, ensure_ascii=False, default=str)
+            with open(fpath + '.tmp.npz', 'wb') as f:
+                np.savez(f, xy=layer.xy, parts=layer.parts, shapes=layer.shapes, importance=layer.importance)
+            os.replace(fpath + '.tmp.npz', fpath + '.npz')
+        self.layers[key] = layer
+        return layer
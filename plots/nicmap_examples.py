@@ -11,10 +11,19 @@ FIG_WIDTH_IN = 10
 FIG_HEIGHT_IN = 8 
 map = NICmap.NICBasemap()     
 map.fig.set_size_inches((FIG_WIDTH_IN, FIG_HEIGHT_IN), forward=True)
+map.detail_dpi = 200     # the figure is saved with dpi=200
 
 # Maternal mortality rate per 100,000 
 # map.maternal_mortality_by_dept()
 
+# Density of health facilities per km^2 (hospitals weigh as 5 facilities)
+# colorbar = map.facility_density(type='health', weights={'hospital' : 5}, bandwidth_km=10)
+# map.add_colorbar(colorbar)
+
+# Distance to the nearest hospital in km (run osm_db/coverage.py first)
+# colorbar = map.draw_raster(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../osm_db/coverage_hospital.npz"), bin_lims=[0, 5, 10, 20, 40, 80])
+# map.add_colorbar(colorbar)
+
 # Population Density by Municipality
 map.population_density_by_municipality()
 
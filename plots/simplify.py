@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Topology-preserving simplification of polygon layers (see geomcache.ShapeLayer).
+
+The rings of all polygons are split into arcs at their junctions (vertices where the boundary shared by
+neighbouring polygons starts or ends). Each arc is ranked once with the Douglas-Peucker algorithm: the importance of
+a vertex is the distance at which Douglas-Peucker would keep it. An arc shared by two polygons gets the same
+importances in both, so that simplifying with any tolerance leaves no gap or overlap between neighbours.
+Since importances are computed once, a simplified level is just the vertices whose importance exceeds the tolerance.
+Example:
+  importance = vertex_importance(layer.xy, layer.parts)
+  xy, parts = simplify_parts(layer.xy, layer.parts, importance, tolerance)
+"""
+
+import numpy as np
+
+# Minimum number of distinct vertices kept in each ring
+MIN_RING_VERTICES = 3
+
+def vertex_ids(xy):
+    """ Return an integer id for each vertex of xy, equal for vertices with the same coordinates """
+    if not len(xy):
+        return np.zeros(0, dtype=np.int64)
+    xy = np.ascontiguousarray(xy, dtype=np.float64)
+    keys = xy.view(np.dtype((np.void, xy.dtype.itemsize * 2))).ravel()
+    ids = np.unique(keys, return_inverse=True)[1]
+    return ids.ravel().astype(np.int64)
+
+def ring_ranges(parts, ids):
+    """
+    Yield (start, end, closed) for each ring: start:end are its distinct vertices and closed tells if
+    it is followed by a closing vertex (at end, equal to the vertex at start)
+    """
+    for start, end in zip(parts[:-1], parts[1:]):
+        closed = end - start > 1 and ids[start] == ids[end - 1]
+        yield start, end - 1 if closed else end, closed
+
+def find_junctions(parts, ids):
+    """
+    Return a boolean array marking the junctions: vertices found in several rings with different neighbours,
+    i.e. where the part of the boundary shared by some polygons starts or ends
+    """
+    vertices, neighbour_min, neighbour_max = [], [], []
+    for start, end, closed in ring_ranges(parts, ids):
+        ring = ids[start:end]
+        if not len(ring):
+            continue
+        prev, nxt = np.roll(ring, 1), np.roll(ring, -1)
+        vertices.append(ring)
+        neighbour_min.append(np.minimum(prev, nxt))
+        neighbour_max.append(np.maximum(prev, nxt))
+    junctions = np.zeros(len(ids), dtype=bool)
+    if not vertices:
+        return junctions
+    vertices, neighbour_min, neighbour_max = [np.concatenate(c) for c in (vertices, neighbour_min, neighbour_max)]
+    distinct = np.unique(np.column_stack([vertices, neighbour_min, neighbour_max]), axis=0)
+    junction_ids = np.flatnonzero(np.bincount(distinct[:, 0], minlength=ids.max() + 1) > 1)
+    junctions[np.isin(ids, junction_ids)] = True
+    return junctions
+
+def point_segment_distance(points, a, b):
+    """ Distance of points (n, 2) to the segment [a, b] """
+    ab = b - a
+    length2 = ab.dot(ab)
+    if length2 == 0:
+        return np.hypot(*(points - a).T)
+    t = np.clip((points - a).dot(ab) / length2, 0, 1)
+    return np.hypot(*(points - a - t[:, None] * ab).T)
+
+def douglas_peucker_importance(points):
+    """
+    Return the Douglas-Peucker importance of each vertex of a polyline (the two ends: inf).
+    The importance of a vertex is at most the importance of the vertex that split the segment it belongs to,
+    so that the vertices kept for a tolerance are exactly those with importance >= tolerance.
+    """
+    n = len(points)
+    importance = np.full(n, np.inf)
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        distances = point_segment_distance(points[first + 1:last], points[first], points[last])
+        k = int(np.argmax(distances))
+        importance[first + 1 + k] = min(distances[k], parent)
+        stack.append((first, first + 1 + k, importance[first + 1 + k]))
+        stack.append((first + 1 + k, last, importance[first + 1 + k]))
+    return importance
+
+def vertex_importance(xy, parts):
+    """
+    Return the importance of each vertex of the rings of xy (see geomcache.ShapeLayer), equal on the arcs shared by several rings.
+    Junctions have importance inf. The closing vertex of a ring has the importance of the first one.
+    """
+    ids = vertex_ids(xy)
+    junctions = find_junctions(parts, ids)
+    importance = np.full(len(xy), np.inf)
+    arc_importance = {}
+    for start, end, closed in ring_ranges(parts, ids):
+        n = end - start
+        if n < 3:
+            continue
+        ring = ids[start:end]
+        cuts = np.flatnonzero(junctions[start:end])
+        if not len(cuts):
+            # Ring without junction: one closed arc from its smallest vertex id, in the direction of its smallest neighbour
+            first = int(np.argmin(ring))
+            step = 1 if ring[(first + 1) % n] <= ring[first - 1] else -1
+            order = (first + step * np.arange(n + 1)) % n
+            arcs = [order]
+        else:
+            order = np.concatenate([np.arange(cuts[0], n), np.arange(0, cuts[0] + 1)])
+            cut_positions = np.flatnonzero(junctions[start:end][order])
+            arcs = [order[i:j + 1] for i, j in zip(cut_positions[:-1], cut_positions[1:])]
+        for arc in arcs:
+            arc_ids = ring[arc]
+            # Arcs are ranked in a canonical direction, so that shared arcs get the same importances
+            if (arc_ids[-1], arc_ids[-2]) < (arc_ids[0], arc_ids[1]):
+                arc, arc_ids = arc[::-1], arc_ids[::-1]
+            key = arc_ids.tobytes()
+            if key not in arc_importance:
+                arc_importance[key] = douglas_peucker_importance(xy[start + arc])
+            interior = arc[1:-1]
+            importance[start + interior] = arc_importance[key][1:-1]
+            if not len(cuts):
+                importance[start + arc[0]] = np.inf
+        if closed:
+            importance[end] = importance[start]
+    return importance
+
+def simplify_parts(xy, parts, importance, tolerance, min_vertices=MIN_RING_VERTICES):
+    """
+    Keep the vertices with importance >= tolerance. Each ring keeps at least its min_vertices most important vertices and stays closed.
+    Return the simplified xy and parts
+    """
+    keep = importance >= tolerance
+    new_xy, new_parts = [], [0]
+    for start, end in zip(parts[:-1], parts[1:]):
+        closed = end - start > 1 and np.array_equal(xy[start], xy[end - 1])
+        ring_end = end - 1 if closed else end
+        ring_keep = keep[start:ring_end].copy()
+        if ring_keep.sum() < min_vertices:
+            ranks = np.argsort(-importance[start:ring_end], kind='stable')[:min_vertices]
+            ring_keep[ranks] = True
+        ring = xy[start:ring_end][ring_keep]
+        if closed and len(ring):
+            ring = np.concatenate([ring, ring[:1]])
+        new_xy.append(ring)
+        new_parts.append(new_parts[-1] + len(ring))
+    if not new_xy:
+        return xy[:0], np.array(new_parts, dtype=np.int64)
+    return np.concatenate(new_xy), np.array(new_parts, dtype=np.int64)
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Slippy map tiles of the NICmap layers (boundaries, choropleth, facility points), to pan and zoom the maps in a browser.
+
+Tiles are 256x256 PNG images in Web Mercator (EPSG:3857) addressed by zoom/x/y, like the tiles of OpenStreetMap, with a
+transparent background so that they can be shown over any base map. Layers are drawn with matplotlib (Agg): the figure of a zoom
+level is built once, with the boundaries simplified to the pixel size of the zoom (see simplify.py), and each tile is a view of it.
+Rendered tiles are kept in an on-disk cache (plots/.cache/tiles) of bounded size, the least recently used tiles being deleted first.
+The cache of a set of layers is identified by a key made of the layers, their data and the shapefiles, so changing a layer
+never serves stale tiles.
+Example:
+  renderer = TileRenderer()
+  renderer.add_choropleth(NICmap.read_adm_nums(fpath), level='municipality', bin_lims=[3, 50, 100, 200, 500, 1000])
+  renderer.add_boundaries('department')
+  places = NICmap.read_places(type='health')
+  renderer.add_facilities([place['lat'] for place in places], [place['lon'] for place in places])
+  seed(renderer, TileCache(TILE_CACHE_DIR), zooms=range(6, 11), processes=4)
+  serve(renderer, TileCache(TILE_CACHE_DIR), port=8000)
+Run: python tiles.py seed --zooms 6-10 --processes 4 [--spec report_maps.json --index 1]
+     python tiles.py serve --port 8000 [--spec report_maps.json --index 1]
+The tiles are then at http://localhost:8000/{z}/{x}/{y}.png, e.g. for Leaflet: L.tileLayer('http://localhost:8000/{z}/{x}/{y}.png')
+"""
+
+import os
+import io
+import re
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+import multiprocessing
+import http.server
+
+import numpy as np
+import matplotlib as mpl
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+
+import geomcache
+
+# Version of the rendering, part of the cache keys
+TILE_VERSION = 1
+TILE_SIZE = 256
+TILE_DPI = 100
+EARTH_RADIUS = 6378137.
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+MAX_LATITUDE = 85.0511287798
+# Bounding box of Nicaragua (lon, lat), as in NICmap.NICBasemap
+NIC_BBOX = (-88., 10.5, -81.89, 15.33)
+# Tolerance of the simplification of boundaries, in pixels
+SIMPLIFY_PIXELS = 0.5
+# Margin around the data, in pixels, within which tiles are drawn (line widths and markers overflow the data)
+MARGIN_PIXELS = 8
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+# Fraction of max_bytes left in the cache by an eviction, so that the cache is not scanned at each new tile
+EVICT_TO = 0.9
+MAX_ZOOM = 20
+
+PLOTS_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA_DIR = os.path.join(PLOTS_DIR, "data/")
+GEOMETRY_CACHE_DIR = os.path.join(PLOTS_DIR, ".cache", "geometry")
+TILE_CACHE_DIR = os.path.join(PLOTS_DIR, ".cache", "tiles")
+ADM_FPATHS = {'department': "NIC_adm/NIC_adm1", 'municipality': "NIC_adm/NIC_adm2"}
+
+class WebMercator(object):
+    """ The spherical Mercator projection of web maps, in metres. Can be used instead of a Basemap by geomcache """
+    projparams = {'proj': 'merc', 'a': EARTH_RADIUS, 'b': EARTH_RADIUS, 'lon_0': 0, 'lat_ts': 0}
+
+    def __call__(self, lons, lats):
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.clip(np.asarray(lats, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+        return EARTH_RADIUS * np.radians(lons), EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lats) / 2))
+
+def tile_bounds(z, x, y):
+    """ Return (xmin, ymin, xmax, ymax) of tile z/x/y in Web Mercator metres (y of tiles grows southwards) """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    return -ORIGIN_SHIFT + x * size, ORIGIN_SHIFT - (y + 1) * size, -ORIGIN_SHIFT + (x + 1) * size, ORIGIN_SHIFT - y * size
+
+def lonlat_to_tile(lon, lat, z):
+    """ Return the (x, y) of the tile of zoom z containing the point (lon, lat) """
+    mx, my = WebMercator()(lon, lat)
+    n = 2 ** z
+    x = int((mx + ORIGIN_SHIFT) / (2 * ORIGIN_SHIFT) * n)
+    y = int((ORIGIN_SHIFT - my) / (2 * ORIGIN_SHIFT) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tiles_in_bbox(z, bbox=NIC_BBOX):
+    """ Return the list of the tiles (z, x, y) of zoom z covering bbox = (lon min, lat min, lon max, lat max) """
+    xmin, ymax = lonlat_to_tile(bbox[0], bbox[1], z)
+    xmax, ymin = lonlat_to_tile(bbox[2], bbox[3], z)
+    return [(z, x, y) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+class TileRenderer(object):
+    """
+    Layers drawn on the tiles, in the order they are added (see add_choropleth, add_boundaries, add_facilities)
+    data_dir: directory of the GADM shapefiles (NIC_adm/), by default plots/data/
+    """
+    def __init__(self, data_dir=DATA_DIR, geometry_cache_dir=GEOMETRY_CACHE_DIR):
+        self.data_dir = data_dir
+        self.projection = WebMercator()
+        self.geometry_cache = geomcache.GeometryCache(geometry_cache_dir)
+        self.layers = []        # (kind, parameters) of the layers
+        self.key_parts = [str(TILE_VERSION)]
+        self.bounds = None      # (xmin, ymin, xmax, ymax) of the data of all layers
+        self.figures = {}       # zoom -> (figure, axis) with all the layers
+        self.blank = None       # PNG image of the tiles without data
+
+    def __getstate__(self):
+        # Figures are not sent to worker processes; each process builds its own
+        state = dict(self.__dict__)
+        state['figures'] = {}
+        state['blank'] = None
+        return state
+
+    def adm_layer(self, level):
+        """ Return the projected shapefile of a level ('department' or 'municipality') and its geometry cache key """
+        fpath = os.path.join(self.data_dir, ADM_FPATHS[level])
+        return self.geometry_cache.load(fpath, self.projection), self.geometry_cache.key(fpath, self.projection)
+
+    def add_layer(self, kind, params, xy, key_parts):
+        self.layers.append((kind, params))
+        self.key_parts.append(repr((kind, key_parts)))
+        if len(xy):
+            bounds = np.concatenate([xy.min(axis=0), xy.max(axis=0)])
+            if self.bounds is not None:
+                bounds = np.concatenate([np.minimum(self.bounds[:2], bounds[:2]), np.maximum(self.bounds[2:], bounds[2:])])
+            self.bounds = bounds
+        self.figures = {}
+
+    def add_boundaries(self, level='department', linewidth=0.4, color='k', linestyle='solid'):
+        """ Add the boundaries of the departments or municipalities (level) """
+        layer, layer_key = self.adm_layer(level)
+        params = {'level': level, 'linewidth': linewidth, 'color': color, 'linestyle': linestyle}
+        self.add_layer('boundaries', params, layer.xy, [layer_key] + sorted(params.items()))
+
+    def add_choropleth(self, adm_num_dicts, level='department', bin_lims=None, nbins=5, linewidth=0.4, cmap_base=None):
+        """ Add a choropleth of the departments or municipalities (level), see NICmap.NICBasemap.choropleth. Return colormap_label """
+        import NICmap
+        layer, layer_key = self.adm_layer(level)
+        name_field = 4 if level == 'department' else 6
+        adm_names = [record[name_field] for record in layer.records]
+        facecolors, colormap_label = NICmap.choropleth_colors(adm_num_dicts, adm_names, cmap_base or mpl.cm.YlOrRd, bin_lims, nbins)
+        params = {'level': level, 'facecolors': facecolors, 'linewidth': linewidth}
+        self.add_layer('choropleth', params, layer.xy, [layer_key, hashlib.sha1(facecolors.tobytes()).hexdigest(), linewidth])
+        return colormap_label
+
+    def add_facilities(self, lats, lons, color='b', markersize=3):
+        """ Add points (e.g. the places returned by NICmap.read_places) drawn as markers of markersize points """
+        x, y = self.projection(lons, lats)
+        xy = np.column_stack([x, y])
+        params = {'xy': xy, 'color': color, 'markersize': markersize}
+        self.add_layer('facilities', params, xy, [hashlib.sha1(xy.tobytes()).hexdigest(), color, markersize])
+
+    def key(self):
+        """ Return the key of the tiles of these layers """
+        return hashlib.sha1('\n'.join(self.key_parts).encode('utf-8')).hexdigest()[:16]
+
+    def figure(self, z):
+        """ Return the (figure, axis) of zoom z with all the layers, drawn at the level of detail of the zoom """
+        if z not in self.figures:
+            tolerance = SIMPLIFY_PIXELS * 2 * ORIGIN_SHIFT / (TILE_SIZE * 2 ** z)
+            fig = Figure(figsize=(TILE_SIZE / TILE_DPI, TILE_SIZE / TILE_DPI), dpi=TILE_DPI)
+            FigureCanvasAgg(fig)
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.axis("off")
+            for kind, params in self.layers:
+                if kind == 'boundaries':
+                    layer = self.adm_layer(params['level'])[0].simplified(tolerance)
+                    ax.add_collection(LineCollection(layer.all_parts(), colors=params['color'], linewidths=params['linewidth'],
+                                                     linestyles=params['linestyle'], antialiaseds=(1,)))
+                elif kind == 'choropleth':
+                    layer = self.adm_layer(params['level'])[0].simplified(tolerance)
+                    facecolors = np.repeat(params['facecolors'], np.diff(layer.shapes), axis=0)
+                    ax.add_collection(PolyCollection(layer.all_parts(), facecolors=facecolors, edgecolors=mpl.rcParams['lines.color'],
+                                                     linewidths=params['linewidth'], antialiaseds=(1,)))
+                elif kind == 'facilities':
+                    ax.plot(params['xy'][:, 0], params['xy'][:, 1], linestyle='none', marker='o',
+                            markersize=params['markersize'], color=params['color'])
+            self.figures[z] = (fig, ax)
+        return self.figures[z]
+
+    def is_empty(self, z, x, y):
+        """ True if tile z/x/y is away from the data of all layers """
+        if self.bounds is None:
+            return True
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        margin = MARGIN_PIXELS * (xmax - xmin) / TILE_SIZE
+        return xmax < self.bounds[0] - margin or xmin > self.bounds[2] + margin or \
+               ymax < self.bounds[1] - margin or ymin > self.bounds[3] + margin
+
+    def render(self, z, x, y):
+        """ Return the PNG image (bytes) of tile z/x/y """
+        if self.is_empty(z, x, y):
+            if self.blank is None:
+                self.blank = self.save_png(Figure(figsize=(TILE_SIZE / TILE_DPI, TILE_SIZE / TILE_DPI), dpi=TILE_DPI))
+            return self.blank
+        fig, ax = self.figure(z)
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        return self.save_png(fig)
+
+    def save_png(self, fig):
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=TILE_DPI, transparent=True)
+        return buf.getvalue()
+
+class TileCache(object):
+    """
+    Tiles in cache_dir/<layers key>/z/x/y.png, at most max_bytes: the least recently used tiles are deleted first
+    (the modification time of a tile is updated each time it is read)
+    """
+    def __init__(self, cache_dir=TILE_CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fpath(self, key, z, x, y):
+        return os.path.join(self.cache_dir, key, str(z), str(x), '%d.png' % y)
+
+    def get(self, key, z, x, y):
+        """ Return the cached tile or None """
+        fpath = self.fpath(key, z, x, y)
+        try:
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            os.utime(fpath)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, z, x, y, data):
+        """ Store a tile, then evict tiles if the cache is larger than max_bytes """
+        fpath = self.fpath(key, z, x, y)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fpath + '.tmp', fpath)
+        if self.size is None:
+            self.size = sum(size for mtime, size, path in self.entries())
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """ Return the list of (modification time, size, path) of the cached tiles """
+        entries = []
+        for dirpath, dirnames, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                if fname.endswith('.png'):
+                    stat = os.stat(os.path.join(dirpath, fname))
+                    entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(dirpath, fname)))
+        return entries
+
+    def evict(self):
+        """ Delete the least recently used tiles until the cache holds at most EVICT_TO * max_bytes """
+        entries = self.entries()
+        total = sum(size for mtime, size, fpath in entries)
+        for mtime, size, fpath in sorted(entries):
+            if total <= EVICT_TO * self.max_bytes:
+                break
+            os.remove(fpath)
+            total -= size
+        self.size = total
+
+def get_tile(renderer, cache, z, x, y, key=None):
+    """ Return tile z/x/y from the cache, or render it and cache it """
+    key = key or renderer.key()
+    data = cache.get(key, z, x, y)
+    if data is None:
+        data = renderer.render(z, x, y)
+        cache.put(key, z, x, y, data)
+    return data
+
+_worker_renderer = None
+
+def init_seed_worker(renderer):
+    global _worker_renderer
+    _worker_renderer = renderer
+
+def seed_tile(tile):
+    """ Worker of seed: return (tile, PNG image) """
+    return tile, _worker_renderer.render(*tile)
+
+def seed(renderer, cache, zooms, bbox=NIC_BBOX, processes=None):
+    """
+    Render the tiles of zooms covering bbox which are not cached yet, with processes worker processes (default: the number of CPUs; 1: in this process).
+    Tiles are rendered by the workers and written to the cache by this process. Return the number of rendered tiles
+    """
+    key = renderer.key()
+    tiles = [tile for z in zooms for tile in tiles_in_bbox(z, bbox) if not os.path.exists(cache.fpath(key, *tile))]
+    processes = min(processes or multiprocessing.cpu_count(), max(len(tiles), 1))
+    start = time.time()
+    if processes <= 1:
+        rendered = ((tile, renderer.render(*tile)) for tile in tiles)
+        for tile, data in rendered:
+            cache.put(key, *tile, data)
+    else:
+        with multiprocessing.Pool(processes, initializer=init_seed_worker, initargs=(renderer,)) as pool:
+            # Tiles are sent in chunks of neighbouring tiles of the same zoom, so that each worker builds few zoom figures
+            for tile, data in pool.imap_unordered(seed_tile, tiles, chunksize=16):
+                cache.put(key, *tile, data)
+    print('Seeded %d tiles in %.1f s' % (len(tiles), time.time() - start))
+    return len(tiles)
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+class TileRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve GET /z/x/y.png from the cache of the server, rendering missing tiles """
+    def do_GET(self):
+        match = TILE_PATH.match(self.path.split('?')[0])
+        if not match or not is_valid_tile(*map(int, match.groups())):
+            self.send_error(404, 'Tiles are at /{z}/{x}/{y}.png')
+            return
+        z, x, y = map(int, match.groups())
+        server = self.server
+        data = server.cache.get(server.key, z, x, y)
+        if data is None:
+            # matplotlib figures are not thread safe: tiles are rendered one at a time
+            with server.lock:
+                data = get_tile(server.renderer, server.cache, z, x, y, server.key)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+def make_server(renderer, cache, host='127.0.0.1', port=8000):
+    """ Return an HTTP server of the tiles of renderer (call serve_forever() to run it) """
+    server = http.server.ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.renderer = renderer
+    server.cache = cache
+    server.key = renderer.key()
+    server.lock = threading.Lock()
+    return server
+
+def serve(renderer, cache, host='127.0.0.1', port=8000):
+    """ Serve the tiles of renderer at http://host:port/{z}/{x}/{y}.png until interrupted """
+    server = make_server(renderer, cache, host, port)
+    print('Serving tiles at http://%s:%d/{z}/{x}/{y}.png' % (host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def renderer_from_spec(spec=None, data_dir=DATA_DIR, places_fpath=None):
+    """
+    Return a TileRenderer of a map specification of batchmaps.py (csv, delimiter, skip_rows, level, bin_lims or nbins, linewidth, boundaries),
+    with the optional key "facilities": {"type": ..., "facility_type": ...} to add the places of osm_db/osm_places.csv.
+    Without spec: the department and municipality boundaries and the health facilities
+    """
+    import NICmap
+    places_fpath = places_fpath or NICmap.PLACES_FPATH
+    renderer = TileRenderer(data_dir)
+    if spec is None:
+        spec = {'boundaries': ['municipalities', 'depts'], 'facilities': {'type': 'health'}}
+    if spec.get('csv'):
+        adm_num_dicts = NICmap.read_adm_nums(os.path.join(data_dir, spec['csv']), spec.get('delimiter', ','), spec.get('skip_rows', 1))
+        renderer.add_choropleth(adm_num_dicts, level=spec.get('level', 'department'), bin_lims=spec.get('bin_lims'),
+                                nbins=spec.get('nbins', 5), linewidth=spec.get('linewidth', 0.4))
+    for boundaries in spec.get('boundaries', []):
+        if boundaries == 'depts':
+            renderer.add_boundaries('department')
+        elif boundaries == 'municipalities':
+            renderer.add_boundaries('municipality', linewidth=0.2, linestyle='--')
+    if 'facilities' in spec:
+        if os.path.exists(places_fpath):
+            places = NICmap.read_places(places_fpath, **spec['facilities'])
+            renderer.add_facilities([place['lat'] for place in places], [place['lon'] for place in places])
+        else:
+            print('%s not found: no facilities on the tiles' % places_fpath)
+    return renderer
+
+def parse_zooms(text):
+    """ '6-10' -> range(6, 11), '8' -> range(8, 9) """
+    first, _, last = text.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render and serve slippy map tiles of NICmap layers')
+    parser.add_argument('command', choices=['seed', 'serve'])
+    parser.add_argument('--spec', help='JSON file with a map specification (or a list of them, see batchmaps.py)')
+    parser.add_argument('--index', type=int, default=0, help='index of the map specification in a list')
+    parser.add_argument('--zooms', type=parse_zooms, default=parse_zooms('6-10'), help='zoom levels to seed, e.g. 6-10')
+    parser.add_argument('--processes', type=int, help='number of worker processes to seed (default: number of CPUs)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-dir', default=TILE_CACHE_DIR)
+    parser.add_argument('--max-mb', type=float, default=MAX_CACHE_BYTES / 1024 ** 2, help='maximum size of the tile cache')
+    args = parser.parse_args()
+
+    spec = None
+    if args.spec:
+        with open(args.spec, encoding='utf-8') as f:
+            spec = json.load(f)
+        if isinstance(spec, list):
+            spec = spec[args.index]
+    renderer = renderer_from_spec(spec)
+    cache = TileCache(args.cache_dir, int(args.max_mb * 1024 ** 2))
+    if args.command == 'seed':
+        seed(renderer, cache, args.zooms, processes=args.processes)
+    else:
+        serve(renderer, cache, args.host, args.port)